@@ -0,0 +1,513 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import hashlib
+from itertools import chain
+
+from fcrepo.wadl import API
+from fcrepo.client import CachingClient, RESULT_PARSERS
+from fcrepo.client import parse_pids, parse_object_profile, parse_datastreams
+from fcrepo.client import parse_datastream_profile, parse_object_methods
+from fcrepo.client import parse_search_page, search_profile, fix_ds_params
+from fcrepo.client import new_datastream, risearch_request, page_query
+from fcrepo.client import page_bounds
+from fcrepo.connection import ChecksumBody, ChecksumMismatchException
+from fcrepo.connection import CHECKSUM_ALGORITHMS, iter_body
+from fcrepo.eventloop import coroutine, Return
+from fcrepo.foxml import FOXMLBuilder
+from fcrepo.batch import log_message, update_info
+from fcrepo.object import VOLATILE_PROPERTIES as VOLATILE_OBJECT_PROPERTIES
+from fcrepo.datastream import VOLATILE_PROPERTIES
+
+OBJECT_PROPERTIES = ('label', 'ownerId', 'state', 'createdDate',
+                     'lastModifiedDate')
+
+DATASTREAM_PROPERTIES = ('label', 'state', 'checksumType', 'checksum',
+                         'controlGroup', 'createdDate', 'formatURI',
+                         'location', 'mimeType', 'size', 'versionable',
+                         'versionId')
+
+class AsyncFedoraClient(CachingClient):
+    """
+    A client for an AsyncConnection, of which every method returns a
+    Future right away. The requests are sent without blocking by the
+    event loop of the connection, so a single thread can have as many
+    requests in flight as the connection has in its pool. The WADL
+    methods and the parsing of the responses are shared with FedoraClient.
+
+    The Futures are done in the thread of the event loop, wait for them
+    with `connection.loop.run_until_complete(future)`, or with
+    `future.result()` when the loop runs in a thread of its own.
+    Responses are read completely, so the methods that return a response
+    in FedoraClient return the content instead.
+    """
+    def __init__(self, connection, wadl_cache=None, cache=None):
+        # fetching the WADL is the only request that blocks
+        CachingClient.__init__(self, cache)
+        self.api = API(connection.blocking(), wadl_cache)
+        self.api.connection = connection
+        self.connection = connection
+
+    def close(self):
+        self.connection.close()
+
+    @coroutine
+    def getNextPID(self, namespace, numPIDs=1, format=u'text/xml'):
+        request = self.api.getNextPID()
+        response = yield request.submit(namespace=namespace,
+                                        numPIDs=numPIDs,
+                                        format=format)
+        ids = parse_pids(response.read())
+        if len(ids) == 1:
+            raise Return(ids[0])
+        raise Return(ids)
+
+    def createObject(self, pid, label, state=u'A'):
+        return self.ingest(FOXMLBuilder(pid, label, state))
+
+    @coroutine
+    def ingest(self, foxml):
+        """
+        Creates an object with its datastreams from a FOXMLBuilder in a
+        single request. The object knows the properties from the document,
+        `load` fetches the others.
+        """
+        request = self.api.createObject(pid=foxml.pid)
+        request.headers['Content-Type'] = 'text/xml; charset=utf-8'
+        try:
+            yield request.submit(foxml.tostring(), state=foxml.state[0],
+                                 label=foxml.label)
+        finally:
+            self._invalidate(foxml.pid)
+        raise Return(AsyncFedoraObject(foxml.pid, self, foxml.profile()))
+
+    @coroutine
+    def getObject(self, pid, profile=None):
+        """
+        The object profile is fetched before the Future is done, so the
+        properties can be read without blocking, unless a profile with
+        the properties is given.
+        """
+        if profile is None:
+            profile = yield self.getObjectProfile(pid)
+        raise Return(AsyncFedoraObject(pid, self, profile))
+
+    @coroutine
+    def getObjects(self, pids, datastreams=()):
+        """
+        Fetch many objects at once, including their list of datastreams
+        and the profiles of the given datastream ids. The result is a list
+        of (pid, object, error) tuples in the order of the pids, error is
+        the exception raised while fetching the object or None.
+        """
+        @coroutine
+        def fetch(pid):
+            obj = yield self.getObject(pid)
+            dsids = yield obj.datastreams()
+            yield [obj.getDatastream(dsid) for dsid in datastreams
+                   if dsid in dsids]
+            raise Return(obj)
+
+        futures = [(pid, fetch(pid)) for pid in pids]
+        results = []
+        for pid, future in futures:
+            try:
+                obj = yield future
+            except Exception, e:
+                results.append((pid, None, e))
+            else:
+                results.append((pid, obj, None))
+        raise Return(results)
+
+    @coroutine
+    def getObjectProfile(self, pid):
+        result = self._cached(('profile', pid))
+        if result is not None:
+            raise Return(result)
+        generation = self._generation(pid)
+        request = self.api.getObjectProfile(pid=pid)
+        response = yield request.submit(format=u'text/xml')
+        result = parse_object_profile(response.read())
+        self._store(('profile', pid), result, generation)
+        raise Return(result)
+
+    @coroutine
+    def updateObject(self, pid, body='', **params):
+        request = self.api.updateObject(pid=pid)
+        try:
+            yield request.submit(body, **params)
+        finally:
+            self._invalidate(pid)
+
+    @coroutine
+    def deleteObject(self, pid, **params):
+        request = self.api.deleteObject(pid=pid)
+        try:
+            yield request.submit(**params)
+        finally:
+            self._invalidate(pid)
+
+    @coroutine
+    def listDatastreams(self, pid, profiles=False):
+        result = self._cached(('datastreams', pid))
+        if result is None:
+            generation = self._generation(pid)
+            request = self.api.listDatastreams(pid=pid)
+            response = yield request.submit(format=u'text/xml')
+            result = parse_datastreams(response.read())
+            self._store(('datastreams', pid), result, generation)
+        if not profiles:
+            raise Return([dsid for dsid, profile in result])
+        raise Return(result)
+
+    def addDatastream(self, pid, dsid, body='', filename=None, **params):
+        body, params = new_datastream(dsid, body, filename, params)
+        request = self.api.addDatastream(pid=pid, dsID=dsid)
+        request.headers['Content-Type'] = params['mimeType']
+        verify = params.get('controlGroup') == u'M'
+        return self._submit_content(request, pid, dsid, body, filename,
+                                    params, verify)
+
+    @coroutine
+    def _submit_content(self, request, pid, dsid, body, filename, params,
+                        verify):
+        # like FedoraClient._submit_content, a file is read by the event
+        # loop while it is sent
+        algorithm = None
+        if verify:
+            algorithm = CHECKSUM_ALGORITHMS.get(params.get('checksumType'))
+        if filename is not None:
+            fp = body = open(filename, 'rb')
+        try:
+            if algorithm is not None and body:
+                if isinstance(body, str):
+                    params.setdefault('checksum', unicode(
+                        hashlib.new(algorithm, body).hexdigest()))
+                else:
+                    body = ChecksumBody(body, algorithm,
+                                        self.connection.blocksize)
+            yield request.submit(body, **params)
+        finally:
+            self._invalidate(pid)
+            if filename is not None:
+                fp.close()
+
+        if isinstance(body, ChecksumBody):
+            profile = yield self.getDatastreamProfile(pid, dsid)
+            if profile.get('checksum') != body.hexdigest():
+                raise ChecksumMismatchException(profile.get('checksum'),
+                                                body.hexdigest())
+
+    @coroutine
+    def getDatastreamProfile(self, pid, dsid):
+        result = self._cached(('dsprofile', pid, dsid))
+        if result is not None:
+            raise Return(result)
+        generation = self._generation(pid)
+        request = self.api.getDatastreamProfile(pid=pid, dsID=dsid)
+        response = yield request.submit(format=u'text/xml')
+        result = parse_datastream_profile(response.read())
+        self._store(('dsprofile', pid, dsid), result, generation)
+        raise Return(result)
+
+    @coroutine
+    def modifyDatastream(self, pid, dsid, body='', filename=None,
+                         controlGroup=None, **params):
+        params = fix_ds_params(params)
+        verify = False
+        if 'checksumType' in params and (body or filename is not None):
+            if controlGroup is None:
+                profile = yield self.getDatastreamProfile(pid, dsid)
+                controlGroup = profile.get('controlGroup')
+            verify = controlGroup == u'M'
+        request = self.api.modifyDatastream(pid=pid, dsID=dsid)
+        yield self._submit_content(request, pid, dsid, body, filename,
+                                   params, verify)
+
+    @coroutine
+    def getDatastream(self, pid, dsid, start=None, end=None):
+        """
+        Unlike FedoraClient.getDatastream, the result is the content
+        """
+        request = self.api.getDatastream(pid=pid, dsID=dsid)
+        if start is not None or end is not None:
+            if end is None:
+                end = ''
+            request.headers['Range'] = 'bytes=%s-%s' % (start or 0, end)
+        response = yield request.submit()
+        raise Return(response.read())
+
+    @coroutine
+    def deleteDatastream(self, pid, dsid, **params):
+        request = self.api.deleteDatastream(pid=pid, dsID=dsid)
+        try:
+            yield request.submit(**params)
+        finally:
+            self._invalidate(pid)
+
+    @coroutine
+    def getAllObjectMethods(self, pid, **params):
+        params['format'] = u'text/xml'
+        request = self.api.getAllObjectMethods(pid=pid)
+        response = yield request.submit(**params)
+        raise Return(parse_object_methods(response.read()))
+
+    @coroutine
+    def invokeSDefMethodUsingGET(self, pid, sdef, method, **params):
+        """
+        The result is the content returned by the method
+        """
+        request = self.api.invokeSDefMethodUsingGET(pid=pid, sDef=sdef,
+                                                    method=method)
+        response = yield request.submit(**params)
+        raise Return(response.read())
+
+    @coroutine
+    def searchObjects(self, query, fields, terms=False, maxResults=10,
+                      objects=False):
+        """
+        The result is a list of all results. With objects, the list
+        contains AsyncFedoraObjects with the properties from the search
+        fields, call their `load` method to fetch the others.
+        """
+        field_params = {}
+        assert isinstance(fields, list)
+        for field in fields:
+            field_params[field] = u'true'
+        params = {'maxResults': maxResults,
+                  'resultFormat': u'text/xml'}
+        if terms:
+            params['terms'] = query
+        else:
+            params['query'] = query
+        request = self.api.searchObjects()
+        request.undocumented_params = field_params
+
+        results = []
+        token = None
+        while True:
+            page_params = dict(params)
+            if token:
+                page_params['sessionToken'] = token
+            response = yield request.submit(**page_params)
+            token = None
+            for kind, value in parse_search_page(response):
+                if kind == 'token':
+                    token = value
+                elif objects:
+                    results.append(AsyncFedoraObject(value['pid'][0], self,
+                                                     search_profile(value)))
+                else:
+                    results.append(value)
+            if not token:
+                break
+        raise Return(results)
+
+    @coroutine
+    def searchTriples(self, query, lang='sparql', format='Sparql',
+                      limit=None, type='tuples', dt='on', flush=True,
+                      pagesize=None):
+        """
+        The result is a list of the results of a resource index query,
+        see FedoraClient.searchTriples
+        """
+        parse = RESULT_PARSERS.get(format.lower())
+        if parse is None:
+            raise ValueError('Unsupported result format: %s' % format)
+        if not pagesize:
+            response = yield self._risearch(query, lang, format, limit, type,
+                                            dt, flush)
+            raise Return(list(parse(response)))
+
+        if lang.lower() != 'sparql':
+            raise ValueError('Paging is only supported for SPARQL queries')
+        query, limit, start = page_bounds(query, limit)
+        results = []
+        offset = 0
+        while limit is None or offset < limit:
+            size = pagesize
+            if limit is not None:
+                size = min(size, limit - offset)
+            response = yield self._risearch(
+                page_query(query, size, start + offset), lang, format, None,
+                type, dt, flush)
+            page = list(parse(response))
+            results.extend(page)
+            if len(page) < size:
+                break
+            offset += len(page)
+            flush = False
+        raise Return(results)
+
+    @coroutine
+    def countTriples(self, query, lang='sparql', type='tuples', flush=True):
+        response = yield self._risearch(query, lang, 'count', None, type,
+                                        'on', flush)
+        raise Return(int(response.read().strip()))
+
+    def _risearch(self, query, lang, format, limit, type, dt, flush):
+        url, headers = risearch_request(query, lang, format, limit, type, dt,
+                                        flush)
+        return self.connection.open(url, '', headers, method='POST')
+
+class AsyncFedoraObject(object):
+    """
+    An object of which the methods return Futures. The properties are
+    read from the profile it was created with, `load` fetches it again
+    and `update` changes properties.
+    """
+    def __init__(self, pid, client, profile=None):
+        self.pid = pid
+        self.client = client
+        self._info = dict(profile or {})
+        self._methods = None
+
+    def __getattr__(self, name):
+        if name in OBJECT_PROPERTIES:
+            try:
+                return self._info[name]
+            except KeyError:
+                raise AttributeError('%s of %s is not loaded, call load' % (
+                    name, self.pid))
+        raise AttributeError(name)
+
+    @coroutine
+    def load(self):
+        """
+        Fetch the object profile again
+        """
+        self._info = yield self.client.getObjectProfile(self.pid)
+        raise Return(self)
+
+    @coroutine
+    def update(self, logMessage=None, **properties):
+        """
+        Change the given properties in a single request. The Future is
+        done when they are saved, the properties that Fedora changes, like
+        lastModifiedDate, are only known after `load`.
+        """
+        if logMessage is None:
+            logMessage = log_message(u'object', properties)
+        yield self.client.updateObject(self.pid, logMessage=logMessage,
+                                       **properties)
+        update_info(self._info, properties, VOLATILE_OBJECT_PROPERTIES)
+        raise Return(self)
+
+    def datastreams(self):
+        return self.client.listDatastreams(self.pid)
+
+    @coroutine
+    def getDatastream(self, dsid):
+        """
+        The Future is done when the datastream profile is loaded
+        """
+        profile = yield self.client.getDatastreamProfile(self.pid, dsid)
+        raise Return(AsyncFedoraDatastream(dsid, self, profile))
+
+    def deleteDatastream(self, dsid, **params):
+        return self.client.deleteDatastream(self.pid, dsid, **params)
+
+    def delete(self, **params):
+        return self.client.deleteObject(self.pid, **params)
+
+    def addDataStream(self, dsid, body='', **params):
+        return self.client.addDatastream(self.pid, dsid, body, **params)
+
+    @coroutine
+    def methods(self):
+        if self._methods is None:
+            self._methods = yield self.client.getAllObjectMethods(self.pid)
+        raise Return([m[1] for m in self._methods])
+
+    @coroutine
+    def call(self, method_name, **params):
+        """
+        The result is the content returned by the method
+        """
+        yield self.methods()
+        for sdef, method in self._methods:
+            if method == method_name:
+                break
+        else:
+            raise KeyError('No such method: %s' % method_name)
+        content = yield self.client.invokeSDefMethodUsingGET(
+            self.pid, sdef, method, **params)
+        raise Return(content)
+
+class AsyncFedoraDatastream(object):
+    """
+    A datastream of which the methods return Futures, the properties are
+    read from its profile
+    """
+    def __init__(self, dsid, object, profile=None):
+        self.dsid = dsid
+        self.object = object
+        self.client = object.client
+        self._info = dict(profile or {})
+
+    def __getattr__(self, name):
+        if name in DATASTREAM_PROPERTIES:
+            try:
+                return self._info[name]
+            except KeyError:
+                raise AttributeError('%s of %s is not loaded, call load' % (
+                    name, self.dsid))
+        raise AttributeError(name)
+
+    @coroutine
+    def load(self):
+        self._info = yield self.client.getDatastreamProfile(self.object.pid,
+                                                            self.dsid)
+        raise Return(self)
+
+    @coroutine
+    def update(self, logMessage=None, **properties):
+        """
+        Change the given properties in a single request
+        """
+        if logMessage is None:
+            logMessage = log_message(u'datastream', properties)
+        yield self.client.modifyDatastream(self.object.pid, self.dsid,
+                                           logMessage=logMessage,
+                                           ignoreContent=True, **properties)
+        update_info(self._info, properties, VOLATILE_PROPERTIES)
+        raise Return(self)
+
+    def getContent(self, start=None, end=None):
+        """
+        The result is the content, not the response
+        """
+        return self.client.getDatastream(self.object.pid, self.dsid, start,
+                                         end)
+
+    @coroutine
+    def setContent(self, data='', filename=None, **params):
+        """
+        Data can be a string, a file-like object or an iterable of strings,
+        or pass a filename to stream the content from disk.
+        """
+        controlGroup = self._info.get('controlGroup')
+        if filename is not None:
+            fp = data = open(filename, 'rb')
+        try:
+            if controlGroup == u'X':
+                # Fedora needs a line end after inline XML
+                if isinstance(data, basestring):
+                    data = [data, '\r\n']
+                else:
+                    data = chain(iter_body(data), ['\r\n'])
+            elif (controlGroup == u'M' and 'checksumType' not in params and
+                  self._info.get('checksumType') in CHECKSUM_ALGORITHMS):
+                params['checksumType'] = self._info['checksumType']
+            yield self.client.modifyDatastream(self.object.pid, self.dsid,
+                                               data,
+                                               controlGroup=controlGroup,
+                                               **params)
+        finally:
+            if filename is not None:
+                fp.close()
+        update_info(self._info, {}, VOLATILE_PROPERTIES)
+
+    def delete(self, **params):
+        return self.client.deleteDatastream(self.object.pid, self.dsid,
+                                            **params)
@@ -0,0 +1,749 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import os
+import time
+import errno
+import socket
+import httplib
+import urlparse
+import logging
+from collections import deque
+
+from fcrepo.cache import CachedResponse
+from fcrepo.workers import Future
+from fcrepo.eventloop import EventLoop, READ, WRITE, coroutine, Return
+from fcrepo.connection import BLOCKSIZE, CONDITIONAL_HEADERS, ACCEPT_ENCODING
+from fcrepo.connection import CONNECTION_ERRORS, RequestInfo, RetryPolicy
+from fcrepo.connection import body_length, body_position, rewind_body
+from fcrepo.connection import iter_body, is_dropped, decoder
+from fcrepo.connection import check_response_status
+
+# errors of a non-blocking socket that is not ready
+WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN,
+              getattr(errno, 'WSAEWOULDBLOCK', 10035))
+
+CONNECTING = (errno.EINPROGRESS, errno.EWOULDBLOCK,
+              getattr(errno, 'WSAEWOULDBLOCK', 10035))
+
+# the most bytes of response headers that are buffered
+MAX_HEAD = 64 * 1024
+
+class AsyncResponse(CachedResponse):
+    """
+    A response that has been read completely, compressed content has been
+    decoded already
+    """
+    def __init__(self, status, reason, data, headers):
+        CachedResponse.__init__(self, data, headers)
+        self.status = status
+        self.reason = reason
+
+class ResponseParser(object):
+    """
+    Parses a HTTP response from the data read from a socket, a block at a
+    time. The body is delimited by its Content-Length, by chunked transfer
+    coding or by the end of the connection.
+    """
+    def __init__(self, method):
+        self.method = method
+        self.version = None
+        self.status = None
+        self.reason = None
+        self.headers = {}
+        self.keep_alive = False
+        self.complete = False
+        # the number of bytes of the body as it was sent
+        self.received = 0
+        self._buffer = ''
+        self._state = 'head'
+        self._remaining = None
+        self._body = []
+
+    def feed(self, data):
+        """
+        Parses a block of data, returns True when the response is complete
+        """
+        self._buffer += data
+        while (not self.complete and
+               getattr(self, '_parse_' + self._state)()):
+            pass
+        if self.complete and self._buffer:
+            # more than the response was sent, the connection is not in
+            # a known state
+            self.keep_alive = False
+        return self.complete
+
+    def feed_eof(self):
+        """
+        The connection was closed by the server
+        """
+        if self._state == 'close':
+            self.complete = True
+            return
+        if self._state == 'head' and self.status is None:
+            raise httplib.BadStatusLine(self._buffer or "''")
+        raise httplib.IncompleteRead(''.join(self._body))
+
+    def response(self):
+        data = ''.join(self._body)
+        headers = self.headers
+        decode = decoder(headers.get('content-encoding'))
+        if decode is not None:
+            data = decode.decompress(data) + decode.flush()
+            # the length is not the decoded length
+            headers = dict(headers)
+            headers.pop('content-length', None)
+        return AsyncResponse(self.status, self.reason, data, headers)
+
+    def _parse_head(self):
+        end = self._buffer.find('\r\n\r\n')
+        if end == -1:
+            if len(self._buffer) > MAX_HEAD:
+                raise httplib.HTTPException('Response headers too long')
+            return False
+        lines = self._buffer[:end].split('\r\n')
+        self._buffer = self._buffer[end + 4:]
+        parts = lines[0].split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise httplib.BadStatusLine(lines[0])
+        try:
+            status = int(parts[1])
+        except ValueError:
+            raise httplib.BadStatusLine(lines[0])
+        if 100 <= status < 200:
+            # an interim response, like 100 Continue
+            return True
+        self.version = parts[0]
+        self.status = status
+        self.reason = len(parts) > 2 and parts[2] or ''
+        name = None
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and name is not None:
+                # a folded header
+                self.headers[name] += ' ' + line.strip()
+                continue
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            value = value.strip()
+            if name in self.headers:
+                value = '%s, %s' % (self.headers[name], value)
+            self.headers[name] = value
+
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+        if self.method == 'HEAD' or status in (204, 304):
+            self.complete = True
+        elif 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self._state = 'chunk_size'
+        elif 'content-length' in self.headers:
+            try:
+                self._remaining = int(self.headers['content-length'])
+            except ValueError:
+                raise httplib.HTTPException('Bad Content-Length: %s' % (
+                    self.headers['content-length']))
+            self._state = 'body'
+            self.complete = not self._remaining
+        else:
+            # the body ends when the server closes the connection
+            self.keep_alive = False
+            self._state = 'close'
+        return True
+
+    def _take(self):
+        # moves up to the remaining bytes from the buffer to the body,
+        # returns True when they have all been read
+        data = self._buffer[:self._remaining]
+        self._buffer = self._buffer[len(data):]
+        self._body.append(data)
+        self.received += len(data)
+        self._remaining -= len(data)
+        return not self._remaining
+
+    def _parse_body(self):
+        self.complete = self._take()
+        return False
+
+    def _parse_close(self):
+        self._body.append(self._buffer)
+        self.received += len(self._buffer)
+        self._buffer = ''
+        return False
+
+    def _parse_chunk_size(self):
+        end = self._buffer.find('\r\n')
+        if end == -1:
+            return False
+        line = self._buffer[:end]
+        self._buffer = self._buffer[end + 2:]
+        try:
+            size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise httplib.IncompleteRead(''.join(self._body))
+        if size:
+            self._remaining = size
+            self._state = 'chunk_data'
+        else:
+            self._state = 'trailer'
+        return True
+
+    def _parse_chunk_data(self):
+        if not self._take():
+            return False
+        self._state = 'chunk_end'
+        return True
+
+    def _parse_chunk_end(self):
+        if len(self._buffer) < 2:
+            return False
+        self._buffer = self._buffer[2:]
+        self._state = 'chunk_size'
+        return True
+
+    def _parse_trailer(self):
+        end = self._buffer.find('\r\n')
+        if end == -1:
+            return False
+        line = self._buffer[:end]
+        self._buffer = self._buffer[end + 2:]
+        if not line:
+            self.complete = True
+        return True
+
+class AsyncHTTPConnection(object):
+    """
+    A persistent HTTP/1.1 connection of which the socket does not block.
+    A request is sent and its response read by the handler that the
+    event loop calls when the socket is ready, one request at a time.
+    It measures the time spent connecting like TimedHTTPConnection.
+    """
+    def __init__(self, loop, host, addresses, dns_time=None):
+        self.loop = loop
+        self.host = host
+        self.sock = None
+        self.dns_time = dns_time
+        self.connect_time = None
+        # whether any of the current request has been sent
+        self.request_sent = False
+        self.body_sent = 0
+        self._addresses = addresses
+        self._untried = []
+        self._state = None
+        self._future = None
+        self._timer = None
+        self._info = None
+        self._parser = None
+        self._pieces = deque()
+        self._offset = 0
+        self._blocks = None
+        self._chunked = False
+
+    def request(self, method, url, body='', headers=None, timeout=None,
+                info=None):
+        """
+        Sends a request, returns a Future of the AsyncResponse. Called in
+        the thread of the event loop.
+        """
+        if self._future is not None:
+            raise httplib.CannotSendRequest()
+        future = self._future = Future()
+        self._info = info
+        self.request_sent = False
+        self.body_sent = 0
+        self._parser = ResponseParser(method)
+        if timeout is not None:
+            self._timer = self.loop.call_later(timeout, self._timed_out)
+        try:
+            self._prepare(method, url, body, headers or {})
+            if self.sock is None:
+                self._untried = list(self._addresses)
+                self._connect()
+            else:
+                self._state = 'sending'
+                self.loop.register(self.sock.fileno(), self, WRITE)
+        except Exception, e:
+            self._fail(e)
+        return future
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.unregister(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    def _prepare(self, method, url, body, headers):
+        names = [name.lower() for name in headers]
+        lines = ['%s %s HTTP/1.1' % (method, url)]
+        if 'host' not in names:
+            lines.append('Host: %s' % self.host)
+        if 'accept-encoding' not in names:
+            lines.append('Accept-Encoding: identity')
+        self._pieces = deque()
+        self._offset = 0
+        self._blocks = None
+        self._chunked = False
+        if isinstance(body, unicode):
+            body = body.encode('utf8')
+        if isinstance(body, str):
+            if body:
+                self._pieces.append(body)
+            length = len(body)
+        elif isinstance(body, (list, tuple)):
+            self._pieces.extend([block for block in body if block])
+            length = body_length(body)
+        else:
+            self._blocks = iter_body(body, BLOCKSIZE)
+            length = body_length(body)
+        if 'content-length' not in names:
+            if length is None:
+                self._chunked = True
+                lines.append('Transfer-Encoding: chunked')
+            else:
+                lines.append('Content-Length: %d' % length)
+        for name, value in headers.items():
+            # like httplib, unicode values must be ascii
+            lines.append('%s: %s' % (str(name), str(value)))
+        if self._blocks is None:
+            self.body_sent = length
+        self._pieces.appendleft('\r\n'.join(lines) + '\r\n\r\n')
+
+    def _connect(self):
+        error = socket.error('getaddrinfo returns an empty list')
+        while self._untried:
+            family, socktype, proto, canonname, address = self._untried.pop(0)
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            self._connecting = time.time()
+            code = sock.connect_ex(address)
+            if code == 0 or code in CONNECTING:
+                self.sock = sock
+                self._state = 'connecting'
+                self.loop.register(sock.fileno(), self, WRITE)
+                return
+            sock.close()
+            error = socket.error(code, os.strerror(code))
+        raise error
+
+    def handle_events(self, readable, writable):
+        try:
+            if self._state == 'connecting':
+                code = self.sock.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_ERROR)
+                if code:
+                    self.close()
+                    if self._untried:
+                        # try the next address of the host
+                        self._connect()
+                        return
+                    raise socket.error(code, os.strerror(code))
+                self.connect_time = time.time() - self._connecting
+                self._state = 'sending'
+            if self._state == 'sending':
+                self._write()
+            elif self._state == 'reading':
+                self._read()
+        except Exception, e:
+            self._fail(e)
+
+    def _write(self):
+        while True:
+            if not self._pieces and not self._next_block():
+                # the request is sent, wait for the response
+                if self._info is not None:
+                    self._info.sent(self, self.body_sent)
+                self._state = 'reading'
+                self.loop.modify(self.sock.fileno(), READ)
+                return
+            data = self._pieces[0]
+            try:
+                # a buffer does not copy the rest of a large string
+                sent = self.sock.send(buffer(data, self._offset, BLOCKSIZE))
+            except socket.error, e:
+                if e.args[0] in WOULDBLOCK:
+                    return
+                raise
+            self.request_sent = True
+            self._offset += sent
+            if self._offset >= len(data):
+                self._pieces.popleft()
+                self._offset = 0
+
+    def _next_block(self):
+        # queues the next block of a streamed body, returns False when
+        # the body has been queued completely
+        if self._blocks is None:
+            return False
+        for block in self._blocks:
+            if not block:
+                # an empty chunk would end the body
+                continue
+            self.body_sent += len(block)
+            if self._chunked:
+                self._pieces.extend(['%x\r\n' % len(block), block, '\r\n'])
+            else:
+                self._pieces.append(block)
+            return True
+        self._blocks = None
+        if self._chunked:
+            self._pieces.append('0\r\n\r\n')
+            return True
+        return False
+
+    def _read(self):
+        try:
+            data = self.sock.recv(BLOCKSIZE)
+        except socket.error, e:
+            if e.args[0] in WOULDBLOCK:
+                return
+            raise
+        parser = self._parser
+        if not data:
+            parser.feed_eof()
+        else:
+            parser.feed(data)
+            if parser.status is not None and self._info is not None and \
+                   self._info.status is None:
+                self._info.received(parser.status)
+        if parser.complete:
+            self._done()
+
+    def _done(self):
+        parser = self._parser
+        response = parser.response()
+        if self._info is not None:
+            if self._info.status is None:
+                self._info.received(parser.status)
+            self._info.bytes_received += parser.received
+        future = self._reset()
+        if not parser.keep_alive:
+            self.close()
+        # the connection is ready for the next request before the
+        # callbacks of the future run
+        future.set_result(response)
+
+    def _fail(self, error):
+        future = self._reset()
+        self.close()
+        if future is not None:
+            future.set_exception(error)
+
+    def _timed_out(self):
+        self._timer = None
+        self._fail(socket.timeout('timed out'))
+
+    def _reset(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.sock is not None:
+            self.loop.unregister(self.sock.fileno())
+        future, self._future = self._future, None
+        self._state = None
+        self._info = None
+        self._parser = None
+        self._pieces = deque()
+        self._blocks = None
+        return future
+
+def split_host(host, default_port=httplib.HTTP_PORT):
+    """
+    Splits host:port, an IPv6 address is in brackets like in URLs
+    """
+    colon = host.rfind(':')
+    bracket = host.rfind(']')
+    port = default_port
+    if colon > bracket:
+        port = int(host[colon + 1:])
+        host = host[:colon]
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    return host, port
+
+class AsyncConnectionPool(object):
+    """
+    A pool of persistent AsyncHTTPConnections, keyed by host. Unlike
+    ConnectionPool it is only used in the thread of the event loop and
+    needs no lock, a checkout returns a Future of a connection which is
+    done when one is free. Host names are resolved once, that is the
+    only call that blocks the loop.
+    """
+    def __init__(self, loop, maxsize=100, idle_timeout=60):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.size = 0
+        # the number of connections that broke
+        self.discarded = 0
+        self._idle = {}
+        self._waiting = deque()
+        self._addresses = {}
+
+    def checkout(self, host):
+        future = Future()
+        self._reap()
+        idle = self._idle.get(host)
+        while idle:
+            conn = idle.pop()[0]
+            if not is_dropped(conn):
+                future.set_result(conn)
+                return future
+            conn.close()
+            self.size -= 1
+        if self.size >= self.maxsize:
+            # make room by closing a connection to another host
+            self._discard_idle()
+        if self.size < self.maxsize:
+            try:
+                future.set_result(self._new(host))
+            except socket.error, e:
+                future.set_exception(e)
+        else:
+            self._waiting.append((host, future))
+        return future
+
+    def checkin(self, host, conn):
+        if conn.sock is None:
+            # the server closed the connection after the response
+            self.size -= 1
+        else:
+            self._idle.setdefault(host, []).append((conn, time.time()))
+        self._serve()
+
+    def discard(self, conn):
+        # the connection is broken or was left in an unknown state
+        conn.close()
+        self.size -= 1
+        self.discarded += 1
+        self._serve()
+
+    def close(self):
+        for idle in self._idle.values():
+            for conn, last_used in idle:
+                conn.close()
+                self.size -= 1
+        self._idle = {}
+
+    def _new(self, host):
+        dns_time = None
+        addresses = self._addresses.get(host)
+        if addresses is None:
+            started = time.time()
+            name, port = split_host(host)
+            addresses = socket.getaddrinfo(name, port, 0, socket.SOCK_STREAM)
+            dns_time = time.time() - started
+            self._addresses[host] = addresses
+        self.size += 1
+        return AsyncHTTPConnection(self.loop, host, addresses, dns_time)
+
+    def _serve(self):
+        # hands free connections to the requests waiting for one, their
+        # futures are finished by the loop, outside of the pool methods
+        while self._waiting:
+            host, future = self._waiting[0]
+            idle = self._idle.get(host)
+            conn = None
+            if idle:
+                conn = idle.pop()[0]
+            elif self.size >= self.maxsize and not self._discard_idle():
+                break
+            self._waiting.popleft()
+            if conn is None:
+                try:
+                    conn = self._new(host)
+                except socket.error, e:
+                    self.loop.call_soon(future.set_exception, e)
+                    continue
+            self.loop.call_soon(future.set_result, conn)
+
+    def _reap(self):
+        expired = time.time() - self.idle_timeout
+        for host, idle in self._idle.items():
+            # connections are appended on checkin, so the oldest come first
+            while idle and idle[0][1] < expired:
+                idle.pop(0)[0].close()
+                self.size -= 1
+            if not idle:
+                del self._idle[host]
+
+    def _discard_idle(self):
+        for host, idle in self._idle.items():
+            if idle:
+                idle.pop(0)[0].close()
+                self.size -= 1
+                return True
+        return False
+
+class AsyncConnection(object):
+    """
+    A connection to a Fedora repository like Connection, of which `open`
+    returns a Future of the response instead of blocking. The requests
+    are sent by an EventLoop on a pool of non-blocking persistent
+    connections, so a single thread has many requests in flight. A
+    response is read completely before its Future is done.
+    """
+    def __init__(self, url, username=None, password=None, loop=None,
+                 pool_size=100, timeout=60, retry=None, breaker=None,
+                 compress=False):
+        """
+         url -- URI pointing to the Fedora server. eg.
+
+            http://localhost:8080/fedora/
+
+         loop -- The EventLoop running the requests, by default a new one.
+
+         pool_size -- The maximum number of open connections, which is
+                the number of requests in flight.
+
+         timeout -- The number of seconds a request may take, from
+                connecting until its response was read.
+
+         retry -- The RetryPolicy of failed requests, by default
+                idempotent requests are retried 3 times.
+
+         breaker -- A CircuitBreaker, which fails requests fast while
+                the server is failing.
+
+         compress -- Ask for gzip or deflate compressed responses.
+
+        The hooks are called in the thread of the event loop, so they must
+        not block, which rules out a ConcurrencyLimiter: the pool_size
+        limits the requests in flight.
+        """
+        self.scheme, self.host, self.path = urlparse.urlparse(url, 'http')[:3]
+        self.url = url
+        self.username = username
+        self.password = password
+        if loop is None:
+            loop = EventLoop()
+        self.loop = loop
+        self.pool = AsyncConnectionPool(loop, pool_size)
+        self.timeout = timeout
+        self.blocksize = BLOCKSIZE
+        self.compress = compress
+        if retry is None:
+            retry = RetryPolicy()
+        self.retry = retry
+        self.hooks = []
+        self.breaker = breaker
+        if breaker is not None:
+            self.hooks.append(breaker)
+
+        self.form_headers = {}
+        if self.username and self.password:
+            token = ('%s:%s' % (self.username,
+                                self.password)).encode('base64').strip()
+            self.form_headers['Authorization'] = 'Basic %s' % token
+
+    @property
+    def reconnects(self):
+        return self.pool.discarded
+
+    def close(self):
+        """
+        Close the idle connections
+        """
+        self.loop.call_soon(self.pool.close)
+
+    def open(self, url, body='', headers=None, method='GET', method_id=None,
+             template=None):
+        """
+        Send a request, returns a Future of the response. Can be called
+        from any thread, the request is sent by the event loop.
+
+        Failed requests are retried according to the retry policy, like
+        those of a Connection, without blocking the loop in between.
+        """
+        return self.loop.submit(self._open, url, body, headers, method,
+                                method_id, template)
+
+    def blocking(self):
+        """
+        Returns a connection of which open blocks until the response has
+        been read, for the requests that are needed before the event loop
+        is used, like those fetching the WADL.
+        """
+        return BlockingConnection(self)
+
+    @coroutine
+    def _open(self, url, body, headers, method, method_id, template):
+        headers = dict(headers or {})
+        header_names = [name.lower() for name in headers]
+        conditional = False
+        for name in header_names:
+            if name in CONDITIONAL_HEADERS:
+                conditional = True
+        if (self.compress and 'accept-encoding' not in header_names and
+            'range' not in header_names):
+            headers['Accept-Encoding'] = ACCEPT_ENCODING
+        if url.startswith('/'):
+            url = url[1:]
+        url = '%s/%s' % (self.path, url)
+        if isinstance(url, unicode):
+            url = url.encode('utf8')
+        position = body_position(body)
+        info = RequestInfo(method, url, method_id, template, self.hooks)
+        policy = self.retry
+        idempotent = policy.idempotent(method, method_id)
+        policy.budget.request()
+
+        try:
+            attempt = 0
+            while True:
+                checkout = time.time()
+                conn = yield self.pool.checkout(self.host)
+                info.sending(time.time() - checkout)
+                try:
+                    logging.debug('Trying %s on %s' % (method, url))
+                    response = yield conn.request(method, url, body, headers,
+                                                  self.timeout, info)
+                except CONNECTION_ERRORS, e:
+                    logging.exception('Got an Exception in open')
+                    self.pool.discard(conn)
+                    # a request that was not sent at all can be retried
+                    if (not rewind_body(body, position) or
+                        not policy.retry(attempt,
+                                         idempotent or not conn.request_sent)):
+                        raise
+                    delay = policy.delay(attempt)
+                except:
+                    self.pool.discard(conn)
+                    raise
+                else:
+                    self.pool.checkin(self.host, conn)
+                    delay = None
+                    if (response.status in policy.statuses and
+                        rewind_body(body, position) and
+                        policy.retry(attempt, idempotent, response.status)):
+                        delay = policy.delay(
+                            attempt, response.getheader('retry-after'))
+                    if delay is None:
+                        info.finish()
+                        response = check_response_status(response,
+                                                         conditional)
+                        break
+                    logging.info('Retrying %s on %s after status %s' % (
+                        method, url, response.status))
+                attempt += 1
+                info.backoff += delay
+                yield self.loop.sleep(delay)
+        except Exception, e:
+            info.finish(e)
+            raise
+        raise Return(response)
+
+class BlockingConnection(object):
+    """
+    Opens requests on an AsyncConnection and waits for their responses
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.url = connection.url
+        self.form_headers = connection.form_headers
+
+    def open(self, url, body='', headers=None, method='GET', method_id=None,
+             template=None):
+        return self.connection.loop.wait(self.connection.open(
+            url, body, headers, method, method_id, template))
@@ -0,0 +1,78 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+from contextlib import contextmanager
+
+def log_message(kind, names):
+    """
+    The default log message of a change of the named properties
+    """
+    names = sorted(names)
+    if len(names) == 1:
+        return u'Changed %s %s property' % (names[0], kind)
+    return u'Changed %s %s properties' % (u', '.join(names), kind)
+
+def update_info(info, properties, volatile):
+    """
+    Set the saved properties in the profile info. The new values are
+    known, the volatile ones are fetched again when they are needed.
+    """
+    info.update(properties)
+    for name in volatile:
+        if name not in properties:
+            info.pop(name, None)
+
+class BatchedProperties(object):
+    """
+    Saves the properties of an object or datastream when they are set,
+    or in a single request at the end of a batch. The class sets `_kind`
+    for the log message and `_volatile`, the properties that Fedora
+    changes on every modification, and implements `_save`.
+    """
+    _kind = None
+    _volatile = ()
+
+    def _setProperty(self, name, value):
+        self._pending[name] = value
+        if not self._batches:
+            self._flush()
+
+    @contextmanager
+    def batch(self, logMessage=None):
+        """
+        Collect the properties changed within the with statement, and
+        save them in a single request when it ends:
+
+          with obj.batch(u'Moved to the archive'):
+              obj.label = u'Archived'
+              obj.state = u'I'
+        """
+        self._batches += 1
+        try:
+            yield self
+        except:
+            self._batches -= 1
+            if not self._batches:
+                self._pending = {}
+            raise
+        self._batches -= 1
+        if not self._batches:
+            self._flush(logMessage)
+
+    def _flush(self, logMessage=None):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        if logMessage is None:
+            logMessage = log_message(self._kind, pending)
+        try:
+            self._save(pending, logMessage)
+        except:
+            self._info = {}
+            self._loaded = False
+            raise
+        update_info(self._info, pending, self._volatile)
+        self._loaded = False
+
+    def _save(self, properties, logMessage):
+        raise NotImplementedError
@@ -0,0 +1,163 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import time
+import threading
+
+class CachedResponse(object):
+    """
+    Looks like a response, for content served from a cache
+    """
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, data, headers=None):
+        self._data = data
+        self._position = 0
+        self._headers = headers or {}
+
+    def read(self, amt=None):
+        if amt is None:
+            end = len(self._data)
+        else:
+            end = self._position + amt
+        data = self._data[self._position:end]
+        self._position += len(data)
+        return data
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return self._headers.items()
+
+    def isclosed(self):
+        return self._position >= len(self._data)
+
+    def close(self):
+        pass
+
+class ObjectCache(object):
+    """
+    A thread safe cache of object and datastream profiles, datastream
+    lists and small datastream contents, which can be passed to a
+    FedoraClient. The least recently used entries are evicted when there
+    are more than maxsize, and entries expire ttl seconds after they were
+    stored.
+
+    Keys are tuples of the kind of entry and the pid, followed by other
+    parts. Another cache can be used instead of this one, when it has
+    the same get, set, invalidate and clear methods.
+    """
+    def __init__(self, maxsize=1000, ttl=60, contents=('DC', 'RELS-EXT'),
+                 maxcontent=0):
+        """
+         contents -- The ids of the datastreams of which the content is
+                cached, it is revalidated after ttl seconds.
+
+         maxcontent -- The content of other datastreams up to this number
+                of bytes is cached too, but revalidated on every read.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.contents = contents
+        self.maxcontent = maxcontent
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pids = {}
+        # a circular doubly linked list of [previous, next, key] links,
+        # the most recently used entries are at the end
+        self._root = root = []
+        root[:] = [root, root, None]
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or None
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            link, value, expires = entry
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # move the link to the end of the list
+            previous, next, key = link
+            previous[1] = next
+            next[0] = previous
+            last = self._root[0]
+            last[1] = self._root[0] = link
+            link[0] = last
+            link[1] = self._root
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl:
+            expires = time.time() + ttl
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            last = self._root[0]
+            link = [last, self._root, key]
+            last[1] = self._root[0] = link
+            self._entries[key] = (link, value, expires)
+            self._pids.setdefault(key[1], set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(self._root[1][2])
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, pid):
+        """
+        Removes all entries of an object
+        """
+        self._lock.acquire()
+        try:
+            for key in list(self._pids.get(pid, ())):
+                self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._pids.clear()
+            self._root[:] = [self._root, self._root, None]
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+    def _remove(self, key):
+        link, value, expires = self._entries.pop(key)
+        previous, next, key = link
+        previous[1] = next
+        next[0] = previous
+        keys = self._pids.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._pids[key[1]]
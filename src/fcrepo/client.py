@@ -1,21 +1,392 @@
 # Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
 # See also LICENSE.txt
 
+import re
+import csv
+import copy
+import time
 import urllib
-from collections import defaultdict
+import hashlib
+import threading
+import Queue
+from StringIO import StringIO
+from collections import defaultdict, deque
 
 from lxml import etree
-from lxml.builder import ElementMaker
 
 from fcrepo.wadl import API
-from fcrepo.utils import NS
+from fcrepo.connection import ChecksumBody, ChecksumMismatchException
+from fcrepo.connection import CHECKSUM_ALGORITHMS
+from fcrepo.utils import NS, ntriples2dict, iter_lines
 from fcrepo.object import FedoraObject
+from fcrepo.foxml import FOXMLBuilder
+from fcrepo.workers import imap_unordered, Executor
+from fcrepo.cache import CachedResponse
 
-NSMAP = {'foxml': 'info:fedora/fedora-system:def/foxml#'}
+# the number of parsed search results of a prefetched page that wait to be
+# used, and the seconds between the checks of a blocked worker whether the
+# search stopped
+SEARCH_QUEUE_SIZE = 100
+POLL_INTERVAL = 0.5
 
-class FedoraClient(object):
-    def __init__(self, connection):
-        self.api = API(connection)
+# the number of changed objects of which the generation is remembered
+GENERATIONS = 10000
+
+# a LIMIT or OFFSET clause at the end of a SPARQL query
+QUERY_MODIFIER = re.compile(r'\s(LIMIT|OFFSET)\s+(\d+)\s*$', re.IGNORECASE)
+
+SEARCH_NS = 'http://www.fedora.info/definitions/1/0/types/'
+
+# search result fields and the object properties they map to
+SEARCH_FIELDS = {'label': 'label',
+                 'ownerId': 'ownerId',
+                 'state': 'state',
+                 'cDate': 'createdDate',
+                 'mDate': 'lastModifiedDate'}
+
+# elements of the profiles and the properties they map to, the xml data is
+# namespaced in 3.4, but not in 3.3, so the namespace is stripped out to be
+# compatible with both
+OBJECT_PROFILE_NAMES = {'objLabel': 'label',
+                        'objOwnerId': 'ownerId',
+                        'objCreateDate': 'createdDate',
+                        'objLastModDate': 'lastModifiedDate',
+                        'objState': 'state'}
+
+DATASTREAM_PROFILE_NAMES = {'dsLabel': 'label',
+                            'dsVersionID': 'versionId',
+                            'dsCreateDate': 'createdDate',
+                            'dsState': 'state',
+                            'dsMIME': 'mimeType',
+                            'dsFormatURI': 'formatURI',
+                            'dsControlGroup': 'controlGroup',
+                            'dsSize': 'size',
+                            'dsVersionable': 'versionable',
+                            'dsInfoType': 'infoType',
+                            'dsLocation': 'location',
+                            'dsLocationType': 'locationType',
+                            'dsChecksum': 'checksum',
+                            'dsChecksumType': 'checksumType'}
+
+SPARQL_NS = 'http://www.w3.org/2001/sw/DataAccess/rf1/result' # ouch, old!
+
+# The parsers of the responses, shared by FedoraClient and AsyncFedoraClient
+
+def parse_pids(xml):
+    doc = etree.fromstring(xml)
+    return [id.decode('utf8') for id in doc.xpath('/pidList/pid/text()')]
+
+def parse_profile(xml, names):
+    doc = etree.fromstring(xml)
+    result = {}
+    for child in doc:
+        # rename elementnames to match property names in foxml
+        name = names.get(child.tag.split('}')[-1])
+        if name is None or child.text is None:
+            continue
+        value = child.text
+        if not isinstance(value, unicode):
+            value = value.decode('utf8')
+        result[name] = value
+    return result
+
+def parse_object_profile(xml):
+    result = {'ownerId': u''}
+    result.update(parse_profile(xml, OBJECT_PROFILE_NAMES))
+    return result
+
+def parse_datastream_profile(xml):
+    return parse_profile(xml, DATASTREAM_PROFILE_NAMES)
+
+def parse_datastreams(xml):
+    """
+    Returns (dsid, profile) tuples, the profile has the label and mimeType
+    """
+    doc = etree.fromstring(xml)
+    result = []
+    for child in doc:
+        profile = {}
+        for name in ('label', 'mimeType'):
+            value = child.attrib.get(name)
+            if value is None:
+                continue
+            if not isinstance(value, unicode):
+                value = value.decode('utf8')
+            profile[name] = value
+        result.append((child.attrib['dsid'], profile))
+    return result
+
+def parse_object_methods(xml):
+    doc = etree.fromstring(xml)
+    method_list = []
+    for sdef_el in doc:
+        sdef = sdef_el.attrib['pid']
+        for method_el in sdef_el:
+            method = method_el.attrib['name']
+            method_list.append((sdef, method))
+    return method_list
+
+def parse_search_page(source):
+    """
+    Parses a page of search results while it is read from source. Yields
+    a ('token', token) tuple for the session token, which Fedora sends
+    before the results, and a ('fields', data) tuple for every result as
+    soon as it has been read.
+    """
+    token_tag = '{%s}token' % SEARCH_NS
+    fields_tag = '{%s}objectFields' % SEARCH_NS
+    for event, el in etree.iterparse(source, events=('end',)):
+        if el.tag == token_tag:
+            yield 'token', (el.text or '').decode('utf8')
+        elif el.tag == fields_tag:
+            data = defaultdict(list)
+            for child in el:
+                field_name = child.tag.split('}')[-1].decode('utf8')
+                value = child.text or u''
+                if not isinstance(value, unicode):
+                    value = value.decode('utf8')
+                data[field_name].append(value)
+            # free the parsed results
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+            yield 'fields', data
+
+def search_profile(data):
+    """
+    The object properties among the fields of a search result
+    """
+    profile = {}
+    for field, name in SEARCH_FIELDS.items():
+        if data.get(field):
+            profile[name] = data[field][0]
+    return profile
+
+def parse_sparql_results(source):
+    result_tag = '{%s}result' % SPARQL_NS
+    for event, result in etree.iterparse(source, events=('end',),
+                                         tag=result_tag):
+        data = {}
+        for el in result:
+            name = el.tag.split('}')[-1]
+            value = {}
+            uri = el.attrib.get('uri')
+            if uri:
+                value['value'] = uri.decode('utf8')
+                value['type'] = 'uri'
+            else:
+                value['type'] = 'literal'
+                if isinstance(el.text, unicode):
+                    value['value'] = el.text
+                elif el.text:
+                    value['value'] = el.text.decode('utf8')
+                else:
+                    value['value'] = u''
+                datatype = el.attrib.get('datatype')
+                lang = el.attrib.get('lang')
+                if datatype:
+                    value['datatype'] = datatype
+                elif lang:
+                    value['lang'] = lang
+            data[name] = value
+        # free the parsed results
+        result.clear()
+        while result.getprevious() is not None:
+            del result.getparent()[0]
+        yield data
+
+def parse_csv_results(source):
+    reader = csv.reader(iter_lines(source))
+    names = None
+    for row in reader:
+        if names is None:
+            names = row
+            continue
+        data = {}
+        for name, value in zip(names, row):
+            data[name] = {'value': value.decode('utf8')}
+        yield data
+
+def parse_tsv_results(source):
+    names = None
+    for line in iter_lines(source):
+        line = line.rstrip('\r\n')
+        if names is None:
+            names = [name.lstrip('?') for name in line.split('\t')]
+            continue
+        if not line:
+            continue
+        data = {}
+        for name, term in zip(names, line.split('\t')):
+            data[name] = ntriples2dict(term)
+        yield data
+
+# the parsers of the result formats of the resource index
+RESULT_PARSERS = {'sparql': parse_sparql_results,
+                  'csv': parse_csv_results,
+                  'tsv': parse_tsv_results}
+
+def risearch_request(query, lang, format, limit, type, dt, flush):
+    """
+    Returns the URL and headers of a resource index query
+    """
+    params = {'query': query,
+              'lang': lang,
+              'flush': str(flush).lower(),
+              'format': format,
+              'type': type,
+              'dt': dt}
+    if limit is not None:
+        params['limit'] = limit
+    for name, value in params.items():
+        if isinstance(value, unicode):
+            params[name] = value.encode('utf8')
+    url = u'/risearch?%s' % urllib.urlencode(params)
+    if format.lower() == 'sparql':
+        headers = {'Accept': 'text/xml'}
+    else:
+        headers = {'Accept': 'text/plain'}
+    return url, headers
+
+def split_query(query):
+    """
+    Splits the LIMIT and OFFSET clauses off the end of a SPARQL query,
+    returns the query and the limit and offset, which are None when the
+    query has none.
+    """
+    limit = offset = None
+    while True:
+        match = QUERY_MODIFIER.search(query)
+        if match is None:
+            break
+        if match.group(1).upper() == 'LIMIT':
+            limit = int(match.group(2))
+        else:
+            offset = int(match.group(2))
+        query = query[:match.start()]
+    return query, limit, offset
+
+def page_bounds(query, limit=None):
+    """
+    Returns the query without its LIMIT and OFFSET clauses, the number of
+    results to page through, None for all, and the offset of the first
+    """
+    query, query_limit, offset = split_query(query)
+    if query_limit is not None and (limit is None or query_limit < limit):
+        limit = query_limit
+    return query, limit, offset or 0
+
+def page_query(query, size, offset):
+    """
+    Returns a SPARQL query for a page of the results of query
+    """
+    return u'%s LIMIT %d OFFSET %d' % (query, size, offset)
+
+def fix_ds_params(params):
+    """
+    Renames the datastream properties to the params of the REST API
+    """
+    for name, param in params.items():
+        newname = {'label': 'dsLabel',
+                   'location': 'dsLocation',
+                   'state': 'dsState'}.get(name, name)
+        if newname != name:
+            params[newname] = param
+            del params[name]
+    return params
+
+def new_datastream(dsid, body, filename, params):
+    """
+    Returns the body and params of a new datastream, with the defaults
+    filled in
+    """
+    if dsid == 'RELS-EXT' and not body and filename is None:
+        body = ('<rdf:RDF xmlns:rdf="%s"/>' % NS.rdf)
+        params['mimeType'] = u'application/rdf+xml'
+        params['formatURI'] = (
+            u'info:fedora/fedora-system:FedoraRELSExt-1.0')
+
+    if params.get('controlGroup', u'X') == u'X':
+        if not 'mimeType' in params:
+            params['mimeType'] = u'text/xml'
+    if not 'mimeType' in params:
+        params['mimeType'] = u'application/binary'
+
+    if 'checksumType' not in params:
+        params['checksumType'] = u'MD5'
+    return body, fix_ds_params(params)
+
+class CachingClient(object):
+    """
+    Keeps the profiles and datastream lists in the cache of a client.
+
+    Every change of an object increases its generation. A read takes the
+    generation of the object before its request, and its result is only
+    stored when no change was made in the meantime, because that result
+    can be from before the change.
+    """
+    cache = None
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._generations = {}
+        # the generation of the objects of which it was forgotten
+        self._forgotten = 0
+        self._changes = 0
+        self._generation_lock = threading.Lock()
+
+    def _generation(self, pid):
+        return self._generations.get(pid, self._forgotten)
+
+    def _cached(self, key):
+        if self.cache is None:
+            return None
+        value = self.cache.get(key)
+        if value is not None:
+            # the objects change the profiles they are given
+            value = copy.deepcopy(value)
+        return value
+
+    def _store(self, key, value, generation, ttl=None):
+        """
+        Stores the value read for the pid in the key, unless the object
+        was changed after generation was taken
+        """
+        if self.cache is None:
+            return
+        value = copy.deepcopy(value)
+        self._generation_lock.acquire()
+        try:
+            if self._generation(key[1]) == generation:
+                self.cache.set(key, value, ttl)
+        finally:
+            self._generation_lock.release()
+
+    def _invalidate(self, pid):
+        if self.cache is None:
+            return
+        self._generation_lock.acquire()
+        try:
+            self._changes += 1
+            if len(self._generations) >= GENERATIONS:
+                # reads of the forgotten objects that are in flight are
+                # not stored
+                self._generations.clear()
+                self._forgotten = self._changes
+            self._generations[pid] = self._changes
+            self.cache.invalidate(pid)
+        finally:
+            self._generation_lock.release()
+
+class FedoraClient(CachingClient):
+    def __init__(self, connection, wadl_cache=None, cache=None):
+        """
+        A cache, like an ObjectCache, keeps the profiles and datastream
+        lists of objects. The entries of an object are invalidated when
+        it is changed through this client.
+        """
+        CachingClient.__init__(self, cache)
+        self.api = API(connection, wadl_cache)
 
     def getNextPID(self, namespace, numPIDs=1, format=u'text/xml'):
         request = self.api.getNextPID()
@@ -24,168 +395,298 @@ class FedoraClient(object):
                                   format=format)
         xml = response.read()
         response.close()
-        doc = etree.fromstring(xml)
-        ids = [id.decode('utf8') for id in doc.xpath('/pidList/pid/text()')]
+        ids = parse_pids(xml)
         if len(ids) == 1:
             return ids[0]
         return ids
         
     def createObject(self, pid, label, state=u'A'):
-        foxml = ElementMaker(namespace=NSMAP['foxml'], nsmap=NSMAP)
-        foxml_state = {'A': u'Active',
-                       'I': u'Inactive',
-                       'D': u'Deleted'}[state]
-        doc = foxml.digitalObject(
-            foxml.objectProperties(
-              foxml.property(NAME="info:fedora/fedora-system:def/model#state",
-                             VALUE=state),
-              foxml.property(NAME="info:fedora/fedora-system:def/model#label",
-                             VALUE=label)
-              ),
-            VERSION='1.1', PID=pid)
-        body = etree.tostring(doc, encoding="UTF-8", xml_declaration=False)
-        
-        request = self.api.createObject(pid=pid)
+        return self.ingest(FOXMLBuilder(pid, label, state))
+
+    def ingest(self, foxml):
+        """
+        Creates an object with its datastreams from a FOXMLBuilder in a
+        single request. The returned object knows the properties and
+        datastreams from the document, so they are not fetched again.
+        """
+        request = self.api.createObject(pid=foxml.pid)
         request.headers['Content-Type'] = 'text/xml; charset=utf-8'
-        response = request.submit(body, state=state[0], label=label)
-        return self.getObject(pid)
+        try:
+            response = request.submit(foxml.tostring(), state=foxml.state[0],
+                                      label=foxml.label)
+        finally:
+            self._invalidate(foxml.pid)
+        response.read()
+        response.close()
+        obj = self.getObject(foxml.pid, foxml.profile())
+        foxml.seed(obj)
+        return obj
     
-    def getObject(self, pid):
-        return FedoraObject(pid, self)
+    def getObject(self, pid, profile=None):
+        """
+        The object profile is only fetched when it's needed, a profile
+        with already known properties can be passed to avoid that.
+        """
+        return FedoraObject(pid, self, profile)
+
+    def getObjects(self, pids, workers=4, datastreams=()):
+        """
+        Fetch many objects concurrently, including their list of
+        datastreams and the profiles of the given datastream ids.
+
+        Yields (pid, object, error) tuples as soon as an object is
+        complete, error is the exception raised while fetching it or None.
+        Only a few pids are taken from pids at a time, so it can be any
+        (large) iterable.
+
+        Concurrent requests need a connection with a pool, otherwise the
+        objects are fetched one by one.
+        """
+        if self.api.connection.pool is None:
+            workers = 1
+
+        def fetch(pid):
+            obj = self.getObject(pid)
+            obj._load()
+            dsids = obj.datastreams()
+            for dsid in datastreams:
+                if dsid in dsids:
+                    obj[dsid]._load()
+            return obj
+
+        return imap_unordered(fetch, pids, workers)
 
     def getObjectProfile(self, pid):
+        result = self._cached(('profile', pid))
+        if result is not None:
+            return result
+        generation = self._generation(pid)
         request = self.api.getObjectProfile(pid=pid)
         response = request.submit(format=u'text/xml')
         xml = response.read()
         response.close()
-        doc = etree.fromstring(xml)
-        result = {'ownerId': u''}
-        for child in doc:
-            # rename elementnames to match property names in foxml
-            # the xml data is namespaced in 3.4, but not in 3.3, so strip out
-            # the namespace, to be compatible with both
-            name = {'objLabel': 'label',
-                    'objOwnerId': 'ownerId',
-                    'objCreateDate': 'createdDate',
-                    'objLastModDate': 'lastModifiedDate',
-                    'objState': 'state'}.get(child.tag.split('}')[-1])
-            if name is None or child.text is None:
-                continue
-            value = child.text
-            if not isinstance(value, unicode):
-                value = value.decode('utf8')
-            result[name] = value
+        result = parse_object_profile(xml)
+        self._store(('profile', pid), result, generation)
         return result
 
     def updateObject(self, pid, body='', **params):
         request = self.api.updateObject(pid=pid)
-        response = request.submit(body, **params)
+        try:
+            response = request.submit(body, **params)
+        finally:
+            self._invalidate(pid)
+        response.read()
+        response.close()
 
     def deleteObject(self, pid, **params):
         request = self.api.deleteObject(pid=pid)
-        response = request.submit(**params)
+        try:
+            response = request.submit(**params)
+        finally:
+            self._invalidate(pid)
+        response.read()
+        response.close()
         
-    def listDatastreams(self, pid):
+    def listDatastreams(self, pid, profiles=False):
+        """
+        Returns the datastream ids of an object, or with profiles
+        a list of (dsid, profile) tuples where the profile contains the
+        label and mimeType of the datastream.
+        """
+        result = self._cached(('datastreams', pid))
+        if result is None:
+            generation = self._generation(pid)
+            result = self._listDatastreams(pid)
+            self._store(('datastreams', pid), result, generation)
+        if not profiles:
+            return [dsid for dsid, profile in result]
+        return result
+
+    def _listDatastreams(self, pid):
         request = self.api.listDatastreams(pid=pid)
         response = request.submit(format=u'text/xml')
         xml = response.read()
         response.close()
-        doc = etree.fromstring(xml)
-        return [child.attrib['dsid'] for child in doc]
-
-    def addDatastream(self, pid, dsid, body='', **params):
-        if dsid == 'RELS-EXT' and not body:
-            body = ('<rdf:RDF xmlns:rdf="%s"/>' % NS.rdf)
-            params['mimeType'] = u'application/rdf+xml'
-            params['formatURI'] = (
-                u'info:fedora/fedora-system:FedoraRELSExt-1.0')
-
-        if params.get('controlGroup', u'X') == u'X':
-            if not 'mimeType' in params:
-                params['mimeType'] = u'text/xml'
-        if not 'mimeType' in params:
-            params['mimeType'] = u'application/binary'
-            
-        if 'checksumType' not in params:
-            params['checksumType'] = u'MD5'
+        return parse_datastreams(xml)
 
-        params = self._fix_ds_params(params)
+    def addDatastream(self, pid, dsid, body='', filename=None, **params):
+        """
+        The body can be a string, a file-like object or an iterable of
+        strings. Alternatively pass the filename of the content, which is
+        streamed from disk.
 
+        For managed content the checksum is computed while the content is
+        sent, and verified by Fedora.
+        """
+        body, params = new_datastream(dsid, body, filename, params)
         request = self.api.addDatastream(pid=pid, dsID=dsid)
         request.headers['Content-Type'] = params['mimeType']
-        response = request.submit(body, **params)        
-
-    def _fix_ds_params(self, params):
-        for name, param in params.items():
-            newname = {'label': 'dsLabel',
-                       'location': 'dsLocation',
-                       'state': 'dsState'}.get(name, name)
-            if newname != name:
-                params[newname] = param
-                del params[name]
-                
-        return params
-        
+        # inline XML is normalized by Fedora, so only the checksum of
+        # managed content can be computed locally
+        verify = params.get('controlGroup') == u'M'
+        self._submit_content(request, pid, dsid, body, filename, params,
+                             verify)
+
+    def _submit_content(self, request, pid, dsid, body, filename, params,
+                        verify):
+        algorithm = None
+        if verify:
+            algorithm = CHECKSUM_ALGORITHMS.get(params.get('checksumType'))
+        if filename is not None:
+            fp = body = open(filename, 'rb')
+        try:
+            if algorithm is not None and body:
+                if isinstance(body, str):
+                    # Fedora refuses the content if the checksum differs
+                    params.setdefault('checksum', unicode(
+                        hashlib.new(algorithm, body).hexdigest()))
+                else:
+                    body = ChecksumBody(body, algorithm,
+                                        self.api.connection.blocksize)
+            response = request.submit(body, **params)
+        finally:
+            self._invalidate(pid)
+            if filename is not None:
+                fp.close()
+        response.read()
+        response.close()
+
+        if isinstance(body, ChecksumBody):
+            # the checksum can only be sent after the content, so compare
+            # with the one Fedora computed instead
+            profile = self.getDatastreamProfile(pid, dsid)
+            if profile.get('checksum') != body.hexdigest():
+                raise ChecksumMismatchException(profile.get('checksum'),
+                                                body.hexdigest())
+
     def getDatastreamProfile(self, pid, dsid):
+        result = self._cached(('dsprofile', pid, dsid))
+        if result is not None:
+            return result
+        generation = self._generation(pid)
         request = self.api.getDatastreamProfile(pid=pid, dsID=dsid)
         response = request.submit(format=u'text/xml')
         xml = response.read()
         response.close()
-        doc = etree.fromstring(xml)
-        result = {}
-        for child in doc:
-            # rename elementnames to match property names in foxml
-            # the xml data is namespaced in 3.4, but not in 3.3, so strip out
-            # the namespace, to be compatible with both
-            name = {'dsLabel': 'label',
-                    'dsVerionId': 'versionId',
-                    'dsCreateDate': 'createdDate',
-                    'dsState': 'state',
-                    'dsMIME': 'mimeType',
-                    'dsFormatURI': 'formatURI',
-                    'dsControlGroup': 'controlGroup',
-                    'dsSize': 'size',
-                    'dsVersionable': 'versionable',
-                    'dsInfoType': 'infoType',
-                    'dsLocation': 'location',
-                    'dsLocationType': 'locationType',
-                    'dsChecksum': 'checksum',
-                    'dsChecksumType': 'checksumType'}.get(child.tag.split('}')[-1])
-            if name is None or child.text is None:
-                continue
-            value = child.text
-            if not isinstance(value, unicode):
-                value = value.decode('utf8')
-            result[name] = value
+        result = parse_datastream_profile(xml)
+        self._store(('dsprofile', pid, dsid), result, generation)
         return result
 
-    def modifyDatastream(self, pid, dsid, body='', **params):
-        params = self._fix_ds_params(params)
+    def modifyDatastream(self, pid, dsid, body='', filename=None,
+                         controlGroup=None, **params):
+        """
+        When a checksumType is given for managed content, the checksum is
+        computed while the content is sent and verified by Fedora. Pass
+        the controlGroup of the datastream when it is known, otherwise it
+        is looked up in the datastream profile.
+        """
+        params = fix_ds_params(params)
+        verify = False
+        if 'checksumType' in params and (body or filename is not None):
+            # like in addDatastream, inline XML is normalized by Fedora
+            if controlGroup is None:
+                profile = self.getDatastreamProfile(pid, dsid)
+                controlGroup = profile.get('controlGroup')
+            verify = controlGroup == u'M'
         request = self.api.modifyDatastream(pid=pid, dsID=dsid)
-        response = request.submit(body, **params)
+        self._submit_content(request, pid, dsid, body, filename, params,
+                             verify)
         
-    def getDatastream(self, pid, dsid):
+    def getDatastream(self, pid, dsid, start=None, end=None):
+        """
+        Returns the response with the content of the datastream. When a
+        start and/or (inclusive) end offset is given only that byte range
+        is requested, check for a 206 status to see if the server honored it.
+
+        With a cache, the content of the datastreams listed in its
+        `contents` is served from the cache until its ttl has passed.
+        Content up to `maxcontent` bytes of the other datastreams is
+        cached as well, but revalidated with a conditional request on
+        every read. Content is only revalidated with its ETag or the
+        checksum of a cached datastream profile, otherwise it is fetched
+        again.
+        """
         request = self.api.getDatastream(pid=pid, dsID=dsid)
+        if start is not None or end is not None:
+            if end is None:
+                end = ''
+            request.headers['Range'] = 'bytes=%s-%s' % (start or 0, end)
+        elif self.cache is not None:
+            return self._getCachedDatastream(request, pid, dsid)
         return request.submit()
 
+    def _getCachedDatastream(self, request, pid, dsid):
+        key = ('content', pid, dsid)
+        small = dsid in getattr(self.cache, 'contents', ())
+        ttl = getattr(self.cache, 'ttl', None)
+        generation = self._generation(pid)
+        entry = self._cached(key)
+        if entry is not None:
+            if small and (not ttl or time.time() - entry['fetched'] < ttl):
+                return CachedResponse(entry['content'])
+            request.headers.update(entry['validators'])
+
+        response = request.submit()
+        if response.status == 304:
+            response.read()
+            response.close()
+            entry['fetched'] = time.time()
+            self._store(key, entry, generation, 0)
+            return CachedResponse(entry['content'])
+
+        length = response.getheader('content-length')
+        if not small and (length is None or
+                          int(length) > getattr(self.cache, 'maxcontent', 0)):
+            return response
+        content = response.read()
+        response.close()
+        validators = self._validators(response, pid, dsid, content)
+        if validators is not None or small:
+            # the entry does not expire, it is revalidated, or fetched
+            # again after the ttl when it can not be
+            self._store(key, {'content': content,
+                              'validators': validators or {},
+                              'fetched': time.time()}, generation, 0)
+        return CachedResponse(content)
+
+    def _validators(self, response, pid, dsid, content):
+        """
+        Returns the headers to revalidate content with, from the ETag of
+        the response or else the checksum of the datastream profile when
+        it is cached. None when the content can not be revalidated; dates
+        have whole seconds, so a change in the same second would be missed.
+        """
+        etag = response.getheader('etag')
+        if etag:
+            return {'If-None-Match': etag}
+        # the profile is not fetched for this, that would be another
+        # request for every content that is cached
+        profile = self._cached(('dsprofile', pid, dsid)) or {}
+        checksum = profile.get('checksum')
+        algorithm = CHECKSUM_ALGORITHMS.get(profile.get('checksumType'))
+        if not checksum or algorithm is None:
+            return None
+        if hashlib.new(algorithm, content).hexdigest() != checksum:
+            # the datastream changed after the profile was read
+            return None
+        return {'If-None-Match': '"%s"' % checksum}
+
     def deleteDatastream(self, pid, dsid, **params):
         request = self.api.deleteDatastream(pid=pid, dsID=dsid)
-        return request.submit(**params)
+        try:
+            response = request.submit(**params)
+        finally:
+            self._invalidate(pid)
+        response.read()
+        response.close()
 
     def getAllObjectMethods(self, pid, **params):
         params['format'] = u'text/xml'
         request = self.api.getAllObjectMethods(pid=pid)
         response = request.submit(**params)
         xml = response.read()
-        doc = etree.fromstring(xml)
-        method_list = []
-        for sdef_el in doc:
-            sdef = sdef_el.attrib['pid']
-            for method_el in sdef_el:
-                method = method_el.attrib['name']
-                method_list.append((sdef, method))
         response.close()
-        return method_list
+        return parse_object_methods(xml)
 
     def invokeSDefMethodUsingGET(self, pid, sdef, method, **params):
         request = self.api.invokeSDefMethodUsingGET(pid=pid, sDef=sdef,
@@ -193,101 +694,230 @@ class FedoraClient(object):
         return request.submit(**params)
 
         
-    def searchObjects(self, query, fields, terms=False, maxResults=10):
+    def searchObjects(self, query, fields, terms=False, maxResults=10,
+                      objects=False, prefetch=0):
+        """
+        Yields a dict of lists of field values for every result. With
+        objects, FedoraObjects are yielded instead, the object properties
+        among the fields are used, so the object profile does not have to
+        be fetched. The pid field is always needed in this case.
+
+        With prefetch, up to that number of following result pages are
+        requested in the background as soon as their session token is
+        known, while the results of the current page are used. Results
+        are handed over as soon as they are parsed. This needs a
+        connection with a pool.
+        """
         field_params = {}
         assert isinstance(fields, list)
         for field in fields:
             field_params[field] = u'true'
             
-        token = True
-        NS = 'http://www.fedora.info/definitions/1/0/types/'
-        while token:
-            if token is True:
-                token = False
-            request = self.api.searchObjects()
-            request.undocumented_params = field_params
+        params = {'maxResults': maxResults,
+                  'resultFormat': u'text/xml'}
+        if terms:
+            params['terms'] = query
+        else:
+            params['query'] = query
 
+        # the request is not changed by submitting it, so every page
+        # can be fetched with it, also by concurrent threads
+        request = self.api.searchObjects()
+        request.undocumented_params = field_params
+
+        def fetch_page(token):
+            page_params = dict(params)
             if token:
-                if terms:
-                    response = request.submit(terms=query,
-                                              sessionToken=token,
-                                              maxResults=maxResults,
-                                              resultFormat=u'text/xml')
-                else:
-                    response = request.submit(query=query,
-                                              sessionToken=token,
-                                              maxResults=maxResults,
-                                              resultFormat=u'text/xml')
+                page_params['sessionToken'] = token
+            return request.submit(**page_params)
+
+        if prefetch and self.api.connection.pool is not None:
+            results = self._prefetch_search_pages(fetch_page, prefetch)
+        else:
+            results = self._search_pages(fetch_page)
+        for data in results:
+            if objects:
+                yield self._search_object(data)
             else:
-                if terms:
-                    response = request.submit(terms=query,
-                                              maxResults=maxResults,
-                                              resultFormat=u'text/xml')
+                yield data
+
+    def _search_pages(self, fetch_page):
+        token = None
+        while True:
+            response = fetch_page(token)
+            token = None
+            for kind, value in self._parse_search_page(response):
+                if kind == 'token':
+                    token = value
                 else:
-                    response = request.submit(query=query,
-                                              maxResults=maxResults,
-                                              resultFormat=u'text/xml')
+                    yield value
+            if not token:
+                break
 
-            xml = response.read()
-            response.close()
-            doc = etree.fromstring(xml)
-                
-            tokens = doc.xpath('//f:token/text()', namespaces={'f': NS})
-            if tokens:
-                token = tokens[0].decode('utf8')
+    def _prefetch_search_pages(self, fetch_page, prefetch):
+        # one more worker for the page that is being used
+        executor = Executor(prefetch + 1)
+        lock = threading.Lock()
+        # the queues of the results of the pages that are requested but
+        # not used yet, the results are put in them while they are parsed
+        pages = deque()
+        # the token of a page that could not be requested yet
+        waiting = []
+        # set when the consumer stops, a worker blocked on a full queue
+        # stops within the polling interval
+        stopped = threading.Event()
+
+        def put(results, item):
+            while not stopped.isSet():
+                try:
+                    results.put(item, timeout=POLL_INTERVAL)
+                except Queue.Full:
+                    continue
+                return True
+            return False
+
+        def request(token):
+            # called with the lock held
+            results = Queue.Queue(SEARCH_QUEUE_SIZE)
+            pages.append(results)
+            executor.submit(fetch, token, results)
+
+        def fetch(token, results):
+            try:
+                for kind, value in self._parse_search_page(fetch_page(token)):
+                    if kind != 'token':
+                        if not put(results, ('result', value)):
+                            return
+                        continue
+                    lock.acquire()
+                    try:
+                        if len(pages) < prefetch:
+                            request(value)
+                        else:
+                            waiting.append(value)
+                    finally:
+                        lock.release()
+            except Exception, e:
+                put(results, ('error', e))
             else:
-                token = False
-            
-            for result in doc.xpath('//f:objectFields', namespaces={'f': NS}):
-                data = defaultdict(list)
-
-                for child in result:
-                    field_name = child.tag.split('}')[-1].decode('utf8')
-                    value = child.text or u''
-                    if not isinstance(value, unicode):
-                        value = value.decode('utf8')
-                    data[field_name].append(value)
-                yield data
+                put(results, ('end', None))
+
+        lock.acquire()
+        try:
+            request(None)
+        finally:
+            lock.release()
+        try:
+            while True:
+                lock.acquire()
+                try:
+                    if not pages:
+                        # the tokens of all used pages have been seen
+                        break
+                    results = pages.popleft()
+                    if waiting:
+                        request(waiting.pop())
+                finally:
+                    lock.release()
+                while True:
+                    kind, value = results.get()
+                    if kind == 'end':
+                        break
+                    if kind == 'error':
+                        raise value
+                    yield value
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False)
+
+    def _parse_search_page(self, response):
+        source = self._response_source(response)
+        try:
+            for item in parse_search_page(source):
+                yield item
+        finally:
+            response.close()
+
+    def _search_object(self, data):
+        return self.getObject(data['pid'][0], search_profile(data))
 
-                
     def searchTriples(self, query, lang='sparql', format='Sparql',
-                      limit=100, type='tuples', dt='on', flush=True):
-        flush = str(flush).lower()
-        url = u'/risearch?%s' % urllib.urlencode({'query':query,
-                                                  'lang':lang,
-                                                  'flush': flush,
-                                                  'format':format,
-                                                  'limit':limit,
-                                                  'type':type,
-                                                  'dt':dt})
-        headers = {'Accept:': 'text/xml'}
-        response = self.api.connection.open(url, '', headers, method='POST')
-        xml = response.read()
-        doc = etree.fromstring(xml)
-        NS = 'http://www.w3.org/2001/sw/DataAccess/rf1/result' # ouch, old!
-        for result in doc.xpath('//sparql:result', namespaces={'sparql': NS}):
-            data = {}
-            for el in result:
-                name = el.tag.split('}')[-1]
-                value = {}
-                uri = el.attrib.get('uri')
-                if uri:
-                    value['value'] = uri.decode('utf8')
-                    value['type'] = 'uri'
-                else:
-                    value['type'] = 'literal'
-                    if isinstance(el.text, unicode):
-                        value['value'] = el.text
-                    elif el.text:
-                        value['value'] = el.text.decode('utf8')
-                    else:
-                        value['value'] = u''
-                    datatype = el.attrib.get('datatype')
-                    lang = el.attrib.get('lang')
-                    if datatype:
-                        value['datatype'] = datatype
-                    elif lang:
-                        value['lang'] = lang
-                data[name] = value
-            yield data
-        
+                      limit=None, type='tuples', dt='on', flush=True,
+                      pagesize=None):
+        """
+        Yields a dict for every result of a resource index query, mapping
+        the names of the variables to dicts with the value. The results
+        are parsed while they are read. The format can be `Sparql`, or
+        `TSV` or `CSV`, which are parsed faster. CSV results do not tell
+        the type of the values, so their dicts only contain the value.
+
+        With a pagesize, the results are fetched in pages with LIMIT and
+        OFFSET added to a SPARQL query, to walk large result sets. The
+        query should have an ORDER BY clause to get a stable order. A
+        LIMIT or OFFSET at the end of the query is kept, the pages are
+        taken from the results it selects.
+        """
+        parse = RESULT_PARSERS.get(format.lower())
+        if parse is None:
+            raise ValueError('Unsupported result format: %s' % format)
+        if not pagesize:
+            response = self._risearch(query, lang, format, limit, type, dt,
+                                      flush)
+            for data in self._parse_results(parse, response):
+                yield data
+            return
+
+        if lang.lower() != 'sparql':
+            raise ValueError('Paging is only supported for SPARQL queries')
+        query, limit, start = page_bounds(query, limit)
+        offset = 0
+        while limit is None or offset < limit:
+            size = pagesize
+            if limit is not None:
+                size = min(size, limit - offset)
+            response = self._risearch(page_query(query, size, start + offset),
+                                      lang, format, None, type, dt, flush)
+            count = 0
+            for data in self._parse_results(parse, response):
+                count += 1
+                yield data
+            if count < size:
+                break
+            offset += count
+            # the index only has to be flushed for the first page
+            flush = False
+
+    def countTriples(self, query, lang='sparql', type='tuples', flush=True):
+        """
+        Returns the number of results of a resource index query
+        """
+        response = self._risearch(query, lang, 'count', None, type, 'on',
+                                  flush)
+        count = response.read()
+        response.close()
+        return int(count.strip())
+
+    def _risearch(self, query, lang, format, limit, type, dt, flush):
+        url, headers = risearch_request(query, lang, format, limit, type, dt,
+                                        flush)
+        return self.api.connection.open(url, '', headers, method='POST')
+
+    def _response_source(self, response):
+        """
+        Returns something to parse the response from while it is read.
+        """
+        if self.api.connection.pool is None:
+            # a response left unread blocks the single connection, while
+            # the results are used other requests could be made
+            source = StringIO(response.read())
+            response.close()
+            return source
+        return response
+
+    def _parse_results(self, parse, response):
+        source = self._response_source(response)
+        try:
+            for data in parse(source):
+                yield data
+        finally:
+            response.close()
@@ -1,10 +1,51 @@
 # Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
 # See also LICENSE.txt
+import os
+import zlib
+import random
+import select
+import hashlib
 import StringIO
 import socket
 import httplib
 import urlparse
 import logging
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
+
+BLOCKSIZE = 64 * 1024
+
+# Fedora checksum types and the matching hashlib algorithms
+CHECKSUM_ALGORITHMS = {'MD5': 'md5',
+                       'SHA-1': 'sha1',
+                       'SHA-256': 'sha256',
+                       'SHA-384': 'sha384',
+                       'SHA-512': 'sha512'}
+
+# request headers that make a 304 Not Modified response possible
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since')
+
+# the content codings a connection with compression accepts
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# media types of request bodies that are worth compressing
+COMPRESSIBLE_TYPES = ('text/', 'application/xml', 'application/rdf+xml')
+
+# HTTP methods of which a request can safely be sent again
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# WADL methods of which the idempotency differs from their HTTP method,
+# a getNextPID that is sent again only skips some PIDs
+WADL_IDEMPOTENCY = {'getNextPID': True}
+
+CONNECTION_ERRORS = (socket.error,
+                     httplib.ImproperConnectionState,
+                     # BadStatusLine is included as it is spurious and may
+                     # randomly happen on an otherwise fine connection
+                     # (though not often)
+                     httplib.BadStatusLine)
 
 class APIException(Exception):
     """ An exception in the general usage of the API """
@@ -26,6 +67,523 @@ class FedoraConnectionException(Exception):
         return repr(self)
 
 
+class CircuitOpenException(APIException):
+    """ A request was refused because the circuit breaker is open """
+    pass
+
+class ChecksumMismatchException(APIException):
+    """
+    The checksum computed locally differs from the one in Fedora, which
+    is the expected checksum, the local one is the actual checksum
+    """
+    def __init__(self, expected, actual):
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return 'Checksum mismatch, expected %s, got %s' % (self.expected,
+                                                          self.actual)
+
+
+class TimedHTTPConnection(httplib.HTTPConnection):
+    """
+    A HTTPConnection which measures how long resolving the host name and
+    connecting take, the times are kept until the next request.
+    """
+    dns_time = None
+    connect_time = None
+
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        # HTTPConnection.connect creates the socket with this function,
+        # Python 2.6 does not have it and nothing is timed
+        self._create_connection = self._timed_create_connection
+
+    def _timed_create_connection(self, address,
+                                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                                 source_address=None):
+        # like socket.create_connection, which is given the resolved
+        # addresses so resolving is timed on its own
+        host, port = address
+        started = time.time()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+        error = socket.error('getaddrinfo returns an empty list')
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            try:
+                sock = socket.create_connection(sockaddr[:2], timeout,
+                                                source_address)
+            except socket.error, error:
+                continue
+            self.dns_time = resolved - started
+            self.connect_time = time.time() - resolved
+            return sock
+        raise error
+
+class RequestInfo(object):
+    """
+    What is known about a request, passed to the hooks of a Connection.
+    The times are in seconds and those of the network are of the last
+    attempt: dns and connect are None when an open connection was used,
+    ttfb is the time from sending until the response headers were read
+    and total the time until the response was read or closed. The time
+    spent before that, waiting in the hooks and for a pooled connection,
+    is in wait and the time between retries is in backoff.
+    """
+    def __init__(self, method, url, method_id=None, template=None,
+                 hooks=()):
+        self.method = method
+        self.url = url
+        self.method_id = method_id
+        self.template = template
+        self.status = None
+        self.error = None
+        self.attempts = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.dns = None
+        self.connect = None
+        self.ttfb = None
+        self.total = None
+        self.wait = 0.0
+        self.backoff = 0.0
+        self.started = time.time()
+        # when the last attempt was started, its response headers were
+        # read and the request was finished
+        self.sent_at = None
+        self.responded = None
+        self.finished = None
+        # whether the response was handed to the caller
+        self.handed_over = False
+        self._hooks = []
+        for hook in hooks:
+            try:
+                hook.before_request(self)
+            except Exception, e:
+                # the hooks that were called already see the request fail
+                self.finish(e)
+                raise
+            self._hooks.append(hook)
+        self.wait = time.time() - self.started
+
+    def sending(self, checkout=0.0):
+        # called when an attempt starts, after waiting checkout seconds
+        # for a connection
+        self.wait += checkout
+        self.sent_at = time.time()
+        self.responded = None
+        self.dns = self.connect = None
+
+    def sent(self, conn, length):
+        # called when a request was sent on conn
+        self.attempts += 1
+        self.bytes_sent += length
+        if conn.connect_time is not None:
+            self.dns = conn.dns_time
+            self.connect = conn.connect_time
+            conn.dns_time = conn.connect_time = None
+
+    def received(self, status):
+        self.status = status
+        self.responded = time.time()
+        self.ttfb = self.responded - self.sent_at
+
+    def hand_over(self):
+        # called when the response is returned, with its body still to
+        # be read; hooks with an after_response method are called, they
+        # do not have to wait for the caller to read it
+        self.handed_over = True
+        for hook in self._hooks:
+            if not hasattr(hook, 'after_response'):
+                continue
+            try:
+                hook.after_response(self)
+            except Exception:
+                logging.exception('Got an Exception in a request hook')
+
+    def finish(self, error=None):
+        if self.total is not None:
+            return
+        self.error = error
+        self.finished = time.time()
+        self.total = self.finished - (self.sent_at or self.started)
+        for hook in self._hooks:
+            try:
+                hook.after_request(self)
+            except Exception:
+                logging.exception('Got an Exception in a request hook')
+
+class RetryBudget(object):
+    """
+    Limits the retries to a ratio of the requests within a sliding window
+    of seconds, so retries do not multiply the load on a server that is
+    failing already. A minimum number of retries within the window is
+    always allowed. A budget can be shared by several connections.
+    """
+    def __init__(self, ratio=0.2, minimum=10, window=10.0):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        for times in (self._requests, self._retries):
+            while times and times[0] < now - self.window:
+                times.popleft()
+
+    def request(self):
+        """ Records a request """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._expire(now)
+            self._requests.append(now)
+        finally:
+            self._lock.release()
+
+    def withdraw(self):
+        """
+        Records a retry and returns True when the budget allows it
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._expire(now)
+            retries = len(self._retries)
+            if (retries >= self.minimum and
+                retries >= self.ratio * len(self._requests)):
+                return False
+            self._retries.append(now)
+            return True
+        finally:
+            self._lock.release()
+
+class RetryPolicy(object):
+    """
+    Decides which failed requests a Connection sends again, and how long
+    it waits before it does. Connection errors are retried, and responses
+    with one of the retryable statuses, for which the Retry-After header
+    of the response is honoured.
+
+    Only idempotent requests are retried, unless the request was never
+    sent. Kept-alive connections which the server closed while they were
+    idle are detected before they are used.
+    """
+    def __init__(self, retries=3, backoff=0.1, maxbackoff=10.0, jitter=True,
+                 statuses=(502, 503, 504), budget=None, idempotency=None):
+        """
+         retries -- The maximum number of retries of a request.
+
+         backoff -- The delay in seconds before the first retry, which
+                doubles with every retry up to maxbackoff. A Retry-After
+                of more than maxbackoff seconds is not waited for.
+
+         jitter -- Randomize the delays over the whole range up to the
+                backoff, so clients do not retry in lockstep.
+
+         budget -- A RetryBudget, by default the retries are limited to
+                20% of the requests.
+
+         idempotency -- A dict of WADL method ids and whether requests of
+                the method can be retried, overriding the HTTP method.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.jitter = jitter
+        self.statuses = statuses
+        if budget is None:
+            budget = RetryBudget()
+        self.budget = budget
+        self.idempotency = dict(WADL_IDEMPOTENCY)
+        self.idempotency.update(idempotency or {})
+
+    def idempotent(self, method, method_id=None):
+        if method_id in self.idempotency:
+            return self.idempotency[method_id]
+        return method.upper() in IDEMPOTENT_METHODS
+
+    def retry(self, attempt, idempotent, status=None):
+        """
+        Whether to retry after a connection error, or a response with the
+        given status. attempt is the number of retries so far.
+        """
+        if attempt >= self.retries or not idempotent:
+            return False
+        if status is not None and status not in self.statuses:
+            return False
+        return self.budget.withdraw()
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns the seconds to wait before a retry, or None when the
+        Retry-After header asks for longer than maxbackoff.
+        """
+        delay = min(self.backoff * 2 ** attempt, self.maxbackoff)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        if retry_after is not None:
+            seconds = parse_retry_after(retry_after)
+            if seconds is not None:
+                if seconds > self.maxbackoff:
+                    return None
+                delay = max(delay, seconds)
+        return delay
+
+def parse_retry_after(value):
+    """
+    Returns the seconds of a Retry-After header, which is a number of
+    seconds or a HTTP date, or None
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(mktime_tz(date) - time.time(), 0)
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of persistent HTTP connections, keyed by host.
+    """
+    def __init__(self, maxsize=10, idle_timeout=60, timeout=None):
+        """
+         maxsize -- Hard cap on the number of open connections,
+                idle or in use.
+
+         idle_timeout -- Idle connections older than this number of
+                seconds are closed.
+
+         timeout -- Number of seconds to wait for a free connection
+                when the pool is exhausted, None waits forever.
+        """
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.size = 0
+        # the number of connections that broke or were left unusable
+        self.discarded = 0
+        self._idle = {}
+        self._lock = threading.Condition()
+
+    def checkout(self, host):
+        self._lock.acquire()
+        try:
+            deadline = None
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while True:
+                self._reap()
+                idle = self._idle.get(host)
+                if idle:
+                    conn = idle.pop()[0]
+                    if not is_dropped(conn):
+                        return conn
+                    conn.close()
+                    self.size -= 1
+                    continue
+                if self.size < self.maxsize:
+                    self.size += 1
+                    break
+                if self._discard_idle():
+                    # made room by closing a connection to another host
+                    continue
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise APIException(
+                            'No free connection in pool after %s seconds' % (
+                            self.timeout))
+                    self._lock.wait(remaining)
+        finally:
+            self._lock.release()
+        return TimedHTTPConnection(host)
+
+    def checkin(self, host, conn):
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(host, []).append((conn, time.time()))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def discard(self, conn):
+        # the connection is broken or was left in an unknown state
+        conn.close()
+        self._lock.acquire()
+        try:
+            self.size -= 1
+            self.discarded += 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for conn, last_used in idle:
+                    conn.close()
+                    self.size -= 1
+            self._idle = {}
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+    def _reap(self):
+        # called with the lock held
+        expired = time.time() - self.idle_timeout
+        for host, idle in self._idle.items():
+            # connections are appended on checkin, so the oldest come first
+            while idle and idle[0][1] < expired:
+                idle.pop(0)[0].close()
+                self.size -= 1
+            if not idle:
+                del self._idle[host]
+
+    def _discard_idle(self):
+        # called with the lock held
+        for host, idle in self._idle.items():
+            if idle:
+                idle.pop(0)[0].close()
+                self.size -= 1
+                return True
+        return False
+
+
+class DeflateDecoder(object):
+    """
+    Decodes the deflate content coding, which is zlib data, but some
+    servers send raw deflate data without the zlib header.
+    """
+    def __init__(self):
+        self._first = True
+        self._data = ''
+        self._obj = zlib.decompressobj()
+
+    def decompress(self, data):
+        if not self._first:
+            return self._obj.decompress(data)
+        # kept to decode it again as raw deflate data
+        self._data += data
+        try:
+            decoded = self._obj.decompress(data)
+        except zlib.error:
+            self._first = False
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._obj.decompress(self._data)
+        if decoded:
+            self._first = False
+            self._data = ''
+        return decoded
+
+    def flush(self):
+        return self._obj.flush()
+
+def decoder(encoding):
+    """
+    Returns a decompressor for a Content-Encoding, or None
+    """
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return DeflateDecoder()
+    return None
+
+class Response(object):
+    """
+    Wraps a httplib response. A response that is closed before it has been
+    read completely closes its connection, as the unread data makes the
+    socket unusable. Pooled connections are returned to the pool as soon
+    as the response has been read completely, or discarded from the pool
+    when it is closed before that.
+
+    Compressed content is decoded while it is read, the Content-Length
+    of a compressed response is hidden as it is not the decoded length.
+    """
+    def __init__(self, response, conn, host, pool=None, info=None):
+        self._response = response
+        self._conn = conn
+        self._sock = conn.sock
+        self._host = host
+        self._pool = pool
+        self._info = info
+        self._decoder = decoder(response.getheader('content-encoding'))
+        self._compressed = self._decoder is not None
+        self._decoded = ''
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def getheader(self, name, default=None):
+        if self._compressed and name.lower() == 'content-length':
+            return default
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        if self._compressed:
+            return self._read_decoded(amt)
+        return self._read(amt)
+
+    def _read(self, amt=None):
+        data = self._response.read(amt)
+        if self._info is not None:
+            self._info.bytes_received += len(data)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def _read_decoded(self, amt=None):
+        # a block of compressed data can decode to much more than amt,
+        # the rest is kept for the next read
+        while ((amt is None or len(self._decoded) < amt) and
+               self._decoder is not None):
+            block = self._read(amt)
+            self._decoded += self._decoder.decompress(block)
+            if not block or self._response.isclosed():
+                # a decompressor can not be used after it is flushed
+                self._decoded += self._decoder.flush()
+                self._decoder = None
+        if amt is None:
+            amt = len(self._decoded)
+        data = self._decoded[:amt]
+        self._decoded = self._decoded[amt:]
+        return data
+
+    def close(self):
+        # unread data is left on the socket, it can not be reused
+        unusable = self._conn is not None and not self._response.isclosed()
+        if (unusable and self._pool is None and
+            self._conn.sock is not self._sock):
+            # the single connection has been used for another request
+            unusable = False
+        self._response.close()
+        self._release(unusable)
+
+    def _release(self, unusable=False):
+        if self._conn is not None:
+            if self._pool is not None:
+                if unusable:
+                    self._pool.discard(self._conn)
+                else:
+                    self._pool.checkin(self._host, self._conn)
+            elif unusable:
+                self._conn.close()
+            self._conn = None
+        if self._info is not None:
+            self._info.finish()
+
+    def __del__(self):
+        if self._conn is not None:
+            self.close()
+
+
 class Connection(object):
     """
     Represents a connection to a Fedora-Commons Repository using the REST API
@@ -33,7 +591,9 @@ class Connection(object):
     """
     def __init__(self, url, debug=False,
                  username=None, password=None, 
-                 persistent=True):
+                 persistent=True, pool_size=None, retry=None,
+                 breaker=None, limiter=None, compress=False,
+                 compress_bodies=None):
         """
          url -- URI pointing to the Fedora server. eg.
          
@@ -41,6 +601,27 @@ class Connection(object):
             
          persistent -- Keep a persistent HTTP connection open.
                 Defaults to true
+
+         pool_size -- Use a thread safe pool of at most this many
+                persistent HTTP connections, so the connection can be
+                shared between threads. Defaults to a single connection.
+
+         retry -- The RetryPolicy of failed requests, by default
+                idempotent requests are retried 3 times.
+
+         breaker -- A CircuitBreaker, which fails requests fast while
+                the server is failing.
+
+         limiter -- A ConcurrencyLimiter, which limits the number of
+                requests in flight.
+
+         compress -- Ask for gzip or deflate compressed responses, which
+                are decoded while they are read.
+
+         compress_bodies -- Send XML and text request bodies of at least
+                this many bytes gzip compressed. Only for servers that
+                decode compressed requests, which Fedora does not do
+                without a filter.
         """        
         self.scheme, self.host, self.path = urlparse.urlparse(url, 'http')[:3]
         self.url = url
@@ -49,8 +630,26 @@ class Connection(object):
         self.debug = debug
         
         self.persistent = persistent
-        self.reconnects = 0
-        self.conn = httplib.HTTPConnection(self.host)
+        self.blocksize = BLOCKSIZE
+        self._reconnects = 0
+        self.compress = compress
+        self.compress_bodies = compress_bodies
+        if retry is None:
+            retry = RetryPolicy()
+        self.retry = retry
+        # objects with before_request and after_request methods, and
+        # optionally after_response, which are called with the RequestInfo
+        # of every request
+        self.hooks = []
+        self.breaker = breaker
+        self.limiter = limiter
+        for hook in (breaker, limiter):
+            if hook is not None:
+                self.hooks.append(hook)
+        self.conn = TimedHTTPConnection(self.host)
+        self.pool = None
+        if pool_size:
+            self.pool = ConnectionPool(pool_size)
 
         self.form_headers = {}
         
@@ -64,45 +663,292 @@ class Connection(object):
         
     def close(self):
         self.conn.close()
+        if self.pool is not None:
+            self.pool.close()
 
-    def open(self, url, body='', headers=None, method='GET',):
+    @property
+    def reconnects(self):
+        """
+        The number of connections that were closed because they broke
+        """
+        if self.pool is not None:
+            # counted by the pool, under its lock
+            return self.pool.discarded
+        return self._reconnects
+
+    def open(self, url, body='', headers=None, method='GET', method_id=None,
+             template=None):
+        """
+        Send a request and return the response. The body can be a string,
+        a file-like object or an iterable of strings, which are streamed
+        in blocks so large bodies are never held in memory.
+
+        A conditional request, with an If-None-Match or If-Modified-Since
+        header, can return a response with the 304 Not Modified status.
+
+        Failed requests are retried according to the retry policy, a body
+        that is not a string or a list of strings must be seekable to be
+        sent again.
+
+        The method_id and template of the URL are passed to the hooks, they
+        are set for requests of WADL methods.
+        """
         if headers is None:
             headers = {}
+        conditional = False
+        header_names = {}
+        for name in headers:
+            header_names[name.lower()] = name
+            if name.lower() in CONDITIONAL_HEADERS:
+                conditional = True
+        if (self.compress and 'accept-encoding' not in header_names and
+            'range' not in header_names):
+            # a range of a compressed response would be a range of the
+            # compressed data
+            headers = dict(headers)
+            headers['Accept-Encoding'] = ACCEPT_ENCODING
+        if (self.compress_bodies is not None and
+            isinstance(body, basestring) and
+            len(body) >= self.compress_bodies and
+            'content-encoding' not in header_names and
+            compressible(headers.get(header_names.get('content-type')))):
+            headers = dict(headers)
+            headers['Content-Encoding'] = 'gzip'
+            body = gzip_string(body)
         if url.startswith('/'):
             url = url[1:]
         url = '%s/%s' % (self.path, url)
-        attempts = 3
+        if isinstance(url, unicode):
+            # httplib would turn the whole request into unicode, which
+            # breaks on binary bodies
+            url = url.encode('utf8')
+        position = body_position(body)
+        info = RequestInfo(method, url, method_id, template, self.hooks)
+        policy = self.retry
+        idempotent = policy.idempotent(method, method_id)
+        policy.budget.request()
 
-        while attempts:
-            try:
-                logging.debug('Trying %s on %s' % (method, url))
-                self.conn.request(method, url, body, headers)
-                return check_response_status(self.conn.getresponse())
-            except (socket.error,
-                    httplib.ImproperConnectionState,
-                    httplib.BadStatusLine):
-                    # We include BadStatusLine as they are spurious
-                    # and may randomly happen on an otherwise fine
-                    # connection (though not often)
-                logging.exception('Got an Exception in open')
-                self._reconnect()
-                attempts -= 1
-                if not attempts:
+        try:
+            attempt = 0
+            while True:
+                checkout = time.time()
+                if self.pool is not None:
+                    conn = self.pool.checkout(self.host)
+                else:
+                    conn = self.conn
+                    if is_dropped(conn):
+                        conn.close()
+                info.sending(time.time() - checkout)
+                connected = False
+                try:
+                    logging.debug('Trying %s on %s' % (method, url))
+                    if conn.sock is None:
+                        conn.connect()
+                    connected = True
+                    info.sent(conn, self._send(conn, method, url, body,
+                                               headers))
+                    response = conn.getresponse()
+                    info.received(response.status)
+                except CONNECTION_ERRORS, e:
+                    logging.exception('Got an Exception in open')
+                    self._discard(conn)
+                    # the request was not sent at all, an error while
+                    # sending or reading the response could come after the
+                    # server processed it
+                    unsent = (not connected or
+                              isinstance(e, httplib.CannotSendRequest))
+                    if (not rewind_body(body, position) or
+                        not policy.retry(attempt, idempotent or unsent)):
+                        raise
+                    delay = policy.delay(attempt)
+                except:
+                    self._discard(conn)
                     raise
-        if not self.persistent:
-           self.close()
-        
-    def _reconnect(self):
-        self.reconnects += 1
-        self.close()
-        self.conn.connect()
+                else:
+                    response = Response(response, conn, self.host, self.pool)
+                    delay = None
+                    if (response.status in policy.statuses and
+                        rewind_body(body, position) and
+                        policy.retry(attempt, idempotent, response.status)):
+                        delay = policy.delay(
+                            attempt, response.getheader('retry-after'))
+                    if delay is None:
+                        response._info = info
+                        info.hand_over()
+                        return check_response_status(response, conditional)
+                    logging.info('Retrying %s on %s after status %s' % (
+                        method, url, response.status))
+                    response.read()
+                    response.close()
+                attempt += 1
+                info.backoff += delay
+                time.sleep(delay)
+        except FedoraConnectionException:
+            # the response was closed, which finished the request
+            raise
+        except Exception, e:
+            info.finish(e)
+            raise
+
+    def _discard(self, conn):
+        if self.pool is not None:
+            self.pool.discard(conn)
+        else:
+            # the next request connects again
+            self._reconnects += 1
+            conn.close()
+
+    def _send(self, conn, method, url, body, headers):
+        """ Sends a request, returns the number of bytes of the body """
+        if isinstance(body, basestring):
+            conn.request(method, url, body, headers)
+            return len(body)
+
+        conn.putrequest(method, url)
+        chunked = False
+        length = body_length(body)
+        header_names = [name.lower() for name in headers]
+        if 'content-length' not in header_names:
+            if length is None:
+                chunked = True
+                conn.putheader('Transfer-Encoding', 'chunked')
+            else:
+                conn.putheader('Content-Length', str(length))
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.endheaders()
+
+        sent = 0
+        for block in iter_body(body, self.blocksize):
+            if not block:
+                # an empty chunk would end the body
+                continue
+            sent += len(block)
+            if chunked:
+                conn.send('%x\r\n' % len(block))
+                conn.send(block)
+                conn.send('\r\n')
+            else:
+                conn.send(block)
+        if chunked:
+            conn.send('0\r\n\r\n')
+        return sent
+
         
-def check_response_status(response):
-    if response.status not in (200, 201, 204):
+def compressible(content_type):
+    if not content_type:
+        return False
+    content_type = content_type.lower()
+    for prefix in COMPRESSIBLE_TYPES:
+        if content_type.startswith(prefix):
+            return True
+    return False
+
+def gzip_string(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf8')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def is_dropped(conn):
+    """
+    Whether the server closed an idle kept-alive connection. Its socket
+    is readable then, as nothing else is sent between requests.
+    """
+    if conn.sock is None:
+        return False
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+def body_length(body):
+    """ Length of a request body, or None when it's not known upfront """
+    if isinstance(body, basestring):
+        return len(body)
+    if isinstance(body, (list, tuple)):
+        # a list of strings
+        return sum([len(block) for block in body])
+    try:
+        return os.fstat(body.fileno()).st_size - body.tell()
+    except (AttributeError, OSError, IOError):
+        pass
+    return None
+
+def body_position(body):
+    try:
+        return body.tell()
+    except (AttributeError, IOError):
+        return None
+
+def rewind_body(body, position):
+    """
+    Rewind a request body so it can be sent again. Returns False for
+    bodies that can only be read once.
+    """
+    if isinstance(body, (basestring, list, tuple)):
+        return True
+    if position is None:
+        return False
+    body.seek(position)
+    return True
+
+def iter_body(body, blocksize=BLOCKSIZE):
+    """ Iterate over a file-like or iterable body in blocks """
+    if hasattr(body, 'read'):
+        while True:
+            block = body.read(blocksize)
+            if not block:
+                break
+            yield block
+    else:
+        for block in body:
+            yield block
+
+class ChecksumBody(object):
+    """
+    Wraps a file-like or iterable request body and computes its digest
+    while the blocks are sent.
+    """
+    def __init__(self, body, algorithm, blocksize=BLOCKSIZE):
+        self.body = body
+        self.algorithm = algorithm
+        self.blocksize = blocksize
+        self.digest = hashlib.new(algorithm)
+
+    def __iter__(self):
+        for block in iter_body(self.body, self.blocksize):
+            self.digest.update(block)
+            yield block
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    # used to find the content length
+    def fileno(self):
+        return self.body.fileno()
+
+    def tell(self):
+        return self.body.tell()
+
+    def seek(self, position):
+        # the body is sent again, start over
+        self.body.seek(position)
+        self.digest = hashlib.new(self.algorithm)
+
+def check_response_status(response, not_modified=False):
+    """
+    Raises a FedoraConnectionException for an error status, the 304 Not
+    Modified status is only accepted with not_modified.
+    """
+    if response.status == 304 and not_modified:
+        return response
+    if response.status not in (200, 201, 204, 206):
         ex = FedoraConnectionException(response.status, response.reason)
         try:
             ex.body = response.read()
         except:
             pass
+        response.close()
         raise ex
     return response
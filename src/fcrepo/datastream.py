@@ -1,11 +1,25 @@
 # Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
 # See also LICENSE.txt
 
+import os
+import time
+import hashlib
+from itertools import chain
 from collections import defaultdict
 
 from lxml import etree
 
+from fcrepo.connection import iter_body, BLOCKSIZE, CHECKSUM_ALGORITHMS
+from fcrepo.connection import FedoraConnectionException
+from fcrepo.connection import ChecksumMismatchException
 from fcrepo.utils import rdfxml2dict, dict2rdfxml
+from fcrepo.batch import BatchedProperties
+
+_marker = object()
+
+# datastream properties changed by Fedora on every modification
+VOLATILE_PROPERTIES = ('versionId', 'createdDate', 'location', 'size',
+                       'checksum')
     
 class typedproperty(property):
     def __init__(self, fget, fset=None, fdel=None, doc=None, pytype=None):
@@ -25,13 +39,35 @@ class typedproperty(property):
             
         super(typedproperty, self).__init__(typed_get, typed_set, fdel, doc)
 
-class FedoraDatastream(object):
-    def __init__(self, dsid, object):
+class FedoraDatastream(BatchedProperties):
+    _kind = u'datastream'
+    _volatile = VOLATILE_PROPERTIES
+
+    def __init__(self, dsid, object, profile=None):
+        """
+        The datastream profile is fetched when a property is first read,
+        unless it is in the profile with already known properties.
+        """
         self.object = object
         self.dsid = dsid
+        self._info = dict(profile or {})
+        self._loaded = False
+        self._pending = {}
+        self._batches = 0
+
+    def _load(self):
         self._info = self.object.client.getDatastreamProfile(self.object.pid,
                                                              self.dsid)
+        self._loaded = True
 
+    def _get(self, name, default=_marker):
+        if name in self._pending:
+            return self._pending[name]
+        if name not in self._info and not self._loaded:
+            self._load()
+        if default is _marker:
+            return self._info[name]
+        return self._info.get(name, default)
         
     def delete(self, **params):
         self.object.client.deleteDatastream(self.object.pid,
@@ -39,71 +75,185 @@ class FedoraDatastream(object):
                                             **params)
         self.object._dsids = None
 
-    def getContent(self):
-        return self.object.client.getDatastream(self.object.pid, self.dsid)
+    def getContent(self, start=None, end=None):
+        return self.object.client.getDatastream(self.object.pid, self.dsid,
+                                                start, end)
 
-    def setContent(self, data='', **params):
-            
-        if self._info['controlGroup'] == 'X':
-            # for some reason we need to add 2 characters to the body
-            # or we get a parsing error in fedora
-            data += '\r\n'
-        
-        self.object.client.modifyDatastream(self.object.pid,
-                                            self.dsid,
-                                            data,
-                                            **params)
-        self._info = self.object.client.getDatastreamProfile(self.object.pid,
-                                                             self.dsid)
+    def download(self, target, start=0, end=None, resume=False,
+                 blocksize=BLOCKSIZE, progress=None, verify=True):
+        """
+        Stream the content to target, a filename or a file-like object,
+        in blocks of blocksize bytes. Only the byte range from start up to
+        and including end is downloaded when given.
+
+        With resume, an existing target file is taken to be a partial
+        download and only the remaining bytes are fetched.
+
+        The progress callable is called after every block with the number
+        of bytes written and the seconds elapsed so far.
+
+        When the complete content of a managed datastream is downloaded its
+        checksum is computed on the fly and compared with the checksum
+        in the datastream profile, unless verify is false.
+
+        Returns a dict with the number of bytes written, the seconds it
+        took, the throughput in bytes per second and the checksum.
+        """
+        digest = None
+        algorithm = CHECKSUM_ALGORITHMS.get(self._get('checksumType', None))
+        if (verify and algorithm is not None and not start and end is None
+            and self._get('controlGroup') == 'M'):
+            digest = hashlib.new(algorithm)
+
+        fp = target
+        if isinstance(target, basestring):
+            mode = 'wb'
+            if resume and os.path.exists(target):
+                mode = 'ab'
+                if digest is not None:
+                    # the part downloaded before is only on disk
+                    partial = open(target, 'rb')
+                    for block in iter_body(partial, blocksize):
+                        digest.update(block)
+                    partial.close()
+                start += os.path.getsize(target)
+            fp = open(target, mode)
+
+        started = time.time()
+        written = 0
+        try:
+            try:
+                response = self.getContent(start or None, end)
+            except FedoraConnectionException, e:
+                if e.httpcode == 416 and resume:
+                    # Range Not Satisfiable, the download was complete
+                    response = None
+                else:
+                    raise
+            if response is not None:
+                try:
+                    skip = 0
+                    remaining = None
+                    if response.status != 206:
+                        # the server ignored the range request
+                        skip = start
+                        if end is not None:
+                            remaining = end - start + 1
+                    while True:
+                        block = response.read(blocksize)
+                        if not block:
+                            break
+                        if skip:
+                            if len(block) <= skip:
+                                skip -= len(block)
+                                continue
+                            block = block[skip:]
+                            skip = 0
+                        if remaining is not None:
+                            block = block[:remaining]
+                            remaining -= len(block)
+                        fp.write(block)
+                        if digest is not None:
+                            digest.update(block)
+                        written += len(block)
+                        if progress is not None:
+                            progress(written, time.time() - started)
+                        if remaining == 0:
+                            break
+                finally:
+                    # also when writing failed, the connection is released
+                    response.close()
+        finally:
+            if fp is not target:
+                fp.close()
+
+        seconds = time.time() - started
+        rate = 0.0
+        if seconds:
+            rate = written / seconds
+        checksum = None
+        if digest is not None:
+            checksum = digest.hexdigest()
+            if checksum != self._get('checksum', None):
+                raise ChecksumMismatchException(self._get('checksum', None),
+                                                checksum)
+        return {'bytes': written, 'seconds': seconds, 'rate': rate,
+                'checksum': checksum}
+
+    def setContent(self, data='', filename=None, **params):
+        """
+        Data can be a string, a file-like object or an iterable of strings,
+        or pass a filename to stream the content from disk.
+        """
+        if filename is not None:
+            fp = data = open(filename, 'rb')
+        try:
+            if self._get('controlGroup') == 'X':
+                # for some reason we need to add 2 characters to the body
+                # or we get a parsing error in fedora
+                if isinstance(data, basestring):
+                    # sent one after another, so the data is not copied
+                    data = [data, '\r\n']
+                else:
+                    data = chain(iter_body(data), ['\r\n'])
+            elif (self._get('controlGroup') == 'M' and
+                  'checksumType' not in params and
+                  self._get('checksumType', None) in CHECKSUM_ALGORITHMS):
+                # have the checksum verified while uploading
+                params['checksumType'] = self._get('checksumType')
+
+            self.object.client.modifyDatastream(
+                self.object.pid, self.dsid, data,
+                controlGroup=self._get('controlGroup'), **params)
+        finally:
+            if filename is not None:
+                fp.close()
+        # reload the profile when it's needed again
+        self._info = {}
+        self._loaded = False
         
-    def _setProperty(self, name, value):
-        msg = u'Changed %s datastream property' % name
-        name = {'label': 'dsLabel',
-                'location': 'dsLocation',
-                'state': 'dsState'}.get(name, name)
-        params = {name: value, 'logMessage': msg, 'ignoreContent': True}
-        self.object.client.modifyDatastream(self.object.pid,
-                                            self.dsid,
-                                            **params)
-        self._info = self.object.client.getDatastreamProfile(self.object.pid,
-                                                             self.dsid)
+    def _save(self, properties, logMessage):
+        self.object.client.modifyDatastream(self.object.pid, self.dsid,
+                                            logMessage=logMessage,
+                                            ignoreContent=True,
+                                            **properties)
 
-    label = property(lambda self: self._info['label'],
+    label = property(lambda self: self._get('label'),
                      lambda self, value: self._setProperty('label', value))
-    location = property(lambda self: self._info['location'],
+    location = property(lambda self: self._get('location'),
                         lambda self, value: self._setProperty('location', value))
-    state = property(lambda self: self._info['state'],
+    state = property(lambda self: self._get('state'),
                            lambda self, value: self._setProperty('state',
                                                                  value))
-    checksumType = property(lambda self: self._info['checksumType'],
+    checksumType = property(lambda self: self._get('checksumType'),
                             lambda self, value: self._setProperty('checksumType',
                                                                  value))
-    versionId = property(lambda self: self._info['versionId'],
+    versionId = property(lambda self: self._get('versionId'),
                         lambda self, value: self._setProperty('versionId',
                                                               value)) 
-    mimeType = property(lambda self: self._info['mimeType'],
+    mimeType = property(lambda self: self._get('mimeType'),
                         lambda self, value: self._setProperty('mimeType',
                                                               value)) 
-    formatURI = property(lambda self: self._info['formatURI'],
+    formatURI = property(lambda self: self._get('formatURI'),
                          lambda self, value: self._setProperty('formatURI',
                                                                value)) 
 
 
-    versionable = typedproperty(lambda self: self._info['versionable'],
+    versionable = typedproperty(lambda self: self._get('versionable'),
                                 lambda self, value: self._setProperty(
                                   'versionable', value), pytype=bool) 
 
     # read only
-    createdDate = property(lambda self: self._info['createdDate'])
-    controlGroup = property(lambda self: self._info['controlGroup'])
-    size = typedproperty(lambda self: self._info['size'], pytype=int)
-    checksum = property(lambda self: self._info['formatURI'])
+    createdDate = property(lambda self: self._get('createdDate'))
+    controlGroup = property(lambda self: self._get('controlGroup'))
+    size = typedproperty(lambda self: self._get('size'), pytype=int)
+    checksum = property(lambda self: self._get('checksum'))
 
 
 
 class RELSEXTDatastream(FedoraDatastream):
-    def __init__(self, dsid, object):
-        super(RELSEXTDatastream, self).__init__(dsid, object)
+    def __init__(self, dsid, object, profile=None):
+        super(RELSEXTDatastream, self).__init__(dsid, object, profile)
         self._rdf = None
 
     def _get_rdf(self):
@@ -119,12 +269,12 @@ class RELSEXTDatastream(FedoraDatastream):
         return keys
     predicates = keys
     
-    def setContent(self, data='', **params):
-        if not data:
+    def setContent(self, data='', filename=None, **params):
+        if not data and filename is None:
             rdf = self._get_rdf()
             data = dict2rdfxml(self.object.pid, rdf)
-            self._rdf = None
-        super(RELSEXTDatastream, self).setContent(data, **params)
+        self._rdf = None
+        super(RELSEXTDatastream, self).setContent(data, filename, **params)
     def __setitem__(self, key, value):
         rdf = self._get_rdf()
         rdf[key]=value
@@ -146,8 +296,8 @@ class RELSEXTDatastream(FedoraDatastream):
         return rdf.__iter__()
     
 class DCDatastream(FedoraDatastream):
-    def __init__(self, dsid, object):
-        super(DCDatastream, self).__init__(dsid, object)
+    def __init__(self, dsid, object, profile=None):
+        super(DCDatastream, self).__init__(dsid, object, profile)
         self._dc = None
 
     def _get_dc(self):
@@ -172,8 +322,8 @@ class DCDatastream(FedoraDatastream):
         return keys
     properties = keys
     
-    def setContent(self, data='', **params):
-        if not data:
+    def setContent(self, data='', filename=None, **params):
+        if not data and filename is None:
             dc = self._get_dc()
             nsmap = {'dc': 'http://purl.org/dc/elements/1.1/',
                      'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/'}
@@ -184,8 +334,8 @@ class DCDatastream(FedoraDatastream):
                     el.text = value
             data = etree.tostring(doc, encoding="UTF-8",
                                   pretty_print=True, xml_declaration=False)
-            self._dc = None
-        super(DCDatastream, self).setContent(data, **params)
+        self._dc = None
+        super(DCDatastream, self).setContent(data, filename, **params)
         
     def __setitem__(self, key, value):
         dc = self._get_dc()
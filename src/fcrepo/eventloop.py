@@ -0,0 +1,461 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import time
+import heapq
+import errno
+import types
+import socket
+import select
+import logging
+import threading
+from collections import deque
+
+from fcrepo.workers import Future
+
+# the events a handler of a socket waits for
+READ = 1
+WRITE = 2
+
+class Timer(object):
+    """
+    A call scheduled with EventLoop.call_later, which can be cancelled
+    """
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """
+    Waits for the sockets of non-blocking connections and calls their
+    handlers, the callbacks and the timers, all in a single thread. The
+    loop runs in the thread that calls `run` or `run_until_complete`, or
+    in a background thread started with `start`.
+
+    Only call_soon, call_later, submit and stop can be called from other
+    threads, the handlers of the sockets are registered and called in the
+    thread of the loop. Sockets are watched with poll where it exists,
+    select limits them to about a thousand.
+    """
+    def __init__(self):
+        self._handlers = {}
+        self._events = {}
+        self._poll = None
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+        self._timers = []
+        self._sequence = 0
+        self._callbacks = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        # a socket of which the other end wakes up the loop when a
+        # callback is added by another thread
+        self._waker, self._wakeup = socketpair()
+        self._waker.setblocking(0)
+        self._wakeup.setblocking(0)
+        self.register(self._waker.fileno(), self, READ)
+
+    def register(self, fd, handler, events):
+        """
+        Calls handler.handle_events(readable, writable) when the file
+        descriptor is readable or writable, events is READ, WRITE or both
+        """
+        self._handlers[fd] = handler
+        self._events[fd] = events
+        if self._poll is not None:
+            self._poll.register(fd, poll_mask(events))
+
+    def modify(self, fd, events):
+        self._events[fd] = events
+        if self._poll is not None:
+            self._poll.modify(fd, poll_mask(events))
+
+    def unregister(self, fd):
+        if self._handlers.pop(fd, None) is None:
+            return
+        del self._events[fd]
+        if self._poll is not None:
+            self._poll.unregister(fd)
+
+    def call_soon(self, callback, *args):
+        """
+        Calls callback with the arguments in the thread of the loop
+        """
+        self._lock.acquire()
+        try:
+            self._callbacks.append((callback, args))
+        finally:
+            self._lock.release()
+        if not self.in_loop():
+            self._wake()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Calls callback after delay seconds, returns a Timer
+        """
+        timer = Timer(callback, args)
+        self._lock.acquire()
+        try:
+            self._sequence += 1
+            heapq.heappush(self._timers,
+                           (time.time() + delay, self._sequence, timer))
+        finally:
+            self._lock.release()
+        if not self.in_loop():
+            self._wake()
+        return timer
+
+    def sleep(self, delay):
+        """
+        Returns a Future which is done after delay seconds
+        """
+        future = Future()
+        self.call_later(delay, future.set_result, None)
+        return future
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Calls func in the thread of the loop, returns a Future of its
+        result. When func returns a Future, like a coroutine does, the
+        returned Future is done when that one is.
+        """
+        future = Future()
+        def call():
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                future.set_exception(e)
+                return
+            if isinstance(result, Future):
+                chain(result, future)
+            else:
+                future.set_result(result)
+        self.call_soon(call)
+        return future
+
+    def in_loop(self):
+        """
+        Whether the current thread is running the loop
+        """
+        return self._thread is threading.currentThread()
+
+    def run(self):
+        """
+        Runs the loop in the current thread until stop is called
+        """
+        self._lock.acquire()
+        try:
+            if self._running:
+                raise RuntimeError('The event loop is running already')
+            self._running = True
+            self._thread = threading.currentThread()
+        finally:
+            self._lock.release()
+        try:
+            while self._running:
+                self._run_once()
+        finally:
+            self._lock.acquire()
+            try:
+                self._running = False
+                self._thread = None
+            finally:
+                self._lock.release()
+
+    def run_until_complete(self, future):
+        """
+        Runs the loop in the current thread until the future is done, and
+        returns its result
+        """
+        if not future.done():
+            future.add_done_callback(lambda future: self._stop())
+            self.run()
+        return future.result()
+
+    def start(self):
+        """
+        Runs the loop in a background thread
+        """
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        while self._thread is None and thread.isAlive():
+            time.sleep(0.001)
+
+    def stop(self):
+        """
+        Stops the loop after the callbacks that are due
+        """
+        self.call_soon(self._stop)
+
+    def wait(self, future, timeout=None):
+        """
+        Blocks until the future is done and returns its result. When the
+        loop is not running in another thread, it is run in this one.
+        """
+        if self.in_loop():
+            raise RuntimeError('Waiting would block the event loop')
+        if self._thread is not None:
+            return future.result(timeout)
+        return self.run_until_complete(future)
+
+    def close(self):
+        self.unregister(self._waker.fileno())
+        self._waker.close()
+        self._wakeup.close()
+
+    def _stop(self):
+        self._running = False
+
+    def _wake(self):
+        try:
+            self._wakeup.send('x')
+        except socket.error:
+            # the loop is woken up already
+            pass
+
+    def handle_events(self, readable, writable):
+        # the waker socket is readable
+        try:
+            while self._waker.recv(1024):
+                pass
+        except socket.error:
+            pass
+
+    def _run_once(self):
+        timeout = None
+        self._lock.acquire()
+        try:
+            if self._callbacks:
+                timeout = 0
+            elif self._timers:
+                timeout = max(self._timers[0][0] - time.time(), 0)
+        finally:
+            self._lock.release()
+
+        for fd, readable, writable in self._wait(timeout):
+            handler = self._handlers.get(fd)
+            if handler is None:
+                continue
+            try:
+                handler.handle_events(readable, writable)
+            except Exception:
+                logging.exception('Got an Exception in the event loop')
+
+        now = time.time()
+        self._lock.acquire()
+        try:
+            while self._timers and self._timers[0][0] <= now:
+                timer = heapq.heappop(self._timers)[2]
+                if not timer.cancelled:
+                    self._callbacks.append((timer.callback, timer.args))
+            # callbacks added by these callbacks run the next time
+            callbacks = list(self._callbacks)
+            self._callbacks.clear()
+        finally:
+            self._lock.release()
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception('Got an Exception in the event loop')
+
+    def _wait(self, timeout):
+        # returns (fd, readable, writable) tuples, errors are reported as
+        # both, so the handler finds the error when it reads or writes
+        if self._poll is not None:
+            if timeout is not None:
+                timeout = timeout * 1000
+            try:
+                events = self._poll.poll(timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            errors = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            return [(fd, bool(event & (select.POLLIN | errors)),
+                     bool(event & (select.POLLOUT | errors)))
+                    for fd, event in events]
+        readers = [fd for fd, events in self._events.items() if events & READ]
+        writers = [fd for fd, events in self._events.items()
+                   if events & WRITE]
+        try:
+            # on windows a failed connect is in the exceptional set
+            readable, writable, failed = select.select(readers, writers,
+                                                       writers, timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        fds = set(readable) | set(writable) | set(failed)
+        return [(fd, fd in readable or fd in failed,
+                 fd in writable or fd in failed) for fd in fds]
+
+def poll_mask(events):
+    mask = 0
+    if events & READ:
+        mask |= select.POLLIN
+    if events & WRITE:
+        mask |= select.POLLOUT
+    return mask
+
+def socketpair():
+    """
+    Returns two connected sockets
+    """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    # windows has no socketpair
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        server, address = listener.accept()
+    finally:
+        listener.close()
+    return server, client
+
+def chain(source, target):
+    """
+    Sets the outcome of the source Future on the target Future when the
+    source is done
+    """
+    def done(future):
+        error = future.exception()
+        if error is not None:
+            target.set_exception(error)
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(done)
+
+class Return(Exception):
+    """
+    Raised by a coroutine to return a value, generators can not return
+    one in Python 2:
+
+      raise Return(value)
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+def coroutine(func):
+    """
+    Turns a generator function into a function which returns a Future.
+    The generator yields Futures, or lists of Futures, and is resumed
+    with their results when they are done, or gets their exception
+    raised. A value is returned by raising Return:
+
+      @coroutine
+      def labels(client, pids):
+          objects = yield [client.getObject(pid) for pid in pids]
+          raise Return([obj.label for obj in objects])
+
+    The generator runs until its first yield in the calling thread, and
+    after that in the thread that finished the Futures, which is the
+    thread of the event loop for requests.
+    """
+    def wrapper(*args, **kwargs):
+        future = Future()
+        try:
+            result = func(*args, **kwargs)
+        except Return, e:
+            future.set_result(e.value)
+            return future
+        except Exception, e:
+            future.set_exception(e)
+            return future
+        if isinstance(result, types.GeneratorType):
+            _Runner(result, future).step()
+        else:
+            future.set_result(result)
+        return future
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class _Runner(object):
+    # drives the generator of a coroutine
+    def __init__(self, generator, future):
+        self.generator = generator
+        self.future = future
+
+    def step(self, value=None, error=None):
+        while True:
+            try:
+                if error is not None:
+                    yielded = self.generator.throw(error)
+                else:
+                    yielded = self.generator.send(value)
+            except StopIteration:
+                self.future.set_result(None)
+                return
+            except Return, e:
+                self.future.set_result(e.value)
+                return
+            except Exception, e:
+                self.future.set_exception(e)
+                return
+            if isinstance(yielded, list):
+                yielded = gather(yielded)
+            if not isinstance(yielded, Future):
+                value = None
+                error = TypeError('A coroutine can only yield Futures, '
+                                  'not %r' % (yielded,))
+                continue
+            if not yielded.done():
+                yielded.add_done_callback(self._resume)
+                return
+            # done already, go on without growing the stack
+            value, error = outcome(yielded)
+
+    def _resume(self, future):
+        value, error = outcome(future)
+        self.step(value, error)
+
+def outcome(future):
+    error = future.exception()
+    if error is not None:
+        return None, error
+    return future.result(), None
+
+def gather(futures):
+    """
+    Returns a Future of the list of the results of the futures, or of the
+    first exception one of them raised
+    """
+    target = Future()
+    futures = list(futures)
+    if not futures:
+        target.set_result([])
+        return target
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        error = future.exception()
+        lock.acquire()
+        try:
+            if target.done():
+                return
+            if error is None:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+        finally:
+            lock.release()
+        if error is not None:
+            target.set_exception(error)
+        else:
+            target.set_result([f.result() for f in futures])
+
+    for future in futures:
+        future.add_done_callback(done)
+    return target
@@ -0,0 +1,165 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import base64
+from collections import defaultdict
+
+from lxml import etree
+from lxml.builder import ElementMaker
+
+from fcrepo.utils import dict2rdfxml
+
+NSMAP = {'foxml': 'info:fedora/fedora-system:def/foxml#'}
+MODEL = 'info:fedora/fedora-system:def/model#'
+
+DC_NSMAP = {'dc': 'http://purl.org/dc/elements/1.1/',
+            'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/'}
+
+class FOXMLBuilder(object):
+    """
+    Builds a FOXML 1.1 document of an object with its datastreams, which
+    is ingested with a single request by FedoraClient.ingest:
+
+      foxml = FOXMLBuilder(pid, label=u'My object')
+      foxml.setDC({'title': [u'My object']})
+      foxml.setRelations({NS.fedora.isMemberOf: [
+                          {'type': 'uri', 'value': u'info:fedora/col:1'}]})
+      foxml.addDatastream('META', '<meta/>', label=u'Metadata')
+      foxml.addDatastream('IMAGE', location=u'http://host/image.png',
+                          controlGroup=u'M', mimeType=u'image/png')
+      obj = client.ingest(foxml)
+    """
+    def __init__(self, pid, label, state=u'A', ownerId=None):
+        self.pid = pid
+        self.label = label
+        self.state = state
+        self.ownerId = ownerId
+        self.datastreams = []
+        self._profiles = {}
+        self._dc = None
+        self._rdf = None
+
+    def addDatastream(self, dsid, content=None, location=None,
+                      controlGroup=u'X', label=u'', mimeType=None,
+                      formatURI=None, state=u'A', versionable=True,
+                      checksumType=None, checksum=None):
+        """
+        Adds a datastream. Inline XML (controlGroup X) content can be a
+        string or an element. Managed content (M) is either included as
+        a string, or fetched by Fedora from the location URL, which is
+        also how externally referenced (E) and redirected (R) datastreams
+        are added.
+        """
+        if mimeType is None:
+            if controlGroup == u'X':
+                mimeType = u'text/xml'
+            else:
+                mimeType = u'application/binary'
+        foxml = ElementMaker(namespace=NSMAP['foxml'], nsmap=NSMAP)
+        version = foxml.datastreamVersion(ID='%s.0' % dsid, LABEL=label,
+                                          MIMETYPE=mimeType)
+        if formatURI:
+            version.attrib['FORMAT_URI'] = formatURI
+        if checksumType:
+            digest = foxml.contentDigest(TYPE=checksumType)
+            if checksum:
+                digest.attrib['DIGEST'] = checksum
+            version.append(digest)
+        if controlGroup == u'X':
+            if content is None:
+                raise ValueError('Inline XML datastream %s has no content' %
+                                 dsid)
+            if isinstance(content, basestring):
+                if isinstance(content, unicode):
+                    content = content.encode('utf8')
+                content = etree.fromstring(content)
+            version.append(foxml.xmlContent(content))
+        elif location is not None:
+            version.append(foxml.contentLocation(TYPE='URL', REF=location))
+        elif controlGroup == u'M' and content is not None:
+            version.append(foxml.binaryContent(base64.b64encode(content)))
+        else:
+            raise ValueError('Datastream %s has no content or location' %
+                             dsid)
+        self.datastreams.append(foxml.datastream(
+            version, ID=dsid, STATE=state, CONTROL_GROUP=controlGroup,
+            VERSIONABLE=str(bool(versionable)).lower()))
+
+        profile = {'label': label,
+                   'mimeType': mimeType,
+                   'controlGroup': controlGroup,
+                   'state': state,
+                   'versionable': bool(versionable)}
+        if formatURI:
+            profile['formatURI'] = formatURI
+        if checksumType:
+            profile['checksumType'] = checksumType
+        self._profiles[dsid] = profile
+
+    def setDC(self, values, label=u'Dublin Core Record for this object'):
+        """
+        Adds the DC datastream with a dict of lists of values, like the
+        DCDatastream returns.
+        """
+        doc = etree.Element('{%s}dc' % DC_NSMAP['oai_dc'], nsmap=DC_NSMAP)
+        for key, items in sorted(values.items()):
+            for value in items:
+                el = etree.SubElement(doc, '{%s}%s' % (DC_NSMAP['dc'], key))
+                el.text = value
+        self.addDatastream('DC', doc, label=label,
+                           formatURI=u'http://www.openarchives.org/OAI/2.0/oai_dc/')
+        self._dc = values
+
+    def setRelations(self, predicates):
+        """
+        Adds the RELS-EXT datastream with a dict of lists of objects, like
+        the RELSEXTDatastream returns.
+        """
+        rdfxml = dict2rdfxml(self.pid, predicates)
+        self.addDatastream('RELS-EXT', rdfxml,
+                           label=u'Relationships',
+                           mimeType=u'application/rdf+xml',
+                           formatURI=(u'info:fedora/fedora-system:'
+                                      u'FedoraRELSExt-1.0'))
+        self._rdf = predicates
+
+    def tostring(self):
+        foxml = ElementMaker(namespace=NSMAP['foxml'], nsmap=NSMAP)
+        properties = foxml.objectProperties(
+            foxml.property(NAME=MODEL + 'state', VALUE=self.state),
+            foxml.property(NAME=MODEL + 'label', VALUE=self.label))
+        if self.ownerId is not None:
+            properties.append(foxml.property(NAME=MODEL + 'ownerId',
+                                             VALUE=self.ownerId))
+        doc = foxml.digitalObject(properties, *self.datastreams,
+                                  **{'VERSION': '1.1', 'PID': self.pid})
+        return etree.tostring(doc, encoding="UTF-8", xml_declaration=False)
+
+    def profile(self):
+        """
+        The object properties that are known from the document
+        """
+        profile = {'label': self.label, 'state': self.state}
+        if self.ownerId is not None:
+            profile['ownerId'] = self.ownerId
+        return profile
+
+    def seed(self, obj):
+        """
+        Sets the datastreams and their properties and content known from
+        the document on a FedoraObject for it, so they are not fetched.
+        """
+        if 'DC' in self._profiles:
+            # Fedora only adds a DC datastream when there is none
+            obj._dsids = [ds.get('ID') for ds in self.datastreams]
+        obj._ds_profiles = dict(self._profiles)
+        if self._dc is not None:
+            dc = defaultdict(list)
+            for key, values in self._dc.items():
+                dc[key] = list(values)
+            obj['DC']._dc = dc
+        if self._rdf is not None:
+            rdf = defaultdict(list)
+            for predicate, objects in self._rdf.items():
+                rdf[predicate] = list(objects)
+            obj['RELS-EXT']._rdf = rdf
@@ -0,0 +1,283 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import os
+import re
+import json
+import time
+import urllib
+import datetime
+from email.utils import parsedate_tz, mktime_tz
+
+from fcrepo.connection import ChecksumMismatchException
+from fcrepo.datastream import FedoraDatastream
+from fcrepo.workers import imap_unordered
+
+MANIFEST = 'manifest.json'
+SYNC_STATE = 'sync.json'
+
+# the datastream properties that identify a version of the content
+VERSION_PROPERTIES = ('versionId', 'createdDate', 'checksum')
+
+# a date of Fedora, like 2010-11-04T12:00:00.123Z
+FEDORA_DATE = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?Z?$')
+
+# control groups of datastreams of which the content is not in Fedora,
+# the manifest has their location
+REFERENCED = (u'R', u'E')
+
+class Harvester(object):
+    """
+    Copies objects from Fedora to a directory tree: every object gets a
+    directory with a file for the content of each datastream and a
+    manifest.json with the object profile and the datastream profiles.
+
+    The content of redirected and externally referenced datastreams is
+    not copied, only their location is in the manifest.
+
+    The manifest is written last, so objects of an interrupted harvest
+    are harvested again. Objects of which the lastModifiedDate did not
+    change since their manifest was written are skipped, and only the
+    content of datastreams with a new version is downloaded again.
+    """
+    def __init__(self, client, directory, workers=4):
+        self.client = client
+        self.directory = directory
+        if client.api.connection.pool is None:
+            workers = 1
+        self.workers = workers
+
+    def path(self, pid, dsid=None):
+        path = os.path.join(self.directory, urllib.quote(pid, safe=''))
+        if dsid is not None:
+            path = os.path.join(path, urllib.quote(dsid, safe=''))
+        return path
+
+    def manifest(self, pid):
+        """
+        Returns the manifest of a harvested object, or None
+        """
+        return read_json(os.path.join(self.path(pid), MANIFEST))
+
+    def harvest(self, pids=None, query=None, terms=False):
+        """
+        Harvests the objects with the given pids, or the results of a
+        searchObjects query. Yields (pid, harvested, error) tuples in order
+        of completion, harvested is false when the object did not change.
+        """
+        if query is not None:
+            items = self._search(query, terms)
+        else:
+            items = ((pid, None) for pid in pids)
+        for item, result, error in imap_unordered(self._harvest, items,
+                                                  self.workers):
+            yield item[0], result, error
+
+    def _search(self, query, terms=False):
+        # the modification date of the results saves a request for
+        # the objects that did not change
+        for data in self.client.searchObjects(query, ['pid', 'mDate'], terms,
+                                              maxResults=100):
+            yield data['pid'][0], (data.get('mDate') or [None])[0]
+
+    def _harvest(self, item):
+        pid, modified = item
+        manifest = self.manifest(pid) or {'profile': {}, 'datastreams': {}}
+        harvested = manifest['profile'].get('lastModifiedDate')
+        if same_date(modified, harvested):
+            return False
+        profile = self.client.getObjectProfile(pid)
+        if same_date(profile.get('lastModifiedDate'), harvested):
+            return False
+
+        directory = self.path(pid)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        obj = self.client.getObject(pid, profile)
+        ds_profiles = {}
+        for dsid in self.client.listDatastreams(pid):
+            ds_profile = self.client.getDatastreamProfile(pid, dsid)
+            ds_profiles[dsid] = ds_profile
+            old = manifest['datastreams'].get(dsid)
+            target = self.path(pid, dsid)
+            if ds_profile.get('controlGroup') in REFERENCED:
+                # Fedora redirects to the content of R datastreams
+                if os.path.exists(target):
+                    os.remove(target)
+                continue
+            if (old is not None and os.path.exists(target) and
+                not self._changed(old, ds_profile)):
+                continue
+            self._download(FedoraDatastream(dsid, obj, ds_profile),
+                           ds_profile, target)
+
+        for dsid in manifest['datastreams']:
+            target = self.path(pid, dsid)
+            if dsid not in ds_profiles and os.path.exists(target):
+                os.remove(target)
+
+        manifest = {'pid': pid,
+                    'profile': profile,
+                    'datastreams': ds_profiles,
+                    'harvested': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                               time.gmtime())}
+        write_json(os.path.join(directory, MANIFEST), manifest)
+        return True
+
+    def _changed(self, old, new):
+        """
+        Whether a datastream has a new version, or new content
+        """
+        for name in VERSION_PROPERTIES:
+            if old.get(name) != new.get(name):
+                return True
+        return False
+
+    def _download(self, ds, ds_profile, target):
+        # a partial download of an interrupted harvest is resumed, when it
+        # is of the same version of the datastream
+        partial = target + '.part'
+        version = partial + '.json'
+        if os.path.exists(partial):
+            old = read_json(version)
+            if old is None or self._changed(old, ds_profile):
+                os.remove(partial)
+        if not os.path.exists(partial):
+            write_json(version, dict([(name, ds_profile.get(name))
+                                      for name in VERSION_PROPERTIES]))
+        try:
+            ds.download(partial, resume=True)
+        except ChecksumMismatchException:
+            # the content changed since the partial download
+            os.remove(partial)
+            raise
+        replace(partial, target)
+        os.remove(version)
+
+class Mirror(Harvester):
+    """
+    Keeps a harvest of the results of a searchObjects query up to date.
+    The latest modification date of the harvested objects is stored in
+    the directory, the next sync only asks Fedora for the objects that
+    were modified since.
+    """
+    def __init__(self, client, directory, query, workers=4):
+        """
+         query -- A query with conditions, like u'pid~foo:*', a condition
+                on the modification date is added to it.
+        """
+        super(Mirror, self).__init__(client, directory, workers)
+        self.query = query
+
+    def state(self):
+        return read_json(os.path.join(self.directory, SYNC_STATE)) or {}
+
+    def sync(self):
+        """
+        Harvests the objects modified since the last sync, yields (pid,
+        harvested, error) tuples like Harvester.harvest. The stored
+        modification date is only advanced when all objects were
+        harvested, so the failed ones are tried again next time.
+        """
+        modified = self.state().get('modified')
+        query = self.query
+        if modified:
+            # the objects modified at that moment are harvested already,
+            # but their manifest is used to skip them
+            query = u'%s mDate>=%s' % (query, modified)
+
+        # the time of the server before the query is the next lower bound,
+        # so objects modified while the query runs are found next time
+        started = self._server_time()
+        # without it, the latest modification date of the results is used
+        latest = [modified]
+        def items():
+            for pid, date in self._search(query):
+                if date and (latest[0] is None or
+                             parse_date(date) > parse_date(latest[0])):
+                    latest[0] = date
+                yield pid, date
+
+        failed = False
+        for item, result, error in imap_unordered(self._harvest, items(),
+                                                  self.workers):
+            if error is not None:
+                failed = True
+            yield item[0], result, error
+
+        mark = started or latest[0]
+        if not failed and mark != modified:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            write_json(os.path.join(self.directory, SYNC_STATE),
+                       {'modified': mark})
+
+    def _server_time(self):
+        """
+        The time of the server from the Date header of a response, like
+        the dates of Fedora, or None when it is not known
+        """
+        response = self.client.api.connection.open('/describe?xml=true')
+        date = response.getheader('date')
+        response.read()
+        response.close()
+        parsed = date and parsedate_tz(date)
+        if not parsed:
+            return None
+        return time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                             time.gmtime(mktime_tz(parsed)))
+
+def parse_date(date):
+    """
+    Parses a date from Fedora, like 2010-11-04T12:00:00.123Z, of which
+    the milliseconds can have fewer digits or be left out. Returns None
+    for dates that can not be parsed.
+    """
+    match = date and FEDORA_DATE.match(date)
+    if not match:
+        return None
+    fields = [int(field) for field in match.groups()[:6]]
+    fraction = match.group(7) or ''
+    fields.append(int(fraction[:6].ljust(6, '0')))
+    try:
+        return datetime.datetime(*fields)
+    except ValueError:
+        return None
+
+def same_date(date, other):
+    """
+    Whether two dates from Fedora are the same moment, dates that are
+    missing or can not be parsed are never the same
+    """
+    parsed = parse_date(date)
+    return parsed is not None and parsed == parse_date(other)
+
+def read_json(path):
+    """
+    Returns the data of a JSON file, or None when it does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    f = open(path, 'rb')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def write_json(path, data):
+    """
+    Writes a JSON file, a complete file replaces the old one
+    """
+    f = open(path + '.tmp', 'wb')
+    try:
+        json.dump(data, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    replace(path + '.tmp', path)
+
+def replace(source, target):
+    if os.path.exists(target) and os.name == 'nt':
+        # rename does not replace files on windows
+        os.remove(target)
+    os.rename(source, target)
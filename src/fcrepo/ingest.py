@@ -0,0 +1,412 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import os
+import re
+import time
+import hashlib
+import threading
+import Queue
+
+from fcrepo.connection import APIException, FedoraConnectionException
+from fcrepo.connection import ChecksumMismatchException, CircuitOpenException
+from fcrepo.connection import CONNECTION_ERRORS
+from fcrepo.foxml import FOXMLBuilder
+from fcrepo.pid import PIDAllocator
+
+STAGES = ('allocate', 'build', 'upload', 'verify')
+
+_STOP = object()
+
+# seconds between checks whether the ingest has been stopped
+POLL_INTERVAL = 0.5
+
+# the characters escaped in the fields of journal lines
+JOURNAL_ESCAPES = {u'\\': u'\\', u'\t': u't', u'\n': u'n', u'\r': u'r'}
+JOURNAL_UNESCAPES = dict([(v, k) for k, v in JOURNAL_ESCAPES.items()])
+
+class IngestVerificationError(APIException):
+    """ An ingested object differs from its specification """
+    pass
+
+class ObjectExistsError(APIException):
+    """ The PID of an object to ingest is in use already """
+    pass
+
+class IngestItem(object):
+    """
+    An object specification on its way through the pipeline
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.key = spec.get('key', spec.get('pid'))
+        self.pid = spec.get('pid')
+        self.foxml = None
+        self.uploads = []
+        self.ingested = False
+        self.uploaded = set()
+        self.attempts = 0
+        # the error of the previous attempt of the current stage
+        self.last_error = None
+        self.started = time.time()
+
+class IngestStats(object):
+    """
+    Counters of a bulk ingest, safe to read while it runs
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.stage_count = dict([(stage, 0) for stage in STAGES])
+        self.stage_seconds = dict([(stage, 0.0) for stage in STAGES])
+        self.total_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + amount)
+        finally:
+            self._lock.release()
+
+    def add_stage(self, stage, seconds):
+        self._lock.acquire()
+        try:
+            self.stage_count[stage] += 1
+            self.stage_seconds[stage] += seconds
+        finally:
+            self._lock.release()
+
+    def throughput(self):
+        """
+        Completed objects per second
+        """
+        return self.completed / max(time.time() - self.started, 0.001)
+
+    def latency(self, stage=None):
+        """
+        The average number of seconds an object spends in a stage, or in
+        the whole pipeline, including the retries.
+        """
+        if stage is None:
+            return self.total_seconds / max(self.completed, 1)
+        return self.stage_seconds[stage] / max(self.stage_count[stage], 1)
+
+class IngestJournal(object):
+    """
+    A file with the keys and PIDs of the ingested objects, one per line,
+    used to skip them when an ingest is started again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                for line in f:
+                    if not line.endswith('\n'):
+                        # written partially when the process was killed
+                        continue
+                    key, pid = line.rstrip('\n').decode('utf8').split(u'\t')
+                    self.done[unescape_field(key)] = unescape_field(pid)
+            finally:
+                f.close()
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def add(self, key, pid):
+        line = u'%s\t%s\n' % (escape_field(key), escape_field(pid))
+        self._lock.acquire()
+        try:
+            self.done[key] = pid
+            self._file.write(line.encode('utf8'))
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._file.close()
+
+def escape_field(value):
+    """
+    Escapes the tabs and line ends of a field of a journal line
+    """
+    return re.sub(u'[\\\\\t\n\r]',
+                  lambda match: u'\\' + JOURNAL_ESCAPES[match.group()],
+                  unicode(value))
+
+def unescape_field(value):
+    return re.sub(u'\\\\(.)',
+                  lambda match: JOURNAL_UNESCAPES.get(match.group(1),
+                                                      match.group(1)),
+                  value)
+
+class BulkIngest(object):
+    """
+    Ingests a large number of objects concurrently. Every object passes
+    through the stages of a pipeline, each stage has a number of worker
+    threads and a bounded queue of objects waiting for it:
+
+      allocate -- a PID is reserved, unless the specification has one
+
+      build -- the FOXML document is built, with DC, RELS-EXT, inline XML
+             and managed content given as a string
+
+      upload -- the object is ingested, managed content from files is
+             streamed to Fedora afterwards and its checksum verified
+
+      verify -- the datastreams of the object are compared with the
+             specification
+
+    Objects are specified by dicts, with an optional `pid` or else a
+    `namespace`, `label`, `state`, `ownerId`, `dc` (a dict of lists of
+    values), `relations` (a dict of predicates like RELSEXTDatastream)
+    and `datastreams`, a list of dicts with the `dsid`, either `content`,
+    `filename` or `location`, and the other arguments of
+    FOXMLBuilder.addDatastream. A `key` identifies the object in the
+    journal, the pid is used when it's missing.
+
+    A stage that fails is retried with an exponential backoff when the
+    error is a server or network error, or the circuit breaker of the
+    connection is open. An object of which the PID exists already fails
+    with an ObjectExistsError right away.
+    """
+    def __init__(self, client, workers=None, queuesize=100, retries=3,
+                 backoff=1.0, journal=None, allocator=None):
+        """
+         workers -- A dict with the number of workers for stages,
+                by default there is one allocate and two build and
+                verify workers, and the upload workers use the rest of
+                the connection pool.
+
+         queuesize -- The number of objects that can wait for a stage.
+
+         journal -- Path of the journal file, objects in it are skipped.
+        """
+        if client.api.connection.pool is None:
+            raise ValueError('Bulk ingest needs a connection with a pool')
+        self.client = client
+        self.workers = {'allocate': 1,
+                        'build': 2,
+                        'upload': max(client.api.connection.pool.maxsize - 3,
+                                      1),
+                        'verify': 2}
+        self.workers.update(workers or {})
+        self.queuesize = queuesize
+        self.retries = retries
+        self.backoff = backoff
+        self.journal = journal and IngestJournal(journal)
+        self.allocator = allocator or PIDAllocator(client)
+        self.stats = IngestStats()
+
+    def run(self, specs):
+        """
+        Ingests the objects of the specs iterable, which is consumed
+        only as fast as the objects are ingested. Yields (spec, pid,
+        error) tuples in order of completion, error is the exception
+        that made the ingest of the object fail or None. Objects in the
+        journal are skipped and not yielded.
+        """
+        queues = [Queue.Queue(self.queuesize) for stage in STAGES]
+        results = Queue.Queue(self.queuesize)
+        stopped = threading.Event()
+
+        for index, stage in enumerate(STAGES):
+            if index + 1 < len(STAGES):
+                output = queues[index + 1]
+            else:
+                output = results
+            for i in range(self.workers[stage]):
+                thread = threading.Thread(target=self._work,
+                                          args=(stage, queues[index], output,
+                                                results, stopped))
+                thread.daemon = True
+                thread.start()
+
+        fed = [0]
+        def feed():
+            try:
+                for spec in specs:
+                    if stopped.isSet():
+                        break
+                    item = IngestItem(spec)
+                    if self.journal is not None and item.key in self.journal:
+                        self.stats.add('skipped')
+                        continue
+                    fed[0] += 1
+                    self._put(queues[0], item, stopped)
+            finally:
+                self._put(results, _STOP, stopped)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        received = 0
+        feeding = True
+        try:
+            while feeding or received < fed[0]:
+                item = results.get()
+                if item is _STOP:
+                    feeding = False
+                    continue
+                received += 1
+                yield item.spec, item.pid, getattr(item, 'error', None)
+        finally:
+            # also reached when the consumer stops iterating early, the
+            # workers and the feeder stop within the polling interval
+            stopped.set()
+
+    def _put(self, queue, item, stopped):
+        while not stopped.isSet():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+            except Queue.Full:
+                continue
+            return
+
+    def _work(self, stage, input, output, results, stopped):
+        handler = getattr(self, '_%s' % stage)
+        while not stopped.isSet():
+            try:
+                item = input.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            started = time.time()
+            try:
+                self._attempt(handler, item)
+            except Exception, e:
+                item.error = e
+                self.stats.add('failed')
+                self.stats.add_stage(stage, time.time() - started)
+                self._put(results, item, stopped)
+                continue
+            self.stats.add_stage(stage, time.time() - started)
+            if output is results:
+                self._complete(item)
+            self._put(output, item, stopped)
+
+    def _attempt(self, handler, item):
+        attempt = 0
+        item.last_error = None
+        while True:
+            try:
+                return handler(item)
+            except Exception, e:
+                if attempt >= self.retries or not self._retryable(e):
+                    raise
+                item.last_error = e
+            self.stats.add('retries')
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+            item.attempts += 1
+
+    def _retryable(self, error):
+        if isinstance(error, FedoraConnectionException):
+            return error.httpcode >= 500
+        return isinstance(error, CONNECTION_ERRORS + (
+            ChecksumMismatchException, CircuitOpenException))
+
+    def _complete(self, item):
+        self.stats.add('completed')
+        self.stats.add('total_seconds', time.time() - item.started)
+        if self.journal is not None and item.key is not None:
+            self.journal.add(item.key, item.pid)
+
+    def _allocate(self, item):
+        if item.pid is None:
+            item.pid = self.allocator.allocate(item.spec['namespace'])
+        if item.key is None:
+            item.key = item.pid
+
+    def _build(self, item):
+        spec = item.spec
+        foxml = FOXMLBuilder(item.pid, spec.get('label', u''),
+                             spec.get('state', u'A'), spec.get('ownerId'))
+        if spec.get('dc'):
+            foxml.setDC(spec['dc'])
+        if spec.get('relations'):
+            foxml.setRelations(spec['relations'])
+        for ds in spec.get('datastreams', ()):
+            params = dict(ds)
+            dsid = params.pop('dsid')
+            if 'filename' in params:
+                item.uploads.append((dsid, params))
+                continue
+            content = params.get('content')
+            if (params.get('controlGroup') == u'M' and content is not None
+                and not params.get('checksumType')):
+                # Fedora verifies the checksum of the decoded content
+                params['checksumType'] = u'MD5'
+                params['checksum'] = unicode(hashlib.md5(content).hexdigest())
+            foxml.addDatastream(dsid, **params)
+        item.foxml = foxml
+
+    def _upload(self, item):
+        if not item.ingested:
+            try:
+                self.client.ingest(item.foxml)
+            except FedoraConnectionException, e:
+                # the object may have been created by an attempt of which
+                # the response got lost, but not by an attempt that got
+                # an error response
+                lost = isinstance(item.last_error, CONNECTION_ERRORS)
+                if not lost and e.httpcode != 500:
+                    raise
+                if not self._exists(item.pid):
+                    raise
+                if not lost:
+                    # Fedora answers an existing PID with a 500, which
+                    # is not worth retrying
+                    raise ObjectExistsError(u'Object %s exists already' %
+                                            item.pid)
+            item.ingested = True
+        for dsid, params in item.uploads:
+            if dsid in item.uploaded:
+                continue
+            params = dict(params)
+            filename = params.pop('filename')
+            params.setdefault('controlGroup', u'M')
+            if 'label' in params:
+                params['dsLabel'] = params.pop('label')
+            if 'state' in params:
+                params['dsState'] = params.pop('state')
+            if (item.last_error is not None and
+                dsid in self._datastreams(item.pid)):
+                # added by an attempt of which the response got lost, or
+                # of which the checksum did not match
+                self.client.deleteDatastream(item.pid, dsid)
+            self.client.addDatastream(item.pid, dsid, filename=filename,
+                                      **params)
+            item.uploaded.add(dsid)
+
+    def _verify(self, item):
+        expected = set([dsid for dsid, params in item.uploads])
+        expected.update([ds.get('ID') for ds in item.foxml.datastreams])
+        missing = expected - set(self._datastreams(item.pid))
+        if missing:
+            raise IngestVerificationError(
+                'Datastreams %s of %s are missing' % (
+                    ', '.join(sorted(missing)), item.pid))
+
+    def _exists(self, pid):
+        try:
+            self.client.getObjectProfile(pid)
+        except FedoraConnectionException, e:
+            if e.httpcode == 404:
+                return False
+            raise
+        return True
+
+    def _datastreams(self, pid):
+        return self.client.listDatastreams(pid)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
@@ -0,0 +1,188 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import threading
+from collections import defaultdict
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+TIMINGS = ('wait', 'dns', 'connect', 'ttfb', 'total')
+
+class Histogram(object):
+    """
+    Counts observations in buckets, cumulative like Prometheus histograms
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def buckets(self):
+        """
+        Returns (upper bound, count) tuples, the last bound is infinity
+        """
+        return zip(self.bounds, self.counts) + [(float('inf'), self.count)]
+
+    def mean(self):
+        return self.sum / max(self.count, 1)
+
+class Metrics(object):
+    """
+    A hook for Connection.hooks, which keeps histograms of the timings
+    and counters of the requests and bytes per WADL method:
+
+      metrics = Metrics()
+      connection.hooks.append(metrics)
+
+    Requests that are not made by WADL methods are counted by their HTTP
+    method. The numbers can be exported for StatsD or Prometheus.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.timings = {}
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(int)
+        self.bytes_sent = defaultdict(int)
+        self.bytes_received = defaultdict(int)
+        # the counts at the last StatsD export
+        self._exported = {}
+        self._lock = threading.Lock()
+
+    def before_request(self, info):
+        pass
+
+    def after_request(self, info):
+        key = info.method_id or info.method
+        self._lock.acquire()
+        try:
+            self.requests[key] += 1
+            if info.error is not None:
+                self.errors[key] += 1
+            if info.status is not None:
+                self.statuses[(key, info.status)] += 1
+            self.bytes_sent[key] += info.bytes_sent
+            self.bytes_received[key] += info.bytes_received
+            for name in TIMINGS:
+                value = getattr(info, name)
+                if value is None:
+                    continue
+                histogram = self.timings.get((key, name))
+                if histogram is None:
+                    histogram = Histogram(self.buckets)
+                    self.timings[(key, name)] = histogram
+                histogram.observe(value)
+        finally:
+            self._lock.release()
+
+    def histogram(self, key, name='total'):
+        """
+        Returns the Histogram of a timing of a method, or None
+        """
+        return self.timings.get((key, name))
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.timings.clear()
+            for counter in (self.requests, self.errors, self.statuses,
+                            self.bytes_sent, self.bytes_received):
+                counter.clear()
+            self._exported.clear()
+        finally:
+            self._lock.release()
+
+    def statsd(self, prefix='fcrepo'):
+        """
+        Returns StatsD lines of the counters and the mean timings in
+        milliseconds since the previous call, StatsD adds up the counts
+        it is sent.
+        """
+        lines = []
+        counts = []
+        self._lock.acquire()
+        try:
+            for metric, counter in (('requests', self.requests),
+                                    ('errors', self.errors),
+                                    ('status', self.statuses),
+                                    ('bytes_sent', self.bytes_sent),
+                                    ('bytes_received', self.bytes_received)):
+                for key, count in sorted(counter.items()):
+                    if metric == 'status':
+                        key, status = key
+                        name = '%s.%s.status.%s' % (prefix, key, status)
+                    else:
+                        name = '%s.%s.%s' % (prefix, key, metric)
+                    counts.append((name, count))
+            for name, count in counts:
+                delta = count - self._exported.get(name, 0)
+                self._exported[name] = count
+                if delta:
+                    lines.append('%s:%d|c' % (name, delta))
+            for (key, timing), histogram in sorted(self.timings.items()):
+                name = '%s.%s.%s' % (prefix, key, timing)
+                count, total = self._exported.get(name, (0, 0.0))
+                self._exported[name] = (histogram.count, histogram.sum)
+                if histogram.count > count:
+                    mean = (histogram.sum - total) / (histogram.count - count)
+                    lines.append('%s:%.3f|ms' % (name, mean * 1000))
+        finally:
+            self._lock.release()
+        return lines
+
+    def prometheus(self, prefix='fcrepo'):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        self._lock.acquire()
+        try:
+            counters = (('requests_total', self.requests),
+                        ('errors_total', self.errors),
+                        ('sent_bytes_total', self.bytes_sent),
+                        ('received_bytes_total', self.bytes_received))
+            for name, counter in counters:
+                lines.append('# TYPE %s_%s counter' % (prefix, name))
+                for key, count in sorted(counter.items()):
+                    lines.append('%s_%s{method="%s"} %d' % (prefix, name,
+                                                            key, count))
+            lines.append('# TYPE %s_responses_total counter' % prefix)
+            for (key, status), count in sorted(self.statuses.items()):
+                lines.append(
+                    '%s_responses_total{method="%s",status="%s"} %d' % (
+                        prefix, key, status, count))
+            for name in TIMINGS:
+                metric = '%s_%s_seconds' % (prefix, name)
+                lines.append('# TYPE %s histogram' % metric)
+                for (key, timing), histogram in sorted(self.timings.items()):
+                    if timing != name:
+                        continue
+                    for bound, count in histogram.buckets():
+                        if bound == float('inf'):
+                            le = '+Inf'
+                        else:
+                            le = repr(bound)
+                        lines.append('%s_bucket{method="%s",le="%s"} %d' % (
+                            metric, key, le, count))
+                    lines.append('%s_sum{method="%s"} %r' % (
+                        metric, key, histogram.sum))
+                    lines.append('%s_count{method="%s"} %d' % (
+                        metric, key, histogram.count))
+        finally:
+            self._lock.release()
+        return lines
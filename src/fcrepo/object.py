@@ -1,37 +1,65 @@
 # Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
 # See also LICENSE.txt
 
+from fcrepo.batch import BatchedProperties
 from fcrepo.datastream import FedoraDatastream, RELSEXTDatastream, DCDatastream
 
-class FedoraObject(object):
-    def __init__(self, pid, client):
+# only the modification date changes when properties are saved
+VOLATILE_PROPERTIES = ('lastModifiedDate',)
+
+class FedoraObject(BatchedProperties):
+    _kind = u'object'
+    _volatile = VOLATILE_PROPERTIES
+
+    def __init__(self, pid, client, profile=None):
+        """
+        The object profile is fetched when a property is first read.
+        A profile with the properties that are already known, for example
+        from search results, can be given to avoid fetching it at all.
+        """
         self.pid = pid
         self.client = client
-        self._info = self.client.getObjectProfile(self.pid)
+        self._info = dict(profile or {})
+        self._loaded = False
+        self._pending = {}
+        self._batches = 0
         self._dsids = None # load lazy
+        self._ds_profiles = {}
         self._methods = None
         self._ds_cache = {}
-        
-    def _setProperty(self, name, value):
-        msg = u'Changed %s object property' % name
-        kwargs = {name: value, 'logMessage': msg}
-        self.client.updateObject(self.pid, **kwargs)
+
+    def _load(self):
         self._info = self.client.getObjectProfile(self.pid)
+        self._loaded = True
+
+    def _get(self, name):
+        if name in self._pending:
+            return self._pending[name]
+        if name not in self._info and not self._loaded:
+            self._load()
+        return self._info[name]
+        
+    def _save(self, properties, logMessage):
+        self.client.updateObject(self.pid, logMessage=logMessage,
+                                 **properties)
 
-    label = property(lambda self: self._info['label'],
+    label = property(lambda self: self._get('label'),
                      lambda self, value: self._setProperty('label', value))
-    ownerId = property(lambda self: self._info['ownerId'],
+    ownerId = property(lambda self: self._get('ownerId'),
                        lambda self, value: self._setProperty('ownerId', value))
-    state = property(lambda self: self._info['state'],
+    state = property(lambda self: self._get('state'),
                            lambda self, value: self._setProperty('state',
                                                                  value))
     # read only
-    createdDate = property(lambda self: self._info['createdDate'])
-    lastModifiedDate = property(lambda self: self._info['lastModifiedDate'])
+    createdDate = property(lambda self: self._get('createdDate'))
+    lastModifiedDate = property(lambda self: self._get('lastModifiedDate'))
 
     def datastreams(self):
         if self._dsids is None:
-            self._dsids = self.client.listDatastreams(self.pid)
+            listing = self.client.listDatastreams(self.pid, profiles=True)
+            self._dsids = [dsid for dsid, profile in listing]
+            # the listing includes some properties of every datastream
+            self._ds_profiles = dict(listing)
         return self._dsids
 
     def __iter__(self):
@@ -44,12 +72,13 @@ class FedoraObject(object):
         ds = self._ds_cache.get(dsid)
         if not ds is None:
             return ds
-        elif dsid == 'DC':
-            ds = DCDatastream(dsid, self)
+        profile = self._ds_profiles.get(dsid)
+        if dsid == 'DC':
+            ds = DCDatastream(dsid, self, profile)
         elif dsid == 'RELS-EXT':
-            ds = RELSEXTDatastream(dsid, self)
+            ds = RELSEXTDatastream(dsid, self, profile)
         else:
-            ds = FedoraDatastream(dsid, self)
+            ds = FedoraDatastream(dsid, self, profile)
         self._ds_cache[dsid] = ds
         return ds
 
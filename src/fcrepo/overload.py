@@ -0,0 +1,227 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import time
+import logging
+import threading
+from collections import deque
+
+from fcrepo.connection import CircuitOpenException
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+def failed(info):
+    """
+    Whether a request failed in a way that shows the server is in trouble
+    """
+    return info.error is not None or (info.status is not None and
+                                      info.status >= 500)
+
+def latency(info):
+    """
+    The seconds the server took to respond to the last attempt of a
+    request. The time it waited in a limiter, for a pooled connection or
+    between retries is not included, as it says nothing about the server.
+    """
+    if info.sent_at is None:
+        # failed before it was sent
+        return 0.0
+    if info.responded is not None:
+        # the time to the first byte does not depend on the size of
+        # the body
+        return info.responded - info.sent_at
+    return info.finished - info.sent_at
+
+class CircuitBreaker(object):
+    """
+    A hook for Connection.hooks which stops sending requests to a server
+    that is failing or overloaded, so it gets a chance to recover and the
+    clients fail fast instead of waiting for it.
+
+    The breaker trips open when too many of the recent requests failed,
+    or were slow. While it is open requests raise a CircuitOpenException
+    without being sent. After reset_timeout seconds a single request is
+    let through, when it succeeds the breaker closes again, otherwise it
+    stays open for another reset_timeout.
+
+    The outcome of a request is known when its response headers arrive,
+    the response does not have to be read or closed for that.
+    """
+    def __init__(self, window=20, minimum=10, error_ratio=0.5,
+                 slow_time=5.0, slow_ratio=0.8, reset_timeout=30.0):
+        """
+         window -- The number of recent requests of which the outcomes
+                are kept, at least minimum are needed to trip.
+
+         error_ratio -- Trip when this ratio of the recent requests got
+                an error or a 5xx response.
+
+         slow_ratio -- Trip when this ratio of the recent requests took
+                longer than slow_time seconds to respond.
+        """
+        self.window = window
+        self.minimum = minimum
+        self.error_ratio = error_ratio
+        self.slow_time = slow_time
+        self.slow_ratio = slow_ratio
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.opened = None
+        self.trips = 0
+        self.rejected = 0
+        self._outcomes = deque()
+        self._probe = None
+        self._lock = threading.Lock()
+
+    def before_request(self, info):
+        self._lock.acquire()
+        try:
+            if self.state == CLOSED:
+                return
+            if (self._probe is None and
+                time.time() - self.opened >= self.reset_timeout):
+                self.state = HALF_OPEN
+                self._probe = info
+                return
+            self.rejected += 1
+        finally:
+            self._lock.release()
+        raise CircuitOpenException(
+            'The circuit breaker is open since %s' % time.ctime(self.opened))
+
+    def after_response(self, info):
+        self._outcome(info)
+
+    def after_request(self, info):
+        if not info.handed_over:
+            # failed, or refused, before there was a response
+            self._outcome(info)
+
+    def _outcome(self, info):
+        error = failed(info)
+        slow = not error and latency(info) > self.slow_time
+        self._lock.acquire()
+        try:
+            if info is self._probe:
+                self._probe = None
+                if error or slow:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self.state != CLOSED:
+                # finished while the breaker tripped
+                return
+            self._outcomes.append((error, slow))
+            if len(self._outcomes) > self.window:
+                self._outcomes.popleft()
+            if len(self._outcomes) < self.minimum:
+                return
+            errors = len([o for o in self._outcomes if o[0]])
+            slows = len([o for o in self._outcomes if o[1]])
+            if (errors >= self.error_ratio * len(self._outcomes) or
+                slows >= self.slow_ratio * len(self._outcomes)):
+                self._open()
+        finally:
+            self._lock.release()
+
+    def _open(self):
+        if self.state != OPEN:
+            logging.warning('Circuit breaker opened')
+            self.trips += 1
+        self.state = OPEN
+        self.opened = time.time()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.state = CLOSED
+            self.opened = None
+            self._probe = None
+            self._outcomes.clear()
+        finally:
+            self._lock.release()
+
+class ConcurrencyLimiter(object):
+    """
+    A hook for Connection.hooks which limits the number of requests in
+    flight, requests over the limit wait until another one is finished.
+
+    The limit adapts to the server with additive increase, multiplicative
+    decrease: it grows by one when as many requests as the limit succeeded
+    in time, and is multiplied by decrease when a request fails or its
+    latency exceeds the target. Without a target latency, the target is
+    tolerance times the lowest latency of the recent requests.
+
+    A request is in flight until its response headers arrive, a response
+    that is read slowly, or left unread, does not hold a slot.
+    """
+    def __init__(self, limit=4, minimum=2, maximum=64, latency=None,
+                 tolerance=2.0, decrease=0.5, window=100):
+        self.limit = float(limit)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency = latency
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.window = window
+        self.inflight = 0
+        self._latencies = deque()
+        self._decreased = 0
+        self._cond = threading.Condition()
+
+    def before_request(self, info):
+        self._cond.acquire()
+        try:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+        finally:
+            self._cond.release()
+
+    def after_response(self, info):
+        self._outcome(info)
+
+    def after_request(self, info):
+        if not info.handed_over:
+            self._outcome(info)
+
+    def _outcome(self, info):
+        if isinstance(info.error, CircuitOpenException):
+            # refused by a breaker, the request did not reach the server
+            self._release()
+            return
+        seconds = latency(info)
+        self._cond.acquire()
+        try:
+            self._latencies.append(seconds)
+            if len(self._latencies) > self.window:
+                self._latencies.popleft()
+            target = self.latency
+            if target is None:
+                target = self.tolerance * min(self._latencies)
+            if failed(info) or seconds > target:
+                # one decrease for the requests that were in flight
+                # together, they likely suffered from the same overload
+                if time.time() - self._decreased > seconds:
+                    self.limit = max(self.limit * self.decrease,
+                                     self.minimum)
+                    self._decreased = time.time()
+            elif self.inflight >= int(self.limit):
+                # only grow when the limit is reached, otherwise it says
+                # nothing about whether the server can take more
+                self.limit = min(self.limit + 1.0 / self.limit, self.maximum)
+        finally:
+            self._cond.release()
+        self._release()
+
+    def _release(self):
+        self._cond.acquire()
+        try:
+            self.inflight -= 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
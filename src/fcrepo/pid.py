@@ -0,0 +1,122 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import time
+import logging
+import threading
+from collections import deque
+
+class PIDBlock(object):
+    """
+    The reserved PIDs of a single namespace
+    """
+    def __init__(self, namespace, blocksize):
+        self.namespace = namespace
+        self.blocksize = blocksize
+        self.pids = deque()
+        self.lock = threading.Lock()
+        self.refilling = False
+        self.filled = None
+        self.stock = 0
+
+class PIDAllocator(object):
+    """
+    Hands out PIDs from blocks that are reserved with a single getNextPID
+    call. When the number of reserved PIDs of a namespace drops below
+    the low water mark, the next block is reserved in a background
+    thread, so allocating a PID rarely waits for Fedora.
+
+    The size of the blocks adapts to the rate at which PIDs are used, a
+    block should last about `interval` seconds. Background reservation
+    needs a connection with a pool, without one the blocks are reserved
+    when they are empty.
+
+    PIDs that have been reserved but are not used are lost, Fedora does
+    not hand them out again.
+    """
+    def __init__(self, client, blocksize=10, minsize=10, maxsize=1000,
+                 interval=10.0, lowwater=0.5):
+        self.client = client
+        self.blocksize = blocksize
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.interval = interval
+        self.lowwater = lowwater
+        self.background = client.api.connection.pool is not None
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def allocate(self, namespace):
+        """
+        Returns a new PID in namespace
+        """
+        block = self._blocks.get(namespace)
+        if block is None:
+            block = self._block(namespace)
+        while True:
+            try:
+                # popleft is atomic, no lock is needed
+                pid = block.pids.popleft()
+            except IndexError:
+                self._fill(block)
+                continue
+            if (self.background and not block.refilling and
+                len(block.pids) < block.blocksize * self.lowwater):
+                self._refill(block)
+            return pid
+
+    def _block(self, namespace):
+        self._lock.acquire()
+        try:
+            block = self._blocks.get(namespace)
+            if block is None:
+                block = PIDBlock(namespace, self.blocksize)
+                self._blocks[namespace] = block
+            return block
+        finally:
+            self._lock.release()
+
+    def _fill(self, block, refill=False):
+        block.lock.acquire()
+        try:
+            if block.pids and not refill:
+                # filled by another thread in the meantime
+                return
+            now = time.time()
+            if block.filled is not None:
+                used = block.stock - len(block.pids)
+                elapsed = max(now - block.filled, 0.001)
+                size = int(used / elapsed * self.interval)
+                block.blocksize = max(self.minsize, min(self.maxsize, size))
+            pids = self.client.getNextPID(block.namespace,
+                                          numPIDs=block.blocksize)
+            if not isinstance(pids, list):
+                pids = [pids]
+            block.pids.extend(pids)
+            block.filled = now
+            block.stock = len(block.pids)
+        finally:
+            block.lock.release()
+
+    def _refill(self, block):
+        block.lock.acquire()
+        try:
+            if block.refilling:
+                return
+            block.refilling = True
+        finally:
+            block.lock.release()
+
+        def refill():
+            try:
+                self._fill(block, refill=True)
+            except Exception:
+                # allocate reserves the block itself when it's empty,
+                # and raises the error then
+                logging.exception('Could not reserve PIDs in %s' %
+                                  block.namespace)
+            block.refilling = False
+
+        thread = threading.Thread(target=refill)
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,94 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+"""
+Micro benchmark of the WADL request construction cost, no Fedora server
+is needed. Run it with:
+
+   python -m fcrepo.tests.bench_wadl
+
+For comparison it also times the document wide XPath queries which
+were run for every request before the method table was compiled.
+"""
+import timeit
+import StringIO
+
+from lxml import etree
+
+from fcrepo.wadl import API, NSMAP
+
+RESOURCE = """
+<resource path="res%(n)s">
+ <method name="GET" id="get%(n)s">
+  <request>
+   <param name="format" style="query" type="xs:string" default="html"/>
+   <param name="asOfDateTime" style="query" type="xs:string"/>
+   <param name="validate" style="query" type="xs:boolean"/>
+  </request>
+ </method>
+ <resource path="{pid}">
+  <method name="PUT" id="put%(n)s">
+   <request>
+    <param name="label" style="query" type="xs:string"/>
+    <param name="maxResults" style="query" type="xs:int" default="25"/>
+    <param name="logMessage" style="query" type="xs:string"/>
+   </request>
+  </method>
+ </resource>
+</resource>"""
+
+# roughly the size of the WADL file shipped with Fedora 3.4
+WADL = """<application xmlns="http://research.sun.com/wadl/2006/10">
+<resources base="http://localhost:8080/fedora/">
+<resource path="objects">%s</resource>
+</resources>
+</application>""" % ''.join([RESOURCE % {'n': n} for n in range(20)])
+
+
+class DummyResponse(StringIO.StringIO):
+    status = 200
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class DummyConnection(object):
+    url = 'http://localhost:8080/fedora'
+    form_headers = {'Authorization': 'Basic Zm9vOmJhcg=='}
+
+    def open(self, url, body='', headers=None, method='GET'):
+        return DummyResponse(WADL)
+
+
+def xpath_request(doc, method_id, url):
+    """
+    Builds the URL and finds the params of a method the way it was done
+    for every request before 1.2, only the URL template was kept
+    """
+    param_types = {}
+    default_values = {}
+    for param in doc.xpath(
+        '//wadl:method[@id="%s"]/wadl:request/wadl:param' % method_id,
+        namespaces=NSMAP):
+        name = param.attrib['name']
+        param_types[name] = {'xs:int': int,
+                             'xs:boolean': bool,
+                             'xs:string': unicode}[param.attrib['type']]
+        default_value = param.attrib.get('default')
+        if default_value:
+            default_values[name] = default_value
+    return url % {'pid': u'foo:1'}, param_types, default_values
+
+def best_usec(func, number):
+    best = min(timeit.Timer(func).repeat(3, number))
+    return best / number * 1000000
+
+def main(number=10000):
+    api = API(DummyConnection())
+    doc = etree.fromstring(WADL)
+    print 'request construction: %.1f usec per request' % best_usec(
+        lambda: api.put19(pid=u'foo:1'), number)
+    print 'XPath queries per request: %.1f usec per request' % best_usec(
+        lambda: xpath_request(doc, 'put19', api.put19.url), number // 10)
+
+if __name__ == '__main__':
+    main()
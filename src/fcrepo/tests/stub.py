@@ -0,0 +1,146 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+"""
+A HTTP server on localhost for the tests of the transport, which answers
+with the responses a test queued and records the requests it gets.
+"""
+import sys
+import time
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+
+class StubRequest(object):
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keeps the connection open between requests
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stub.connected()
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            blocks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    # the trailer ends with an empty line
+                    while self.rfile.readline().strip():
+                        pass
+                    return ''.join(blocks)
+                blocks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('content-length') or 0)
+        return self.rfile.read(length)
+
+    def answer(self):
+        stub = self.server.stub
+        request = StubRequest(self.command, self.path,
+                              dict(self.headers.items()), self.read_body())
+        status, headers, body, delay = stub.next_response(request)
+        try:
+            if delay:
+                time.sleep(delay)
+        finally:
+            stub.answered()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if isinstance(body, list):
+            # sent chunked, in these blocks
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for block in body:
+                self.wfile.write('%x\r\n%s\r\n' % (len(block), block))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = answer
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # a client that closes a response it did not read resets the
+        # connection, which the tests do on purpose
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+class StubServer(object):
+    """
+    Queue the responses with `respond`, when the queue is empty requests
+    get a 200 response with an empty body. The requests are kept in
+    `requests` and the number of accepted connections in `connections`.
+    The most requests that were handled at the same time is `peak`.
+    """
+    def __init__(self):
+        self.requests = []
+        self.connections = 0
+        self.peak = 0
+        self._active = 0
+        self._responses = []
+        self._lock = threading.Lock()
+        self._server = ThreadedHTTPServer(('127.0.0.1', 0), StubHandler)
+        self._server.stub = self
+        self.url = 'http://127.0.0.1:%s/fedora' % self._server.server_port
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    def respond(self, status=200, body='', headers=None, delay=0):
+        """
+        Queues a response, a body that is a list of strings is sent
+        chunked. The response is sent after delay seconds.
+        """
+        self._lock.acquire()
+        try:
+            self._responses.append((status, headers or {}, body, delay))
+        finally:
+            self._lock.release()
+
+    def next_response(self, request):
+        self._lock.acquire()
+        try:
+            self.requests.append(request)
+            self._active += 1
+            self.peak = max(self.peak, self._active)
+            if self._responses:
+                return self._responses.pop(0)
+            return 200, {}, '', 0
+        finally:
+            self._lock.release()
+
+    def answered(self):
+        self._lock.acquire()
+        try:
+            self._active -= 1
+        finally:
+            self._lock.release()
+
+    def connected(self):
+        self._lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
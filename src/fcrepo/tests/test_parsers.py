@@ -0,0 +1,200 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+"""
+Tests of the parsers of Fedora responses and of the ObjectCache, no
+Fedora server is needed.
+"""
+import time
+import unittest
+from StringIO import StringIO
+
+from fcrepo.utils import ntriples2dict, iter_lines
+from fcrepo.client import parse_csv_results, parse_tsv_results
+from fcrepo.client import parse_search_page, search_profile, SEARCH_NS
+from fcrepo.cache import ObjectCache
+
+class CountingFile(StringIO):
+    # records how far the file was read
+    def read(self, size=-1):
+        data = StringIO.read(self, size)
+        self.position = self.tell()
+        return data
+
+class NTriplesTests(unittest.TestCase):
+
+    def test_uri(self):
+        self.assertEqual(ntriples2dict('<info:fedora/foo:1>'),
+                         {'value': u'info:fedora/foo:1', 'type': 'uri'})
+
+    def test_bnode(self):
+        self.assertEqual(ntriples2dict('_:node1'),
+                         {'value': u'node1', 'type': 'bnode'})
+
+    def test_literal(self):
+        self.assertEqual(ntriples2dict('"A label"'),
+                         {'value': u'A label', 'type': 'literal'})
+
+    def test_escapes(self):
+        term = r'"tab\tnewline\nquote\"backslash\\"'
+        self.assertEqual(ntriples2dict(term)['value'],
+                         u'tab\tnewline\nquote"backslash\\')
+
+    def test_unicode_escapes(self):
+        self.assertEqual(ntriples2dict(r'"caf\u00e9"')['value'], u'caf\xe9')
+        # above the BMP, a surrogate pair on narrow builds
+        self.assertEqual(ntriples2dict(r'"\U0001F600"')['value'],
+                         u'\U0001F600')
+
+    def test_utf8(self):
+        self.assertEqual(ntriples2dict('"caf\xc3\xa9"')['value'], u'caf\xe9')
+
+    def test_lang(self):
+        self.assertEqual(ntriples2dict('"Hallo"@nl'),
+                         {'value': u'Hallo', 'type': 'literal',
+                          'lang': u'nl'})
+
+    def test_datatype(self):
+        term = ('"2010-11-04T12:00:00.000Z"'
+                '^^<http://www.w3.org/2001/XMLSchema#dateTime>')
+        self.assertEqual(ntriples2dict(term),
+                         {'value': u'2010-11-04T12:00:00.000Z',
+                          'type': 'literal',
+                          'datatype':
+                          u'http://www.w3.org/2001/XMLSchema#dateTime'})
+
+class ResultTests(unittest.TestCase):
+
+    def test_iter_lines(self):
+        source = StringIO('first\nsecond line\r\n\nlast')
+        self.assertEqual(list(iter_lines(source, blocksize=4)),
+                         ['first\n', 'second line\r\n', '\n', 'last'])
+
+    def test_csv(self):
+        source = StringIO('s,label\r\n'
+                          'info:fedora/foo:1,"Comma, and ""quotes"""\r\n'
+                          'info:fedora/foo:2,caf\xc3\xa9\r\n')
+        self.assertEqual(list(parse_csv_results(source)),
+                         [{'s': {'value': u'info:fedora/foo:1'},
+                           'label': {'value': u'Comma, and "quotes"'}},
+                          {'s': {'value': u'info:fedora/foo:2'},
+                           'label': {'value': u'caf\xe9'}}])
+
+    def test_tsv(self):
+        source = StringIO('?s\t?label\n'
+                          '<info:fedora/foo:1>\t"Tab\\there"@en\n'
+                          '\n'
+                          '<info:fedora/foo:2>\t"caf\\u00E9"\n')
+        self.assertEqual(list(parse_tsv_results(source)),
+                         [{'s': {'value': u'info:fedora/foo:1',
+                                 'type': 'uri'},
+                           'label': {'value': u'Tab\there',
+                                     'type': 'literal', 'lang': u'en'}},
+                          {'s': {'value': u'info:fedora/foo:2',
+                                 'type': 'uri'},
+                           'label': {'value': u'caf\xe9',
+                                     'type': 'literal'}}])
+
+    def test_results_are_streamed(self):
+        lines = ['<info:fedora/foo:%s>' % i for i in range(100000)]
+        source = CountingFile('?s\n' + '\n'.join(lines))
+        results = parse_tsv_results(source)
+        self.assertEqual(results.next()['s']['value'], u'info:fedora/foo:0')
+        self.failUnless(source.position < len(source.getvalue()))
+
+def search_page(results, token=None):
+    fields = ''.join(['<objectFields><pid>foo:%s</pid><title>%s</title>'
+                      '<title>caf\xc3\xa9</title><label>Label %s</label>'
+                      '</objectFields>' % (n, n, n) for n in range(results)])
+    session = ''
+    if token is not None:
+        session = ('<listSession><token>%s</token><cursor>0</cursor>'
+                   '</listSession>' % token)
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<result xmlns="%s">%s<resultList>%s</resultList></result>' % (
+            SEARCH_NS, session, fields))
+
+class SearchPageTests(unittest.TestCase):
+
+    def test_token_and_fields(self):
+        parsed = list(parse_search_page(StringIO(search_page(2, 'abc'))))
+        self.assertEqual(parsed[0], ('token', u'abc'))
+        self.assertEqual([kind for kind, value in parsed[1:]],
+                         ['fields', 'fields'])
+        data = parsed[1][1]
+        self.assertEqual(data['pid'], [u'foo:0'])
+        self.assertEqual(data['title'], [u'0', u'caf\xe9'])
+        self.assertEqual(search_profile(data), {'label': u'Label 0'})
+
+    def test_last_page(self):
+        parsed = list(parse_search_page(StringIO(search_page(1))))
+        self.assertEqual([kind for kind, value in parsed], ['fields'])
+
+    def test_results_are_streamed(self):
+        source = CountingFile(search_page(20000, 'abc'))
+        parsed = parse_search_page(source)
+        self.assertEqual(parsed.next(), ('token', u'abc'))
+        kind, data = parsed.next()
+        self.assertEqual(data['pid'], [u'foo:0'])
+        self.failUnless(source.position < len(source.getvalue()))
+        self.assertEqual(len(list(parsed)), 19999)
+
+class ObjectCacheTests(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = ObjectCache()
+        self.assertEqual(cache.get(('profile', 'foo:1')), None)
+        cache.set(('profile', 'foo:1'), {'label': u'Label'})
+        self.assertEqual(cache.get(('profile', 'foo:1')), {'label': u'Label'})
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 1,
+                                         'evictions': 0, 'expirations': 0})
+
+    def test_evicts_least_recently_used(self):
+        cache = ObjectCache(maxsize=3)
+        for n in range(3):
+            cache.set(('profile', 'foo:%s' % n), n)
+        # used, so foo:1 is the least recently used one
+        cache.get(('profile', 'foo:0'))
+        cache.set(('profile', 'foo:3'), 3)
+        self.assertEqual(cache.get(('profile', 'foo:1')), None)
+        for n in (0, 2, 3):
+            self.assertEqual(cache.get(('profile', 'foo:%s' % n)), n)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['size'], 3)
+
+    def test_set_again_replaces(self):
+        cache = ObjectCache(maxsize=2)
+        cache.set(('profile', 'foo:0'), 0)
+        cache.set(('profile', 'foo:1'), 1)
+        cache.set(('profile', 'foo:0'), 'new')
+        cache.set(('profile', 'foo:2'), 2)
+        self.assertEqual(cache.get(('profile', 'foo:0')), 'new')
+        self.assertEqual(cache.get(('profile', 'foo:1')), None)
+
+    def test_expires(self):
+        cache = ObjectCache(ttl=0.05)
+        cache.set(('profile', 'foo:1'), 1)
+        cache.set(('content', 'foo:1', 'DC'), 'dc', 0)
+        time.sleep(0.1)
+        self.assertEqual(cache.get(('profile', 'foo:1')), None)
+        # a ttl of 0 does not expire
+        self.assertEqual(cache.get(('content', 'foo:1', 'DC')), 'dc')
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_invalidate(self):
+        cache = ObjectCache()
+        cache.set(('profile', 'foo:1'), 1)
+        cache.set(('dsprofile', 'foo:1', 'DC'), 2)
+        cache.set(('profile', 'foo:2'), 3)
+        cache.invalidate('foo:1')
+        self.assertEqual(cache.get(('profile', 'foo:1')), None)
+        self.assertEqual(cache.get(('dsprofile', 'foo:1', 'DC')), None)
+        self.assertEqual(cache.get(('profile', 'foo:2')), 3)
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    for tests in (NTriplesTests, ResultTests, SearchPageTests,
+                  ObjectCacheTests):
+        suite.addTests(unittest.makeSuite(tests))
+    return suite
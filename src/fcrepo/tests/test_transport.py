@@ -0,0 +1,318 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+"""
+Tests of the transport against a HTTP server on localhost, no Fedora
+server is needed.
+"""
+import time
+import zlib
+import unittest
+import threading
+
+from fcrepo.connection import Connection, RetryPolicy, RetryBudget
+from fcrepo.connection import FedoraConnectionException, CircuitOpenException
+from fcrepo.connection import gzip_string, parse_retry_after
+from fcrepo.overload import CircuitBreaker, ConcurrencyLimiter
+from fcrepo.overload import CLOSED, OPEN
+from fcrepo.tests.stub import StubServer
+
+def retry_policy(**kwargs):
+    # no waiting between retries, and a budget of its own
+    kwargs.setdefault('backoff', 0.0)
+    kwargs.setdefault('jitter', False)
+    kwargs.setdefault('budget', RetryBudget())
+    return RetryPolicy(**kwargs)
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        self.server.stop()
+
+    def connect(self, **kwargs):
+        kwargs.setdefault('retry', retry_policy())
+        connection = Connection(self.server.url, **kwargs)
+        self.connections.append(connection)
+        return connection
+
+class PoolTests(TransportTestCase):
+
+    def test_reuses_connection(self):
+        connection = self.connect(pool_size=2)
+        for i in range(5):
+            self.server.respond(body='hello')
+            response = connection.open('/objects')
+            self.assertEqual(response.read(), 'hello')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests[0].path, '/fedora/objects')
+
+    def test_pool_size_limits_connections(self):
+        connection = self.connect(pool_size=2)
+        for i in range(6):
+            self.server.respond(body='slow', delay=0.1)
+        def fetch():
+            connection.open('/objects').read()
+        threads = [threading.Thread(target=fetch) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(connection.pool.size, 2)
+
+    def test_unread_response_discards_connection(self):
+        connection = self.connect(pool_size=2)
+        self.server.respond(body='x' * 1000)
+        connection.open('/objects').close()
+        self.assertEqual(connection.pool.discarded, 1)
+        self.assertEqual(connection.open('/objects').read(), '')
+        self.assertEqual(self.server.connections, 2)
+
+class BodyTests(TransportTestCase):
+
+    def test_chunked_response(self):
+        connection = self.connect()
+        self.server.respond(body=['first ', 'second ', 'third'])
+        response = connection.open('/objects')
+        self.assertEqual(response.read(), 'first second third')
+
+    def test_chunked_request_body(self):
+        connection = self.connect()
+        def body():
+            yield 'first '
+            yield ''
+            yield 'second'
+        connection.open('/objects', body(), method='POST').read()
+        request = self.server.requests[0]
+        self.assertEqual(request.headers.get('transfer-encoding'), 'chunked')
+        self.assertEqual(request.body, 'first second')
+
+    def test_list_body_has_length(self):
+        connection = self.connect()
+        connection.open('/objects', ['first ', 'second'],
+                        method='POST').read()
+        request = self.server.requests[0]
+        self.assertEqual(request.headers.get('content-length'), '12')
+        self.assertEqual(request.body, 'first second')
+
+class CompressionTests(TransportTestCase):
+    content = '<objectProfile>%s</objectProfile>' % ('<a>b</a>' * 1000)
+
+    def test_accept_encoding(self):
+        self.connect(compress=True).open('/objects').read()
+        self.connect().open('/objects').read()
+        first, second = self.server.requests
+        self.assertEqual(first.headers.get('accept-encoding'),
+                         'gzip, deflate')
+        self.assertEqual(second.headers.get('accept-encoding'), 'identity')
+
+    def test_gzip(self):
+        self.server.respond(body=gzip_string(self.content),
+                            headers={'Content-Encoding': 'gzip'})
+        response = self.connect(compress=True).open('/objects')
+        self.assertEqual(response.getheader('content-length'), None)
+        self.assertEqual(response.read(), self.content)
+
+    def test_deflate(self):
+        self.server.respond(body=zlib.compress(self.content),
+                            headers={'Content-Encoding': 'deflate'})
+        response = self.connect(compress=True).open('/objects')
+        self.assertEqual(response.read(), self.content)
+
+    def test_raw_deflate(self):
+        # some servers leave out the zlib header
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(self.content) + compressor.flush()
+        self.server.respond(body=data,
+                            headers={'Content-Encoding': 'deflate'})
+        response = self.connect(compress=True).open('/objects')
+        self.assertEqual(response.read(), self.content)
+
+    def test_read_in_blocks(self):
+        data = gzip_string(self.content)
+        self.server.respond(body=[data[:10], data[10:50], data[50:]],
+                            headers={'Content-Encoding': 'gzip'})
+        response = self.connect(compress=True).open('/objects')
+        blocks = []
+        while True:
+            block = response.read(100)
+            if not block:
+                break
+            self.failUnless(len(block) <= 100)
+            blocks.append(block)
+        self.assertEqual(''.join(blocks), self.content)
+
+    def test_compressed_request_body(self):
+        connection = self.connect(compress_bodies=100)
+        connection.open('/objects', self.content, method='POST',
+                        headers={'Content-Type': 'text/xml'}).read()
+        connection.open('/objects', 'small', method='POST',
+                        headers={'Content-Type': 'text/xml'}).read()
+        large, small = self.server.requests
+        self.assertEqual(large.headers.get('content-encoding'), 'gzip')
+        self.assertEqual(zlib.decompress(large.body, 16 + zlib.MAX_WBITS),
+                         self.content)
+        self.assertEqual(small.headers.get('content-encoding'), None)
+        self.assertEqual(small.body, 'small')
+
+class RetryTests(TransportTestCase):
+
+    def test_retries_unavailable(self):
+        self.server.respond(503)
+        self.server.respond(503)
+        self.server.respond(body='done')
+        response = self.connect().open('/objects')
+        self.assertEqual(response.read(), 'done')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up(self):
+        for i in range(3):
+            self.server.respond(503)
+        connection = self.connect(retry=retry_policy(retries=2))
+        try:
+            connection.open('/objects')
+        except FedoraConnectionException, e:
+            self.assertEqual(e.httpcode, 503)
+        else:
+            self.fail('No exception raised')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_post_is_not_retried(self):
+        self.server.respond(503)
+        connection = self.connect()
+        self.assertRaises(FedoraConnectionException, connection.open,
+                          '/objects', 'body', method='POST')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_client_error_is_not_retried(self):
+        self.server.respond(404, 'Object not found')
+        connection = self.connect()
+        try:
+            connection.open('/objects/foo:bar')
+        except FedoraConnectionException, e:
+            self.assertEqual(e.httpcode, 404)
+            self.assertEqual(e.body, 'Object not found')
+        else:
+            self.fail('No exception raised')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retry_after(self):
+        self.server.respond(503, headers={'Retry-After': '1'})
+        started = time.time()
+        response = self.connect().open('/objects')
+        self.assertEqual(response.status, 200)
+        self.failUnless(time.time() - started >= 1.0)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_retry_after_too_long(self):
+        self.server.respond(503, headers={'Retry-After': '60'})
+        connection = self.connect(retry=retry_policy(maxbackoff=10.0))
+        started = time.time()
+        self.assertRaises(FedoraConnectionException, connection.open,
+                          '/objects')
+        self.failUnless(time.time() - started < 1.0)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after('Thu, 01 Jan 1970 00:00:00 GMT'),
+                         0)
+        self.assertEqual(parse_retry_after('soon'), None)
+        future = time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                               time.gmtime(time.time() + 30))
+        self.failUnless(25 < parse_retry_after(future) <= 30)
+
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, minimum=1, window=60)
+        for i in range(4):
+            budget.request()
+        self.failUnless(budget.withdraw())
+        self.failUnless(budget.withdraw())
+        self.failIf(budget.withdraw())
+
+class LimiterTests(TransportTestCase):
+
+    def test_limits_requests_in_flight(self):
+        limiter = ConcurrencyLimiter(limit=2, maximum=2)
+        connection = self.connect(pool_size=4, limiter=limiter)
+        for i in range(6):
+            self.server.respond(body='slow', delay=0.2)
+        def fetch():
+            connection.open('/objects').read()
+        threads = [threading.Thread(target=fetch) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.server.peak, 2)
+        self.assertEqual(limiter.inflight, 0)
+
+    def test_unread_response_frees_slot(self):
+        limiter = ConcurrencyLimiter(limit=2, minimum=2, maximum=2)
+        connection = self.connect(pool_size=4, limiter=limiter)
+        responses = [connection.open('/objects') for i in range(3)]
+        self.assertEqual(limiter.inflight, 0)
+        for response in responses:
+            response.close()
+
+    def test_failures_decrease_limit(self):
+        limiter = ConcurrencyLimiter(limit=8, minimum=2)
+        connection = self.connect(limiter=limiter,
+                                  retry=retry_policy(retries=0))
+        self.server.respond(503)
+        self.assertRaises(FedoraConnectionException, connection.open,
+                          '/objects')
+        self.assertEqual(limiter.limit, 4.0)
+        self.assertEqual(limiter.inflight, 0)
+
+class BreakerTests(TransportTestCase):
+
+    def breaker(self):
+        breaker = CircuitBreaker(window=4, minimum=2, reset_timeout=0.2)
+        connection = self.connect(breaker=breaker,
+                                  retry=retry_policy(retries=0))
+        for i in range(2):
+            self.server.respond(500)
+            self.assertRaises(FedoraConnectionException, connection.open,
+                              '/objects')
+        return breaker, connection
+
+    def test_trips_and_fails_fast(self):
+        breaker, connection = self.breaker()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertRaises(CircuitOpenException, connection.open, '/objects')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(breaker.rejected, 1)
+
+    def test_probe_closes(self):
+        breaker, connection = self.breaker()
+        time.sleep(0.25)
+        # the probe is decided when its headers arrive
+        response = connection.open('/objects')
+        self.assertEqual(breaker.state, CLOSED)
+        response.close()
+        connection.open('/objects').read()
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_failed_probe_opens_again(self):
+        breaker, connection = self.breaker()
+        time.sleep(0.25)
+        self.server.respond(503)
+        self.assertRaises(FedoraConnectionException, connection.open,
+                          '/objects')
+        self.assertEqual(breaker.state, OPEN)
+        self.assertRaises(CircuitOpenException, connection.open, '/objects')
+
+def test_suite():
+    suite = unittest.TestSuite()
+    for tests in (PoolTests, BodyTests, CompressionTests, RetryTests,
+                  LimiterTests, BreakerTests):
+        suite.addTests(unittest.makeSuite(tests))
+    return suite
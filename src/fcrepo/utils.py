@@ -120,3 +120,61 @@ def rdfxml2dict(rdfxml):
                     data['datatype'] = datatype
             result[ns+tag].append(data)
     return result
+
+NTRIPLES_ESCAPES = {'t': u'\t', 'n': u'\n', 'r': u'\r', '"': u'"',
+                    '\\': u'\\'}
+
+def ntriples2dict(term):
+    """
+    Converts an RDF term in N-Triples notation, as used in TSV results of
+    the resource index, to a dict like rdfxml2dict returns.
+    """
+    if not isinstance(term, unicode):
+        term = term.decode('utf8')
+    if term.startswith(u'<') and term.endswith(u'>'):
+        return {'value': term[1:-1], 'type': 'uri'}
+    if term.startswith(u'_:'):
+        return {'value': term[2:], 'type': 'bnode'}
+    if not term.startswith(u'"'):
+        return {'value': term, 'type': 'literal'}
+    end = term.rindex(u'"')
+    value = []
+    chars = iter(term[1:end])
+    for char in chars:
+        if char != u'\\':
+            value.append(char)
+            continue
+        char = chars.next()
+        if char in u'uU':
+            digits = u''.join([chars.next()
+                               for i in range({'u': 4, 'U': 8}[char])])
+            # unichr refuses code points above the BMP on narrow builds,
+            # where the escape decodes to a surrogate pair instead
+            value.append(('\\U%08x' % int(digits, 16)).decode(
+                'unicode-escape'))
+        else:
+            value.append(NTRIPLES_ESCAPES.get(char, char))
+    data = {'value': u''.join(value), 'type': 'literal'}
+    rest = term[end + 1:]
+    if rest.startswith(u'@'):
+        data['lang'] = rest[1:]
+    elif rest.startswith(u'^^<'):
+        data['datatype'] = rest[3:-1]
+    return data
+
+def iter_lines(stream, blocksize=8192):
+    """
+    Yields the lines of a file like object, including the line endings,
+    while it is read in blocks.
+    """
+    rest = ''
+    while True:
+        block = stream.read(blocksize)
+        if not block:
+            break
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
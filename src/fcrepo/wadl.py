@@ -1,94 +1,318 @@
 # Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
 # See also LICENSE.txt
 
+import os
+import time
+import json
+import hashlib
 import urllib
+from collections import namedtuple
 
 from lxml import etree
 
+from fcrepo.connection import APIException, FedoraConnectionException
+
 NSMAP = {'wadl': 'http://research.sun.com/wadl/2006/10'}
+WADL_TYPES = {'xs:int': int,
+              'xs:boolean': bool,
+              'xs:string': unicode}
+WADL_TYPE_NAMES = dict([(v, k) for k, v in WADL_TYPES.items()])
+
+class FrozenDict(dict):
+    """
+    A dict that can not be changed, for the tables shared by all requests
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s can not be changed' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash(frozenset(self.iteritems()))
+
+# Everything needed to build a request, compiled once when the WADL file
+# is loaded and shared by all requests. The dicts are FrozenDicts.
+MethodDescriptor = namedtuple('MethodDescriptor',
+                              'id name url param_types default_values')
+
+def compile_method(method):
+    """ Compile a wadl:method element into a MethodDescriptor """
+    paths = [resource.attrib['path'] for resource in
+             method.iterancestors('{%s}resource' % NSMAP['wadl'])]
+    paths.reverse()
+    url = u'/'.join(paths)
+    url = url.replace('//', '/').replace(
+        '%', '%%').replace('{', '%(').replace('}', ')s')
+
+    # XXX hack to fix broken fedora wadl.
+    if not url.startswith('/objects'):
+        url = '/objects%s' % url
+
+    param_types = {}
+    default_values = {}
+    for param in method.iterfind('wadl:request/wadl:param',
+                                 namespaces=NSMAP):
+        name = param.attrib['name']
+        param_types[name] = WADL_TYPES[param.attrib['type']]
+        default_value = param.attrib.get('default')
+        if default_value:
+            default_values[name] = default_value
+
+    return MethodDescriptor(method.attrib['id'], method.attrib['name'], url,
+                            FrozenDict(param_types),
+                            FrozenDict(default_values))
+
+def serialize_bool(value):
+    if value:
+        return 'true'
+    return 'false'
+
+def serialize_text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+def serialize(value):
+    """ Serialize a value of any type for the query string """
+    if isinstance(value, bool):
+        return serialize_bool(value)
+    if isinstance(value, basestring):
+        return serialize_text(value)
+    return str(value)
+
+# functions that turn the params of a WADL type into query string values
+SERIALIZERS = {bool: serialize_bool,
+               int: str,
+               unicode: serialize_text}
 
 class WADLMethod(object):
-    def __init__(self, id, name, api):
-        self.id = id
+    def __init__(self, descriptor, api):
+        self.descriptor = descriptor
+        self.id = descriptor.id
+        self.name = descriptor.name
+        self.url = descriptor.url
         self.api = api
-        self.name = name
-        self.url = u'/'.join(self.api.doc.xpath(
-            '//wadl:method[@id="%s"]//ancestor::wadl:resource/@path' % self.id,
-            namespaces=NSMAP))
-        self.url = self.url.replace('//', '/').replace(
-            '%', '%%').replace('{', '%(').replace('}', ')s')
-
-        # XXX hack to fix broken fedora wadl.
-        if not self.url.startswith('/objects'):
-            self.url = '/objects%s' % self.url
-        
+        # (type, serializer) of every param and the serialized defaults,
+        # so a request only has to encode the params it is given
+        self.params = dict([(name, (param_type, SERIALIZERS[param_type]))
+                            for name, param_type
+                            in descriptor.param_types.items()])
+        self.defaults = dict([(name, serialize(value)) for name, value
+                              in descriptor.default_values.items()])
+
     def __call__(self, **params):
         url = self.url % params
         return WADLRequest(url, self)
 
 class WADLRequest(object):
+    """
+    A request for a WADL method on a URL. It is not changed when it is
+    submitted, so it can be submitted many times with different params.
+    """
     def __init__(self, url, method):
         self.url = url
         self.method = method
         self.headers = self.method.api.connection.form_headers.copy()
 
-        self.param_types = {}
+        self.param_types = self.method.descriptor.param_types
         self.undocumented_params = {} # needed in searchOjbects
-        self.default_values = {}
-        
-        for param in self.method.api.doc.xpath(
-            '//wadl:method[@id="%s"]/wadl:request/wadl:param' % self.method.id,
-            namespaces=NSMAP):
-            name = param.attrib['name']
-            param_type = {'xs:int': int,
-                          'xs:boolean': bool,
-                          'xs:string': unicode}[param.attrib['type']]
-            self.param_types[name] = param_type
-            default_value = param.attrib.get('default')
-            if default_value:
-                self.default_values[name] = default_value
-        
+        self.default_values = self.method.descriptor.default_values
 
-    def submit(self, body='', **params):
-        qs = self.default_values.copy()
-        for param, value in params.items():
-            param_type = self.param_types.get(param)
-            if param_type is None:
+    def query_url(self, **params):
+        """
+        Returns the URL with the query string of the params and defaults
+        """
+        qs = self.method.defaults.copy()
+        types = self.method.params
+        for param, value in params.iteritems():
+            try:
+                param_type, serializer = types[param]
+            except KeyError:
                 raise KeyError('Method "%s" has no param "%s"' % (
                     self.method.id, param))
-            if not isinstance(value, param_type):
+            if (value.__class__ is not param_type and
+                not isinstance(value, param_type)):
                 raise TypeError(
              'Expected %s for param "%s" on method "%s", got %s instead' % (
                     param_type,
                     param,
                     self.method.id,
                     value.__class__))
-            
-            if param_type is bool:
-                value = unicode(param_type).lower()
-            value = unicode(value)
-            qs[param] = value
-        for param, value in self.undocumented_params.items():
+            qs[param] = serializer(value)
+        for param, value in self.undocumented_params.iteritems():
             if not param in qs:
-                qs[param] = value
-        if qs:
-            self.url = '%s?%s' % (self.url, urllib.urlencode(qs))
+                qs[param] = serialize(value)
+        if not qs:
+            return self.url
+        return '%s?%s' % (self.url, urllib.urlencode(qs))
 
-        return self.method.api.connection.open(self.url,
+    def submit(self, body='', **params):
+        return self.method.api.connection.open(self.query_url(**params),
                                                body,
                                                self.headers,
-                                               method=self.method.name)
-    
+                                               method=self.method.name,
+                                               method_id=self.method.id,
+                                               template=self.method.url)
+
+class WADLCache(object):
+    """
+    Stores the compiled WADL method table on disk, keyed by server URL,
+    so a client can start without downloading and parsing the WADL file.
+    The table is stored with the version of the repository, it is not
+    used for another version.
+    """
+    def __init__(self, directory, ttl=3600, offline=False):
+        """
+         directory -- Directory to store the cache files in, it is
+                created when needed.
+
+         ttl -- Number of seconds a cached method table is used before
+                it is revalidated with a conditional GET.
+
+         offline -- Never revalidate, the API is loaded from the cache
+                without any network I/O, so the repository version is not
+                checked either.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.offline = offline
+
+    def path(self, url):
+        return os.path.join(self.directory,
+                            '%s.json' % hashlib.sha1(url).hexdigest())
+
+    def load(self, url, version=None):
+        """
+        Returns the cached entry of a server, or None. When a version is
+        given, an entry stored for another version is not returned.
+        """
+        try:
+            fp = open(self.path(url), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                entry = json.load(fp)
+            except ValueError:
+                # corrupt or partially written, ignore it
+                return None
+        finally:
+            fp.close()
+        if entry.get('url') != url:
+            return None
+        if version is not None and entry.get('version') != version:
+            # the server was upgraded, its methods may have changed
+            return None
+        # json returns unicode strings, but a unicode HTTP method would
+        # make httplib turn the whole request into unicode
+        entry['methods'] = [
+            MethodDescriptor(str(id), str(name), str(template),
+                             FrozenDict([(param, WADL_TYPES[type]) for
+                                         param, type in param_types.items()]),
+                             FrozenDict(default_values))
+            for id, name, template, param_types, default_values in
+            entry['methods']]
+        return entry
+
+    def store(self, url, entry):
+        entry = entry.copy()
+        entry['url'] = url
+        entry['methods'] = [
+            (m.id, m.name, m.url,
+             dict([(param, WADL_TYPE_NAMES[type]) for
+                   param, type in m.param_types.items()]),
+             m.default_values)
+            for m in entry['methods']]
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(url)
+        # write to a temporary file first, so concurrent clients never
+        # read a partially written cache file
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        fp = open(tmp_path, 'wb')
+        try:
+            json.dump(entry, fp)
+        finally:
+            fp.close()
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # windows can not rename over an existing file
+            os.remove(path)
+            os.rename(tmp_path, path)
+
+    def is_fresh(self, entry):
+        return self.offline or time.time() - entry['fetched'] < self.ttl
+
+
 class API(object):
-    def __init__(self, connection):
+    def __init__(self, connection, cache=None):
         self.connection = connection
-        fp = self.connection.open('/objects/application.wadl')
+        self.doc = None
+        entry = None
+        version = None
+        if cache is not None and cache.offline:
+            entry = cache.load(connection.url)
+            if entry is None:
+                raise APIException('No cached WADL file for %s' %
+                                   connection.url)
+        elif cache is not None:
+            # the repository version is only needed to check the cache,
+            # it costs another request
+            version = self._fetch_version()
+            entry = cache.load(connection.url, version)
+        if entry is None or not cache.is_fresh(entry):
+            entry = self._fetch(entry)
+            entry['version'] = version
+            if cache is not None:
+                cache.store(connection.url, entry)
+
+        self.version = entry['version']
+        self.methods = {}
+        for descriptor in entry['methods']:
+            self.methods[descriptor.id] = descriptor
+            self.__dict__[descriptor.id] = WADLMethod(descriptor, self)
+
+    def _fetch(self, entry=None):
+        headers = {}
+        if entry is not None:
+            if entry.get('lastModified'):
+                headers['If-Modified-Since'] = entry['lastModified']
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+        fp = self.connection.open('/objects/application.wadl',
+                                  headers=headers)
+        if fp.status == 304:
+            fp.read()
+            fp.close()
+            # the cached method table is still valid
+            entry['fetched'] = time.time()
+            return entry
         wadl_xml = fp.read()
+        last_modified = fp.getheader('last-modified')
+        etag = fp.getheader('etag')
         fp.close()
         self.doc = etree.fromstring(wadl_xml)
-        for method in self.doc.xpath('//wadl:method',
-                                     namespaces=NSMAP):
-            method_id = method.attrib['id']
-            method_name = method.attrib['name']
-            self.__dict__[method_id] = WADLMethod(method_id, method_name, self)
+        methods = [compile_method(method) for method in
+                   self.doc.iterfind('.//wadl:method', namespaces=NSMAP)]
+        return {'methods': methods,
+                'version': None,
+                'fetched': time.time(),
+                'lastModified': last_modified,
+                'etag': etag}
+
+    def _fetch_version(self):
+        try:
+            fp = self.connection.open('/describe?xml=true')
+        except FedoraConnectionException:
+            return None
+        xml = fp.read()
+        fp.close()
+        doc = etree.fromstring(xml)
+        for child in doc:
+            # namespaced in 3.4, but not in 3.3
+            if child.tag.split('}')[-1] == 'repositoryVersion':
+                return child.text
+        return None
         
@@ -0,0 +1,212 @@
+# Copyright (c) 2010 Infrae / Technical University Delft. All rights reserved.
+# See also LICENSE.txt
+
+import threading
+import Queue
+
+_STOP = object()
+
+def imap_unordered(func, iterable, workers=4, maxpending=None):
+    """
+    Call func for every item of iterable in a pool of worker threads, and
+    yield (item, result, error) tuples in the order they complete. Error is
+    the exception raised by func, or None.
+
+    Items are taken from the iterable only when there is room, at most
+    maxpending items (twice the number of workers by default) are queued
+    or in progress, so memory use does not depend on the number of items.
+
+    With a single worker everything runs in the calling thread.
+    """
+    if workers <= 1:
+        for item in iterable:
+            try:
+                result = func(item)
+            except Exception, e:
+                yield item, None, e
+            else:
+                yield item, result, None
+        return
+
+    if maxpending is None:
+        maxpending = workers * 2
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is _STOP:
+                break
+            try:
+                result = func(item)
+            except Exception, e:
+                results.put((item, None, e))
+            else:
+                results.put((item, result, None))
+
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    items = iter(iterable)
+    pending = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and pending < maxpending:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    exhausted = True
+                else:
+                    tasks.put(item)
+                    pending += 1
+            if not pending:
+                break
+            result = results.get()
+            pending -= 1
+            yield result
+    finally:
+        # also reached when the consumer stops iterating early
+        while True:
+            try:
+                tasks.get_nowait()
+            except Queue.Empty:
+                break
+        for thread in threads:
+            tasks.put(_STOP)
+
+class Future(object):
+    """
+    The result of a call running in an Executor
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return its result, or raise the
+        exception it raised.
+        """
+        if not self._done.wait(timeout) and not self.done():
+            raise TimeoutError(u'The call did not finish in time')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout) and not self.done():
+            raise TimeoutError(u'The call did not finish in time')
+        return self._error
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with the future when it is done, in the thread that
+        finishes it, or right away when it is done already.
+        """
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, error):
+        self._error = error
+        self._finish()
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+class TimeoutError(Exception):
+    pass
+
+class Executor(object):
+    """
+    A pool of worker threads which run calls in the background, the
+    threads are started when the first call is submitted.
+    """
+    def __init__(self, workers=4):
+        self.workers = max(workers, 1)
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Call func with the arguments in a worker thread, returns a Future
+        """
+        future = Future()
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise RuntimeError(u'The executor has been shut down')
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+        self._tasks.put((future, func, args, kwargs))
+        return future
+
+    def map(self, func, iterable):
+        """
+        Submit func for every item, returns a list of Futures
+        """
+        return [self.submit(func, item) for item in iterable]
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is _STOP:
+                break
+            future, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads after the calls already submitted
+        """
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            threads = list(self._threads)
+        finally:
+            self._lock.release()
+        for thread in threads:
+            self._tasks.put(_STOP)
+        if wait:
+            for thread in threads:
+                thread.join()